@@ -1,6 +1,6 @@
 import time
-import sys
-import select
+import struct
+import binascii
 import controls
 import random
 import usb_cdc
@@ -9,18 +9,54 @@ import supervisor
 
 
 MAX_BRIGHTNESS = 50
-TICK_MS = 50
-buffer = ""
-last_tick_time = time.monotonic()
+# How often each job in the main loop runs
+CONTROL_MS = 20
+SENSOR_MS = 20
+LED_MS = 100
+# Longest the loop sleeps before looking for host input again
+INPUT_MS = 5
+# Telemetry and debug output in Hz, changed by the host with e.g. RATE STAT=25 DEBUG=1
+rates = {"STAT": 20, "DEBUG": 0}
+MAX_RATE = 100
+# Longest line the host can send, anything longer is thrown away
+RX_BUFFER_SIZE = 1024
+rx_buffer = bytearray(RX_BUFFER_SIZE)
+rx_view = memoryview(rx_buffer)
+rx_len = 0
+# the rest of an over-long line still has to be skipped
+rx_overflow = False
 MOTOR_MIN = 0.2
 MOTOR_MIN_START = 0.3
 MOTOR_MAX_START = 0.5
-MOTOR_MAX_CHANGE_TICK = 0.2
+MOTOR_MAX_CHANGE_PER_S = 4.0
+MOTOR_MAX_CHANGE_TICK = MOTOR_MAX_CHANGE_PER_S * CONTROL_MS / 1000
 SV1_ADJUST = 0
 SV2_ADJUST = 5
 SV3_ADJUST = 0
 SV4_ADJUST = 0
 
+# Binary frames, kept in sync with web/app/framing.py. What we send:
+#   0xA5 | payload length | frame type | payload | crc32(type + payload)
+# What the host sends is a line, byte stuffed so it can't contain Ctrl-C or a newline:
+#   0xA5 | stuffed(frame type | payload | crc32(type + payload)) | \n
+# Text lines work alongside them, PROTO BIN only switches what we print.
+FRAME_MAGIC = 0xA5
+FRAME_ESC = 0x7D
+FRAME_STAT = 1
+FRAME_MOT = 2
+FRAME_STOP = 3
+FRAME_RESET = 4
+FRAME_BATCH = 5
+# between commands on one line, which are applied all together or not at all
+BATCH_SEPARATOR = ";"
+STAT_LAYOUT = "<3f4hB2f3f3f"
+MOT_LAYOUT = "<HBffhh"
+MOT_CHANNELS = ("X", "Z", "SV1", "SV2", "FU", "FD", "FL", "FR", "RU", "RD", "RL", "RR")
+RESET_MODES = ("", "SOFT", "SAFE")
+binary_output = False
+acc = (-1.0, -1.0, -1.0)
+gyro = (-1.0, -1.0, -1.0)
+
 class Requests:
     x: float = 0.0
     y: float = 0.0
@@ -60,73 +96,74 @@ def soft_servo_control(servo, requested):
     elif servo == controls.sv2:
         controls.sv2.angle = clamp(0, 180, requested + SV2_ADJUST)
 
-def cmd_mot(params):
-    commands = params.split(" ")
-    for command in commands:
+def cmd_mot(updates):
+    for apply, value in updates:
+        apply(value)
+
+def mot_updates(params):
+    """Every channel of a MOT line checked first, so a bad one leaves the rest untouched too."""
+    updates = []
+    for command in params.split(" "):
         channel, _, value = command.partition("=")
-        if channel in ["X", "Y", "Z"]:
-            try:
-                value = float(value)
-            except Exception:
-                do_error("Number format")
-                continue
-            if value < -1.0 or value > 1.0:
-                do_error("Range")
-                continue
-        if channel in ["FU", "FD", "FL", "FR", "RU", "RD", "RL", "RR"]:
-            try:
-                value = int(value)
-            except Exception:
-                do_error("Number format")
-                continue
-            if value not in [0, 1]:
-                do_error("Range")
-                continue
-        # TODO servo range
-        if channel in ["SV1", "SV2", "SV3", "SV4"]:
-            try:
-                value = int(value)
-            except Exception:
-                do_error("Number format")
-                continue
-            if value < 0 or value > 180:
-                do_error("Range")
-                continue
-        if channel == "X":
-            # controls.motor_x.throttle = value
-            requests.x = value
-        elif channel == "Y":
-            # controls.motor_y.throttle = value
-            requests.y = value
-        elif channel == "Z":
-            # controls.motor_z.throttle = value
-            requests.z = value
-        # elif channel == "W":
-        #     controls.motor_w.throttle = value
-        elif channel == "FU":
-            controls.jet_fu.value = bool(value)
-        elif channel == "FD":
-            controls.jet_fd.value = bool(value)
-        elif channel == "FL":
-            controls.jet_fl.value = bool(value)
-        elif channel == "FR":
-            controls.jet_fr.value = bool(value)
-        elif channel == "RU":
-            controls.jet_ru.value = bool(value)
-        elif channel == "RD":
-            controls.jet_rd.value = bool(value)
-        elif channel == "RL":
-            controls.jet_rl.value = bool(value)
-        elif channel == "RR":
-            controls.jet_rr.value = bool(value)
-        elif channel == "SV1":
-            soft_servo_control(controls.sv1, value)
-        elif channel == "SV2":
-            soft_servo_control(controls.sv2, value)
-        elif channel == "SV3":
-            controls.sv3.angle = value
-        elif channel == "SV4":
-            controls.sv4.angle = value
+        if channel not in MOT_CHANNEL_TABLE:
+            continue
+        update = mot_channel(channel, value)
+        if update is None:
+            return None
+        updates.append(update)
+    return updates
+
+def mot_channel(channel, value):
+    convert, low, high, apply = MOT_CHANNEL_TABLE[channel]
+    try:
+        value = convert(value)
+    except Exception:
+        do_error("Number format")
+        return None
+    if value < low or value > high:
+        do_error("Range")
+        return None
+    return (apply, value)
+
+def set_request(axis):
+    def apply(value):
+        setattr(requests, axis, value)
+    return apply
+
+def set_jet(jet):
+    def apply(value):
+        jet.value = bool(value)
+    return apply
+
+def set_servo(servo):
+    def apply(value):
+        soft_servo_control(servo, value)
+    return apply
+
+def set_angle(servo):
+    def apply(value):
+        servo.angle = value
+    return apply
+
+# channel -> (converter, min, max, setter), worked out once instead of per command
+# TODO servo range
+MOT_CHANNEL_TABLE = {
+    "X": (float, -1.0, 1.0, set_request("x")),
+    "Y": (float, -1.0, 1.0, set_request("y")),
+    "Z": (float, -1.0, 1.0, set_request("z")),
+    "FU": (int, 0, 1, set_jet(controls.jet_fu)),
+    "FD": (int, 0, 1, set_jet(controls.jet_fd)),
+    "FL": (int, 0, 1, set_jet(controls.jet_fl)),
+    "FR": (int, 0, 1, set_jet(controls.jet_fr)),
+    "RU": (int, 0, 1, set_jet(controls.jet_ru)),
+    "RD": (int, 0, 1, set_jet(controls.jet_rd)),
+    "RL": (int, 0, 1, set_jet(controls.jet_rl)),
+    "RR": (int, 0, 1, set_jet(controls.jet_rr)),
+    "SV1": (int, 0, 180, set_servo(controls.sv1)),
+    "SV2": (int, 0, 180, set_servo(controls.sv2)),
+    "SV3": (int, 0, 180, set_angle(controls.sv3)),
+    "SV4": (int, 0, 180, set_angle(controls.sv4)),
+}
 
 def cmd_reset(params):
     if params == "SOFT":
@@ -161,79 +198,304 @@ def cmd_stop(params):
     controls.sv1.angle = clamp(0, 180, 90 + SV1_ADJUST)
     controls.sv2.angle = clamp(0, 180, 90 + SV2_ADJUST)
 
+def cmd_proto(params):
+    global binary_output
+    if params == "BIN":
+        binary_output = True
+    elif params == "TEXT":
+        binary_output = False
+    else:
+        do_error("Range")
+        return
+    # acknowledged as text so the host sees it whatever it was expecting
+    print(f"PROTO {params}")
+
+def rate_updates(params):
+    """Every setting of a RATE line checked first, so a bad one changes none of them."""
+    changes = {}
+    for setting in params.split():
+        name, _, value = setting.partition("=")
+        if name not in rates:
+            do_error("Unknown rate")
+            return None
+        try:
+            value = int(value)
+        except Exception:
+            do_error("Number format")
+            return None
+        if value < 0 or value > MAX_RATE:
+            do_error("Range")
+            return None
+        changes[name] = value
+    return changes
+
+def cmd_rate(changes):
+    # a bare RATE changes nothing and reports the current rates
+    rates.update(changes)
+    stat_job.set_rate(rates["STAT"])
+    debug_job.set_rate(rates["DEBUG"])
+    print(f"RATE STAT={rates['STAT']} DEBUG={rates['DEBUG']}")
+
+def frame_mot_updates(payload):
+    mask, jets, x, z, sv1, sv2 = struct.unpack(MOT_LAYOUT, payload)
+    values = (x, z, sv1, sv2)
+    updates = []
+    for bit, channel in enumerate(MOT_CHANNELS):
+        if not mask & (1 << bit):
+            continue
+        update = mot_channel(channel, values[bit] if bit < 4 else (jets >> (bit - 4)) & 1)
+        if update is None:
+            return None
+        updates.append(update)
+    return updates
+
+def frame_stop(payload):
+    cmd_stop("")
+
+def frame_reset(payload):
+    mode = payload[0] if payload else 0
+    cmd_reset(RESET_MODES[mode] if mode < len(RESET_MODES) else "")
+
+# frame type -> (payload length, check turning the payload into the handler's argument or None, handler)
+FRAME_HANDLERS = {
+    FRAME_MOT: (struct.calcsize(MOT_LAYOUT), frame_mot_updates, cmd_mot),
+    FRAME_STOP: (0, None, frame_stop),
+    FRAME_RESET: (1, None, frame_reset),
+}
+
+def write_frame(frame_type, payload):
+    body = bytes((frame_type,)) + payload
+    usb_cdc.console.write(bytes((FRAME_MAGIC, len(payload))) + body + struct.pack("<I", binascii.crc32(body)))
+
+def print_stat(acc, gyro):
+    if not binary_output:
+        print(f"STAT X={controls.motor_x.throttle or 0.0} Y={controls.motor_y.throttle or 0.0} Z={controls.motor_z.throttle or 0.0} SV1={controls.sv1.angle or -1} " +
+              f"SV2={controls.sv2.angle or -1} SV3={controls.sv3.angle or -1} SV4={controls.sv4.angle or -1} FU={int(controls.jet_fu.value)} " +
+              f"FD={int(controls.jet_fd.value)} FL={int(controls.jet_fl.value)} FR={int(controls.jet_fr.value)} RU={int(controls.jet_ru.value)} " +
+              f"RD={int(controls.jet_rd.value)} RL={int(controls.jet_rl.value)} RR={int(controls.jet_rr.value)} BAT={controls.sensor_battery.value / 65535.0 * 3.3 * 4} " +
+              f"DEPTH={controls.sensor_depth.value / 65535.0} ACC={acc[0]},{acc[1]},{acc[2]} " +
+              f"GYRO={gyro[0]},{gyro[1]},{gyro[2]}")
+        return
+    jets = 0
+    for bit, jet in enumerate((controls.jet_fu, controls.jet_fd, controls.jet_fl, controls.jet_fr,
+                               controls.jet_ru, controls.jet_rd, controls.jet_rl, controls.jet_rr)):
+        if jet.value:
+            jets |= 1 << bit
+    write_frame(FRAME_STAT, struct.pack(
+        STAT_LAYOUT,
+        controls.motor_x.throttle or 0.0, controls.motor_y.throttle or 0.0, controls.motor_z.throttle or 0.0,
+        round(controls.sv1.angle or -1), round(controls.sv2.angle or -1),
+        round(controls.sv3.angle or -1), round(controls.sv4.angle or -1),
+        jets,
+        controls.sensor_battery.value / 65535.0 * 3.3 * 4, controls.sensor_depth.value / 65535.0,
+        acc[0], acc[1], acc[2], gyro[0], gyro[1], gyro[2]))
+
+def unstuff(data):
+    if FRAME_ESC not in data:
+        return data
+    out = bytearray()
+    escaped = False
+    for byte in data:
+        if escaped:
+            out.append(byte ^ 0x20)
+            escaped = False
+        elif byte == FRAME_ESC:
+            escaped = True
+        else:
+            out.append(byte)
+    return bytes(out)
+
+def frame_calls(body):
+    """(handler, argument) for each frame in a frame or BATCH body, None if any is bad."""
+    pos = 1 if body[0] == FRAME_BATCH else 0
+    calls = []
+    while pos < len(body):
+        spec = FRAME_HANDLERS.get(body[pos])
+        end = pos + 1 + spec[0] if spec else 0
+        if spec is None or end > len(body) or (pos == 0 and end != len(body)):
+            do_error("Frame")
+            return None
+        _, check, handler = spec
+        arg = body[pos + 1:end]
+        if check is not None:
+            arg = check(arg)
+            if arg is None:
+                return None
+        calls.append((handler, arg))
+        pos = end
+    return calls
+
+def handle_frame(data):
+    data = unstuff(data)
+    body = data[:-4]
+    if not body or struct.unpack("<I", data[-4:])[0] != binascii.crc32(body):
+        do_error("Frame")
+        return
+    calls = frame_calls(body)
+    if calls:
+        for handler, arg in calls:
+            handler(arg)
+
 def cmd_error(params):
     raise ValueError(params)
 
 def do_error(params):
     print(f"ERR {params}")
 
+COMMANDS = {
+    "MOT": cmd_mot,
+    "RESET": cmd_reset,
+    "BOOT": cmd_boot,
+    "STOP": cmd_stop,
+    "ERROR": cmd_error,
+    "PROTO": cmd_proto,
+    "RATE": cmd_rate,
+}
+
+# command -> check turning its text arguments into the handler's argument, or None after an ERR
+CHECKS = {
+    "MOT": mot_updates,
+    "RATE": rate_updates,
+}
+
+def read_lines():
+    """Everything the host has sent so far, as complete lines."""
+    global rx_len, rx_overflow
+    lines = []
+    waiting = usb_cdc.console.in_waiting
+    while waiting:
+        if rx_len == RX_BUFFER_SIZE:
+            # no newline in a whole buffer, nothing sensible to do with it
+            rx_len = 0
+            rx_overflow = True
+            do_error("Overflow")
+        rx_len += usb_cdc.console.readinto(rx_view[rx_len:rx_len + min(waiting, RX_BUFFER_SIZE - rx_len)])
+
+        # searched as bytes, bytearray has no find() in MicroPython and CircuitPython builds
+        data = bytes(rx_view[:rx_len])
+        start = 0
+        end = data.find(b"\n")
+        while end >= 0:
+            if rx_overflow:
+                rx_overflow = False
+            else:
+                lines.append(data[start:end])
+            start = end + 1
+            end = data.find(b"\n", start)
+        if start:
+            rx_len -= start
+            rx_view[:rx_len] = data[start:]
+        waiting = usb_cdc.console.in_waiting
+    return lines
+
+def dispatch(line):
+    if line and line[0] == FRAME_MAGIC:
+        handle_frame(line[1:])
+        return
+    while b"\x08" in line:
+        # backspace while typing in a terminal
+        erase = line.find(b"\x08")
+        line = line[:max(0, erase - 1)] + line[erase + 1:]
+    try:
+        line = line.decode("utf-8").strip()
+    except UnicodeError:
+        do_error("Encoding")
+        return
+    # everything on the line is checked before any of it is applied
+    calls = []
+    for command in line.split(BATCH_SEPARATOR):
+        cmd, _, tail = command.strip().partition(" ")
+        handler = COMMANDS.get(cmd)
+        if handler is None:
+            do_error("Unknown command")
+            return
+        arg = tail.strip()
+        check = CHECKS.get(cmd)
+        if check is not None:
+            arg = check(arg)
+            if arg is None:
+                return
+        calls.append((handler, arg))
+    for handler, arg in calls:
+        handler(arg)
+
 cmd_stop("")
 
 supervisor.runtime.autoreload = False
 supervisor.set_next_code_file(None, reload_on_error=True, sticky_on_error=True)
 
+class Job:
+    """Something the main loop runs every period_ms, or never when the period is 0."""
+
+    def __init__(self, period_ms, run):
+        self.period = period_ms * 1_000_000
+        self.due = 0
+        self.run = run
+
+    def set_rate(self, hz):
+        self.period = 1_000_000_000 // hz if hz else 0
+
+def control():
+    soft_motor_control(controls.motor_x, requests.x)
+    soft_motor_control(controls.motor_y, requests.y)
+    soft_motor_control(controls.motor_z, requests.z)
+
+def sample_sensors():
+    global acc, gyro
+    try:
+        acc = controls.mpu.acceleration
+        gyro = controls.mpu.gyro
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        acc = (-1.0, -1.0, -1.0)
+        gyro = (-1.0, -1.0, -1.0)
+
+def blink():
+    controls.led.value = not controls.led.value
+    controls.pixels[0] = (random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS))
+    controls.pixels[1] = (random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS))
+    controls.pixels[2] = (random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS))
+
+def telemetry():
+    print_stat(acc, gyro)
+
+def debug():
+    print(f"# req x = {requests.x}, current x = {controls.motor_x.throttle}")
+    print(f"# req y = {requests.y}, current y = {controls.motor_y.throttle}")
+    print(f"# req z = {requests.z}, current z = {controls.motor_z.throttle}")
+
+stat_job = Job(0, telemetry)
+stat_job.set_rate(rates["STAT"])
+debug_job = Job(0, debug)
+debug_job.set_rate(rates["DEBUG"])
+# control first, so it runs on time even when a sensor read or print is slow
+jobs = (Job(CONTROL_MS, control), Job(SENSOR_MS, sample_sensors), stat_job, Job(LED_MS, blink), debug_job)
+
 try:
     # Main loop
     while True:
         if not supervisor.runtime.serial_connected:
             cmd_stop("")
-        while select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], []):
-            buffer += sys.stdin.read(1)
-            if buffer[-1] == '\x08':
-                buffer = buffer[0:-2]
-        # print(repr(buffer))
-        lines = []
-        while "\n" in buffer:
-            line, _, buffer = buffer.partition("\n")
-            lines.append(line)
-
-        # Main dispatch
-        for line in lines:
-            cmd, _, tail = line.partition(" ")
-            tail = tail.strip()
-            if cmd == "MOT":
-                cmd_mot(tail)
-            elif cmd == "RESET":
-                cmd_reset(tail)
-            elif cmd == "BOOT":
-                cmd_boot(tail)
-            elif cmd == "STOP":
-                cmd_stop(tail)
-            elif cmd == "ERROR":
-                cmd_error(tail)
-            else:
-                do_error("Unknown command")
-
-        print(f"# req x = {requests.x}, current x = {controls.motor_x.throttle}")
-        print(f"# req y = {requests.y}, current y = {controls.motor_y.throttle}")
-        print(f"# req z = {requests.z}, current z = {controls.motor_z.throttle}")
-        soft_motor_control(controls.motor_x, requests.x)
-        soft_motor_control(controls.motor_y, requests.y)
-        soft_motor_control(controls.motor_z, requests.z)
-
-        controls.led.value = not controls.led.value
-        controls.pixels[0] = (random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS))
-        controls.pixels[1] = (random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS))
-        controls.pixels[2] = (random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS), random.randint(0, MAX_BRIGHTNESS))
-        time_delta = time.monotonic() - last_tick_time
-        # print("#", last_tick_time, time.monotonic(), time_delta)
-        try:
-            acc = controls.mpu.acceleration
-            gyro = controls.mpu.gyro
-        except Exception:
-            import traceback
-            traceback.print_exc()
-            acc = (-1.0, -1.0, -1.0)
-            gyro = (-1.0, -1.0, -1.0)
-        print(f"STAT X={controls.motor_x.throttle or 0.0} Y={controls.motor_y.throttle or 0.0} Z={controls.motor_z.throttle or 0.0} SV1={controls.sv1.angle or -1} " +
-              f"SV2={controls.sv2.angle or -1} SV3={controls.sv3.angle or -1} SV4={controls.sv4.angle or -1} FU={int(controls.jet_fu.value)} " +
-              f"FD={int(controls.jet_fd.value)} FL={int(controls.jet_fl.value)} FR={int(controls.jet_fr.value)} RU={int(controls.jet_ru.value)} " +
-              f"RD={int(controls.jet_rd.value)} RL={int(controls.jet_rl.value)} RR={int(controls.jet_rr.value)} BAT={controls.sensor_battery.value / 65535.0 * 3.3 * 4} " +
-              f"DEPTH={controls.sensor_depth.value / 65535.0} ACC={acc[0]},{acc[1]},{acc[2]} " +
-              f"GYRO={gyro[0]},{gyro[1]},{gyro[2]}")
-        time_to_sleep = TICK_MS/1000.0 - time_delta
+            binary_output = False
+        for line in read_lines():
+            dispatch(line)
+
+        now = time.monotonic_ns()
+        next_due = now + INPUT_MS * 1_000_000
+        for job in jobs:
+            if not job.period:
+                continue
+            if now >= job.due:
+                job.run()
+                job.due += job.period
+                if job.due <= now:
+                    # fell behind, skip the missed runs rather than bunching them up
+                    job.due = now + job.period
+            next_due = min(next_due, job.due)
+
+        time_to_sleep = next_due - time.monotonic_ns()
         if time_to_sleep > 0:
-            time.sleep(time_to_sleep)
-        last_tick_time = time.monotonic()
+            time.sleep(time_to_sleep / 1_000_000_000)
 except KeyboardInterrupt:
     pass
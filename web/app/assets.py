@@ -0,0 +1,219 @@
+import argparse
+import gzip
+import hashlib
+import logging
+import mimetypes
+from pathlib import Path
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Every file under static/ is read once at startup and served from memory:
+#
+#   /static/js/lodash.js               Cache-Control: no-cache, revalidated by ETag
+#   /static/js/lodash.<hash>.js        Cache-Control: immutable for a year
+#
+# Templates link the hashed name through static_url(), so a tablet fetches a
+# file again only when it changed. Text is sent brotli or gzip compressed when
+# the browser accepts it. `uv run app/assets.py` writes the compressed variants
+# next to the files beforehand, otherwise they're made at startup.
+HASH_LENGTH = 12
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+# A compressed variant has to be at least this much smaller to be worth it
+MIN_SAVING = 0.1
+# Encodings in order of preference, the file extension a precompressed variant has
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# What mimetypes doesn't know or gets wrong. Anything else it doesn't know is
+# text/plain, as StaticFiles did, which is how htmx without an extension loads
+CONTENT_TYPES = {
+    ".js": "text/javascript",
+    ".obj": "text/plain",
+    ".mtl": "text/plain",
+}
+
+_ACCEPT = re.compile(r"\s*([^\s;,]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?")
+
+
+def compress(data: bytes, encoding: str) -> bytes | None:
+    if encoding == "gzip":
+        return gzip.compress(data, GZIP_LEVEL, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return None
+
+
+def hashed_name(name: str, digest: str) -> str:
+    stem, dot, suffix = name.rpartition(".")
+    if not dot or not stem:
+        return f"{name}.{digest}"
+    return f"{stem}.{digest}.{suffix}"
+
+
+def accepted_encodings(header: str) -> set[str]:
+    """Encodings an Accept-Encoding header allows, leaving out q=0."""
+    accepted = set()
+    for token, q in _ACCEPT.findall(header):
+        try:
+            if q and float(q) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(token.lower())
+    if "*" in accepted:
+        accepted.update(ENCODINGS)
+    return accepted
+
+
+def content_type(path: Path) -> str:
+    media_type = CONTENT_TYPES.get(path.suffix) or mimetypes.guess_type(path.name)[0] or "text/plain"
+    if media_type.startswith("text/"):
+        media_type += "; charset=utf-8"
+    return media_type
+
+
+def _precompressed(path: Path, encoding: str) -> bytes | None:
+    variant = path.with_name(path.name + ENCODINGS[encoding])
+    if variant.exists() and variant.stat().st_mtime >= path.stat().st_mtime:
+        return variant.read_bytes()
+    return None
+
+
+class Asset:
+    """One file: its bytes, compressed variants and the headers to send with each."""
+
+    def __init__(self, path: Path):
+        data = path.read_bytes()
+        self.digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        media_type = content_type(path)
+        # encoding -> body, "" for uncompressed
+        self.bodies = {"": data}
+        for encoding in ENCODINGS:
+            body = _precompressed(path, encoding) or compress(data, encoding)
+            if body is not None and len(body) <= len(data) * (1 - MIN_SAVING):
+                self.bodies[encoding] = body
+        # (encoding, immutable) -> raw headers
+        self.headers: dict[tuple[str, bool], list[tuple[bytes, bytes]]] = {}
+        for encoding, body in self.bodies.items():
+            for immutable in (False, True):
+                headers = [
+                    (b"content-type", media_type.encode()),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"etag", f'"{self.digest}{"-" + encoding if encoding else ""}"'.encode()),
+                    (b"cache-control", (IMMUTABLE if immutable else REVALIDATE).encode()),
+                    (b"vary", b"accept-encoding"),
+                ]
+                if encoding:
+                    headers.append((b"content-encoding", encoding.encode()))
+                self.headers[encoding, immutable] = headers
+
+    def encoding_for(self, accept: str) -> str:
+        if len(self.bodies) > 1:
+            accepted = accepted_encodings(accept)
+            for encoding in ENCODINGS:
+                if encoding in self.bodies and encoding in accepted:
+                    return encoding
+        return ""
+
+
+class StaticAssets:
+    """Serves a directory from memory with content-hashed URLs and precompressed variants.
+
+    An ASGI app to mount in place of StaticFiles. Files changed on disk are picked
+    up on restart.
+    """
+
+    def __init__(self, directory: Path | str, prefix: str = "/static"):
+        self.directory = Path(directory)
+        self.prefix = prefix.rstrip("/")
+        self.assets: dict[str, Asset] = {}
+        # URL path -> (asset, immutable)
+        self.routes: dict[str, tuple[Asset, bool]] = {}
+        for path in sorted(self.directory.rglob("*")):
+            if not path.is_file() or path.suffix in ENCODINGS.values() or path.name.startswith("."):
+                continue
+            name = path.relative_to(self.directory).as_posix()
+            asset = self.assets[name] = Asset(path)
+            self.routes[f"/{name}"] = (asset, False)
+            self.routes["/" + hashed_name(name, asset.digest)] = (asset, True)
+        sizes = [(len(a.bodies[""]), min(len(b) for b in a.bodies.values())) for a in self.assets.values()]
+        logger.info(
+            "%d static files, %d KiB, %d KiB compressed%s",
+            len(sizes), sum(s for s, _ in sizes) // 1024, sum(c for _, c in sizes) // 1024,
+            "" if brotli else " (install brotli for smaller files)",
+        )
+
+    def url(self, path: str) -> str:
+        """The content-hashed URL for a file, for templates."""
+        name = path.lstrip("/")
+        if (asset := self.assets.get(name)) is None:
+            return f"{self.prefix}/{name}"
+        return f"{self.prefix}/{hashed_name(name, asset.digest)}"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        path = scope["path"]
+        root = scope.get("root_path", "")
+        if root and path.startswith(root):
+            path = path[len(root):]
+        if scope["method"] not in ("GET", "HEAD"):
+            await self._respond(send, 405, [(b"allow", b"GET, HEAD")])
+            return
+        if (route := self.routes.get(path)) is None:
+            await self._respond(send, 404, [(b"content-type", b"text/plain; charset=utf-8")], b"Not Found")
+            return
+        asset, immutable = route
+
+        accept = if_none_match = b""
+        for key, value in scope["headers"]:
+            if key == b"accept-encoding":
+                accept = value
+            elif key == b"if-none-match":
+                if_none_match = value
+        encoding = asset.encoding_for(accept.decode("latin-1"))
+        headers = asset.headers[encoding, immutable]
+        etag = headers[2][1]
+        if if_none_match and (if_none_match == b"*" or etag in (tag.strip() for tag in if_none_match.split(b","))):
+            await self._respond(send, 304, [h for h in headers if h[0] not in (b"content-length", b"content-type")])
+            return
+        body = asset.bodies[encoding] if scope["method"] == "GET" else b""
+        await self._respond(send, 200, headers, body)
+
+    @staticmethod
+    async def _respond(send, status: int, headers: list, body: bytes = b""):
+        if status not in (200, 304):
+            headers = headers + [(b"content-length", str(len(body)).encode())]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write compressed variants of the static files next to them.")
+    parser.add_argument("directory", nargs="?", default=str(Path(__file__).resolve().parent.parent / "static"))
+    args = parser.parse_args()
+    if brotli is None:
+        print("brotli isn't installed, only writing .gz files")
+    for path in sorted(Path(args.directory).rglob("*")):
+        if not path.is_file() or path.suffix in ENCODINGS.values() or path.name.startswith("."):
+            continue
+        data = path.read_bytes()
+        for encoding, extension in ENCODINGS.items():
+            variant = path.with_name(path.name + extension)
+            body = compress(data, encoding)
+            if body is None or len(body) > len(data) * (1 - MIN_SAVING):
+                variant.unlink(missing_ok=True)
+                continue
+            variant.write_bytes(body)
+            print(f"{variant}: {len(data)} -> {len(body)}")
+
+
+if __name__ == "__main__":
+    main()
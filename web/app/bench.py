@@ -0,0 +1,333 @@
+import argparse
+from asyncio import run, sleep
+from datetime import datetime, timezone
+from itertools import cycle
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+from pydantic import ValidationError
+
+from gamepad_frame import GamepadSnapshot, SnapshotDiffer, decode_snapshot, encode_snapshot
+from logs import setup_logging
+from protocol import Command, ConsoleLog, MotionCmd, StateCmd, StopCmd
+
+# Benchmark results are JSON, usually written with --json and read back with --compare:
+#
+#   {"meta": {...}, "results": [{"name": ..., "median_ns": ..., ...}, ...]}
+#
+# Slowdown of a median against the baseline that --compare calls a regression
+REGRESSION_THRESHOLD = 0.10
+# A round is at least this long, so timer resolution doesn't matter
+MIN_ROUND_TIME = 0.02
+ROUNDS = 15
+FANOUT_CLIENTS = (1, 10, 100)
+SIM_VEHICLES = (1, 100)
+
+
+def stat_lines(count: int = 64, seed: int = 0) -> list[str]:
+    """STAT lines as firmware/code.py prints them, with values that change like a sub in use."""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        x = rng.choice((0.0, 0.0, 0.5, -1.0, round(rng.uniform(-1, 1), 6)))
+        sv1 = float(rng.choice((90, 90, 45, 135, rng.randint(0, 180))))
+        sv2 = float(180 - sv1)
+        jets = [rng.random() < 0.1 for _ in range(8)]
+        acc = [round(rng.gauss(0, 0.3), 6), round(rng.gauss(0, 0.3), 6), round(rng.gauss(9.81, 0.1), 6)]
+        gyro = [round(rng.gauss(0, 2), 6) for _ in range(3)]
+        lines.append(
+            f"STAT X={x} Y=0.0 Z={x} SV1={sv1} SV2={sv2} SV3=-1 SV4=-1 "
+            + " ".join(f"{jet}={int(on)}" for jet, on in zip(("FU", "FD", "FL", "FR", "RU", "RD", "RL", "RR"), jets))
+            + f" BAT={round(rng.uniform(10.5, 12.6), 5)} DEPTH={round(rng.uniform(0, 0.2), 6)}"
+            + f" ACC={acc[0]},{acc[1]},{acc[2]} GYRO={gyro[0]},{gyro[1]},{gyro[2]}"
+        )
+    return lines
+
+
+class FakeWebSocket:
+    """Just enough of a WebSocket for WebSocketClient, counting what it was sent."""
+
+    def __init__(self, port: int):
+        self.client = SimpleNamespace(host="127.0.0.1", port=port)
+        self.sent = 0
+
+    async def send_text(self, text: str):
+        self.sent += 1
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+class Bench:
+    def __init__(self, rounds: int = ROUNDS, min_round_time: float = MIN_ROUND_TIME, only: list[str] | None = None):
+        self.rounds = rounds
+        self.min_round_time = min_round_time
+        self.only = only
+        self.results: list[dict] = []
+
+    def wanted(self, name: str) -> bool:
+        return not self.only or any(pattern in name for pattern in self.only)
+
+    def run(self, name: str, fn):
+        if not self.wanted(name):
+            return
+
+        def timed(number: int) -> float:
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            return time.perf_counter() - start
+
+        self._record(name, timed)
+
+    async def run_async(self, name: str, fn):
+        if not self.wanted(name):
+            return
+
+        async def timed(number: int) -> float:
+            start = time.perf_counter()
+            for _ in range(number):
+                await fn()
+            return time.perf_counter() - start
+
+        # same calibration as _record(), inside the running event loop
+        number = 1
+        while (elapsed := await timed(number)) < self.min_round_time:
+            number = int(number * (2 if elapsed < self.min_round_time / 4 else 1.5))
+        times = [await timed(number) / number for _ in range(self.rounds)]
+        self._add(name, number, times)
+
+    def _record(self, name: str, timed):
+        number = 1
+        while (elapsed := timed(number)) < self.min_round_time:
+            number = int(number * (2 if elapsed < self.min_round_time / 4 else 1.5))
+        times = [timed(number) / number for _ in range(self.rounds)]
+        self._add(name, number, times)
+
+    def speedup(self, name: str, reference: str):
+        """Print how many times faster name ran than reference."""
+        medians = {r["name"]: r["median_ns"] for r in self.results}
+        if name in medians and reference in medians:
+            print(f"{name:40} x{medians[reference] / medians[name]:.1f} vs {reference}", file=sys.stderr)
+
+    def _add(self, name: str, number: int, times: list[float]):
+        median = statistics.median(times)
+        result = {
+            "name": name,
+            "number": number,
+            "rounds": len(times),
+            "min_ns": round(min(times) * 1e9, 1),
+            "median_ns": round(median * 1e9, 1),
+            "mean_ns": round(statistics.fmean(times) * 1e9, 1),
+            "stdev_ns": round(statistics.stdev(times) * 1e9, 1) if len(times) > 1 else 0.0,
+            "ops_per_s": round(1 / median, 1),
+        }
+        self.results.append(result)
+        print(f"{name:40} {result['median_ns'] / 1000:10.2f}us  ±{result['stdev_ns'] / 1000:7.2f}  "
+              f"{result['ops_per_s']:12.0f}/s", file=sys.stderr)
+
+
+def reflective_serialize(cmd: Command) -> str:
+    """serialize() as it was before protocol.Codec, walking model_fields."""
+    text = cmd.name
+    for mod in cmd.flags:
+        text += f" {mod}"
+    for key in cmd.__class__.model_fields:
+        if key in Command.model_fields or key == "name":
+            continue
+        val = getattr(cmd, key)
+        if val is None:
+            continue
+        if type(val) is tuple:
+            val = ','.join(str(x) for x in val)
+        text += f" {key.upper()}={val}"
+    return text
+
+
+def validated_parse(text: str) -> Command | None:
+    """Command.parse() with every line going through pydantic, as before protocol.Codec."""
+    try:
+        return Command.validate_text(text)
+    except ValidationError:
+        return None
+
+
+def bench_protocol(bench: Bench):
+    commands = {
+        "MOT servos": MotionCmd(sv1=135, sv2=45),
+        "MOT throttle": MotionCmd(x=0.75, z=0.75),
+        "STOP": StopCmd(),
+        "STAT": StateCmd.default(),
+    }
+    for label, cmd in commands.items():
+        bench.run(f"serialize/{label}", cmd.serialize)
+        bench.run(f"serialize/{label} (reflection)", lambda cmd=cmd: reflective_serialize(cmd))
+        bench.speedup(f"serialize/{label}", f"serialize/{label} (reflection)")
+
+    lines = cycle(stat_lines())
+    bench.run("deserialize/STAT", lambda: Command.deserialize(next(lines)))
+    bench.run("deserialize/MOT", lambda: Command.deserialize("MOT SV1=135 SV2=45"))
+    parsed = {
+        "STAT": lambda: next(lines),
+        "MOT": lambda: "MOT SV1=135 SV2=45",
+        "console line": lambda: "# req x = 0.0, current x = 0.0",
+    }
+    for label, line in parsed.items():
+        bench.run(f"parse/{label}", lambda line=line: Command.parse(line()))
+        bench.run(f"parse/{label} (pydantic)", lambda line=line: validated_parse(line()))
+        bench.speedup(f"parse/{label}", f"parse/{label} (pydantic)")
+
+    # one poll with the left stick moving: JSON event as sent before, and as a snapshot
+    stick = json.dumps({"type": "analog_stick", "stick": "left", "x": 0.1, "y": -0.42, "seq": 1, "sent_at": 1.7e12})
+    bench.run("input/json stick", lambda: json.loads(stick))
+    differ = SnapshotDiffer()
+    frames = cycle(
+        encode_snapshot(GamepadSnapshot(1, 1.7e12, (0.1, y, 0.0, 0.0), 0, (0.0,) * 17))
+        for y in (-0.42, -0.43)
+    )
+    bench.run("input/snapshot stick", lambda: differ.diff(decode_snapshot(next(frames))))
+
+
+def bench_simulator(bench: Bench):
+    from simulator import Simulator
+
+    for n in SIM_VEHICLES:
+        sim = Simulator(seed=0)
+        sim._grow(n)
+        sim.active[:] = True
+        for slot in range(n):
+            sim.reset(slot)
+            sim.motion(slot, MotionCmd(x=0.8, z=0.6, sv1=120, sv2=60, fu=1))
+        slots = sim.active.nonzero()[0]
+        bench.run(f"sim/step x{n}", sim.step)
+        bench.run(f"sim/states x{n}", lambda: sim.states(slots))
+
+
+async def bench_dispatch(bench: Bench):
+    # main.py mounts static/ and templates/ relative to the working directory
+    os.chdir(Path(__file__).resolve().parent.parent)
+    from main import log_gamepad_data, plumbing
+
+    events = {
+        "button_press": {"type": "button_press", "button_name": "Y", "button_index": 3, "value": 1.0},
+        "button_release": {"type": "button_release", "button_name": "Y", "button_index": 3, "value": 0.0},
+        "analog_stick": {"type": "analog_stick", "stick": "left", "x": 0.1, "y": -0.42},
+        "analog_trigger": {"type": "analog_trigger", "trigger": "right", "value": 0.66},
+        "gamepad_state": {"type": "gamepad_state", "gamepad": {}},
+    }
+    for label, event in events.items():
+        await bench.run_async(f"dispatch/{label}", lambda event=event: log_gamepad_data(plumbing, event))
+
+
+async def bench_fanout(bench: Bench):
+    from plumbing import Plumbing
+
+    states = cycle([Command.parse(line) for line in stat_lines()])
+    console = ConsoleLog(line="ERR Range")
+    for n in FANOUT_CLIENTS:
+        plumbing = Plumbing()
+        sockets = [FakeWebSocket(port) for port in range(n)]
+        for ws in sockets:
+            plumbing.ws_connect(ws)
+
+        async def stat():
+            await plumbing.handle_circuitpy_msg(next(states))
+            # let every client's sender hand its frame to the socket
+            await sleep(0)
+
+        async def console_line():
+            await plumbing.handle_circuitpy_msg(console)
+            await sleep(0)
+
+        await bench.run_async(f"fanout/STAT x{n}", stat)
+        await bench.run_async(f"fanout/console x{n}", console_line)
+        for ws in sockets:
+            plumbing.ws_disconnect(ws)
+
+
+def metadata() -> dict:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent
+        ).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results: list[dict], baseline_path: str, threshold: float) -> list[str]:
+    """Print each benchmark against the baseline, returning the names that got slower."""
+    with open(baseline_path) as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        if (before := baseline.get(result["name"])) is None:
+            continue
+        change = result["median_ns"] / before["median_ns"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(result["name"])
+            flag = "  REGRESSION"
+        print(f"{result['name']:40} {before['median_ns'] / 1000:10.2f}us -> {result['median_ns'] / 1000:10.2f}us "
+              f"{change:+7.1%}{flag}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the protocol and plumbing hot paths.")
+    parser.add_argument("only", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON, - for stdout")
+    parser.add_argument("--compare", metavar="PATH", help="JSON from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="slowdown that counts as a regression (default %(default)s)")
+    parser.add_argument("--rounds", type=int, default=ROUNDS)
+    args = parser.parse_args()
+
+    # the handlers log every event, keep that cost in the numbers but off the terminal
+    devnull = open(os.devnull, "w")
+    for handler in setup_logging().handlers:
+        handler.setStream(devnull)
+
+    bench = Bench(rounds=args.rounds, only=args.only)
+    bench_protocol(bench)
+    bench_simulator(bench)
+
+    async def run_async():
+        await bench_dispatch(bench)
+        await bench_fanout(bench)
+
+    run(run_async())
+
+    report = {"meta": metadata(), "results": bench.results}
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        regressions = compare(bench.results, args.compare, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+from protocol import Command, StateCmd
+
+# STAT frames between full states in delta mode, one second at the Pico's 20 Hz
+KEYFRAME_INTERVAL = 20
+
+
+class TelemetryEncoder:
+    """JSON for what the Pico sends, encoded once per message and shared by every client.
+
+    In delta mode a StateCmd only carries the fields that differ from the last keyframe,
+    marked with "delta": true. Deltas are relative to the keyframe rather than the frame
+    before, so a client that misses some (they're droppable) is still right on the next.
+    """
+
+    def __init__(self, delta: bool = True, keyframe_interval: int = KEYFRAME_INTERVAL):
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.keyframe: StateCmd | None = None
+        self.keyframe_json: str | None = None
+        self.last_delta_json: str | None = None
+        self.since_keyframe = 0
+
+    def encode(self, msg: Command) -> tuple[str, bool]:
+        """(json, droppable) for msg. Clients skip a delta they already have themselves."""
+        if not isinstance(msg, StateCmd):
+            return msg.model_dump_json(), False
+        if not self.delta:
+            return msg.model_dump_json(), True
+
+        if self.keyframe is None or self.since_keyframe >= self.keyframe_interval:
+            self.keyframe = msg
+            self.keyframe_json = msg.model_dump_json()
+            self.last_delta_json = None
+            self.since_keyframe = 0
+            # not droppable, every delta after it depends on it
+            return self.keyframe_json, False
+
+        self.since_keyframe += 1
+        base = self.keyframe.__dict__
+        changed = {field for field, value in msg.__dict__.items() if base.get(field) != value}
+        changed.add("name")
+        j = '{"delta":true,' + msg.model_dump_json(include=changed)[1:]
+        self.last_delta_json = j
+        return j, True
+
+    def snapshot(self) -> list[str]:
+        """What a client joining mid-stream needs to show the current state."""
+        return [j for j in (self.keyframe_json, self.last_delta_json) if j is not None]
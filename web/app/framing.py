@@ -0,0 +1,201 @@
+from binascii import crc32
+from enum import IntEnum
+import struct
+
+from protocol import Command, MotionCmd, ResetCmd, StateCmd, StopCmd
+
+# Binary serial frames, kept in sync with firmware/code.py. From the Pico:
+#
+#   0xA5 | payload length (u8) | frame type (u8) | payload | crc32(type + payload) (u32 LE)
+#
+# The magic byte never shows up in the ASCII the Pico prints (ERR lines, tracebacks),
+# so text and frames can share the link and a bad CRC just resyncs on the next 0xA5.
+#
+# To the Pico, frames go out as a line. The console treats 0x03 as Ctrl-C and the
+# firmware splits input on newlines, so those bytes are escaped HDLC style:
+#
+#   0xA5 | stuffed(frame type | payload | crc32(type + payload)) | \n
+#
+# A BATCH frame's payload is other frames' type and payload back to back, each
+# payload the fixed size for its type. The Pico applies all of them or none.
+MAGIC = 0xA5
+ESC = 0x7D
+STUFFED = frozenset((0x03, 0x08, 0x0A, 0x0D, ESC))
+HEADER = struct.Struct("<BBB")
+CRC = struct.Struct("<I")
+
+# X Y Z, SV1-SV4, jets bitmask, BAT DEPTH, ACC, GYRO
+STAT_LAYOUT = struct.Struct("<3f4hB2f3f3f")
+# presence mask, jets bitmask, X Z, SV1 SV2
+MOT_LAYOUT = struct.Struct("<HBffhh")
+RESET_LAYOUT = struct.Struct("<B")
+
+JETS = ("fu", "fd", "fl", "fr", "ru", "rd", "rl", "rr")
+MOT_FIELDS = ("x", "z", "sv1", "sv2", *JETS)
+RESET_MODES = ("", "SOFT", "SAFE")
+
+# Largest amount of text kept around waiting for a newline
+MAX_TEXT = 4096
+
+
+class FrameType(IntEnum):
+    STAT = 1
+    MOT = 2
+    STOP = 3
+    RESET = 4
+    BATCH = 5
+
+
+def encode_frame(frame_type: FrameType, payload: bytes = b"") -> bytes:
+    body = bytes((frame_type,)) + payload
+    return bytes((MAGIC, len(payload))) + body + CRC.pack(crc32(body))
+
+
+def encode_line(frame_type: FrameType, payload: bytes = b"") -> bytes:
+    body = bytes((frame_type,)) + payload
+    out = bytearray((MAGIC,))
+    for byte in body + CRC.pack(crc32(body)):
+        if byte in STUFFED:
+            out += bytes((ESC, byte ^ 0x20))
+        else:
+            out.append(byte)
+    out.append(0x0A)
+    return bytes(out)
+
+
+def encode_cmd(cmd: Command) -> bytes | None:
+    """Frame line for a command, None if it only exists in the text protocol."""
+    if (frame := cmd_frame(cmd)) is None:
+        return None
+    return encode_line(*frame)
+
+
+def encode_batch(cmds: list[Command]) -> bytes | None:
+    """One BATCH frame line for several commands, None if any only exists as text."""
+    payload = bytearray()
+    for cmd in cmds:
+        if (frame := cmd_frame(cmd)) is None:
+            return None
+        payload.append(frame[0])
+        payload += frame[1]
+    return encode_line(FrameType.BATCH, bytes(payload))
+
+
+def cmd_frame(cmd: Command) -> tuple[FrameType, bytes] | None:
+    """Frame type and payload, None for what only the text protocol can carry."""
+    if isinstance(cmd, MotionCmd):
+        mask = 0
+        jets = 0
+        for bit, field in enumerate(MOT_FIELDS):
+            if getattr(cmd, field) is not None:
+                mask |= 1 << bit
+        for bit, field in enumerate(JETS):
+            value = getattr(cmd, field)
+            if value not in (None, 0, 1):
+                # as text, so the Pico rejects it with the same range error
+                return None
+            if value:
+                jets |= 1 << bit
+        try:
+            payload = MOT_LAYOUT.pack(mask, jets, cmd.x or 0.0, cmd.z or 0.0, cmd.sv1 or 0, cmd.sv2 or 0)
+        except (struct.error, OverflowError):
+            # more than f32 or i16 holds, text gets the Pico's range error for it too
+            return None
+        return FrameType.MOT, payload
+    if isinstance(cmd, StopCmd):
+        return FrameType.STOP, b""
+    if isinstance(cmd, ResetCmd):
+        mode = cmd.flags[0] if cmd.flags else ""
+        if mode not in RESET_MODES:
+            return None
+        return FrameType.RESET, RESET_LAYOUT.pack(RESET_MODES.index(mode))
+    return None
+
+
+def _f32(value: float) -> float:
+    # shortest decimal that round-trips through float32, like the Pico would print it
+    return float(f"{value:.7g}")
+
+
+def decode_stat(payload: bytes) -> StateCmd:
+    x, _y, z, sv1, _sv2, _sv3, _sv4, jets, *floats = STAT_LAYOUT.unpack(payload)
+    bat, depth, ax, ay, az, gx, gy, gz = map(_f32, floats)
+    x, z = _f32(x), _f32(z)
+    return StateCmd._codec.build({
+        "x": x,
+        "z": z,
+        "sv1": sv1,
+        "fu": jets & 1,
+        "rd": (jets >> 5) & 1,
+        "acc": (ax, ay, az),
+        "gyro": (gx, gy, gz),
+        "depth": depth,
+        "bat": bat,
+    }, [])
+
+
+_DECODERS = {
+    FrameType.STAT: (STAT_LAYOUT.size, decode_stat),
+}
+
+
+class FrameReader:
+    """Splits a serial byte stream into text lines and decoded frames."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.bad_frames = 0
+        self.bad_text = 0
+
+    def feed(self, data: bytes) -> list[str | Command]:
+        buf = self.buffer
+        buf += data
+        out = []
+        pos = 0
+        while True:
+            magic = buf.find(MAGIC, pos)
+            text_end = magic if magic >= 0 else len(buf)
+            newline = buf.rfind(b"\n", pos, text_end)
+            if newline >= 0:
+                self._text(buf[pos:newline], out)
+                pos = newline + 1
+            if magic < 0:
+                if len(buf) - pos > MAX_TEXT:
+                    self._text(buf[pos:], out)
+                    pos = len(buf)
+                break
+            if pos < magic:
+                # text without a newline in front of a frame
+                self._text(buf[pos:magic], out)
+                pos = magic
+
+            if len(buf) < magic + HEADER.size:
+                break
+            _, length, frame_type = HEADER.unpack_from(buf, magic)
+            end = magic + HEADER.size + length + CRC.size
+            if len(buf) < end:
+                break
+            body = buf[magic + 2:end - CRC.size]
+            decoder = _DECODERS.get(frame_type)
+            if decoder is None or decoder[0] != length or CRC.unpack_from(buf, end - CRC.size)[0] != crc32(body):
+                self.bad_frames += 1
+                # drop the rest of a mangled frame, but not text that followed a stray 0xA5
+                resync = buf.find(MAGIC, magic + 1)
+                if resync < 0:
+                    resync = len(buf)
+                pos = magic + 1 if buf[magic + 1:resync].isascii() else resync
+                continue
+            out.append(decoder[1](bytes(body[1:])))
+            pos = end
+        del buf[:pos]
+        return out
+
+    def _text(self, data: bytes, out: list):
+        for line in data.split(b"\n"):
+            try:
+                text = line.decode("utf-8").strip()
+            except UnicodeDecodeError:
+                self.bad_text += 1
+                text = line.decode("utf-8", errors="replace").strip()
+            if text:
+                out.append(text)
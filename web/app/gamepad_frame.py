@@ -0,0 +1,112 @@
+import struct
+from typing import NamedTuple
+
+# Binary gamepad snapshots, kept in sync with static/js/gamepad.js. One per poll
+# that changed anything, as a binary WebSocket message:
+#
+#   version (u8) | axis count (u8) | button count (u8) | pad | seq (u32) | sent_at (f64, epoch ms)
+#   | axes (i16 each, -32767..32767) | pressed buttons bitmask (u32) | button values (u8 each, 0..255)
+#
+# All little endian. The server keeps the last snapshot per connection and turns
+# what changed into the same button/stick/trigger messages the JSON path carries.
+VERSION = 1
+HEADER = struct.Struct("<BBBxId")
+MASK = struct.Struct("<I")
+AXIS_SCALE = 32767
+VALUE_SCALE = 255
+MAX_BUTTONS = 32
+
+# (axis count, button count) -> Struct for everything after the header
+_bodies: dict[tuple[int, int], struct.Struct] = {}
+
+# Same as the page: stick and trigger values closer to 0 than this count as 0
+DEADZONE = 0.1
+
+# Standard gamepad mapping: stick -> (x axis, y axis), trigger -> button
+STICKS = {"left": (0, 1), "right": (2, 3)}
+TRIGGERS = {"left": 6, "right": 7}
+BUTTON_NAMES = (
+    "A", "B", "X", "Y", "Left Bumper", "Right Bumper", "Left Trigger", "Right Trigger",
+    "Back / Select", "Start", "Left Stick", "Right Stick",
+    "D-Pad Up", "D-Pad Down", "D-Pad Left", "D-Pad Right", "Home / Xbox",
+)
+
+
+class GamepadSnapshot(NamedTuple):
+    seq: int
+    sent_at: float
+    axes: tuple[float, ...]
+    pressed: int
+    values: tuple[float, ...]
+
+
+def encode_snapshot(snapshot: GamepadSnapshot) -> bytes:
+    axes = [round(max(-1.0, min(1.0, a)) * AXIS_SCALE) for a in snapshot.axes]
+    values = [round(max(0.0, min(1.0, v)) * VALUE_SCALE) for v in snapshot.values]
+    return (
+        HEADER.pack(VERSION, len(axes), len(values), snapshot.seq, snapshot.sent_at)
+        + struct.pack(f"<{len(axes)}h", *axes)
+        + MASK.pack(snapshot.pressed)
+        + bytes(values)
+    )
+
+
+def decode_snapshot(data: bytes) -> GamepadSnapshot | None:
+    """None for anything that isn't a whole snapshot of a version this understands."""
+    if len(data) < HEADER.size:
+        return None
+    version, n_axes, n_buttons, seq, sent_at = HEADER.unpack_from(data)
+    if version != VERSION or n_buttons > MAX_BUTTONS:
+        return None
+    if (body := _bodies.get((n_axes, n_buttons))) is None:
+        body = _bodies[n_axes, n_buttons] = struct.Struct(f"<{n_axes}hI{n_buttons}B")
+    if len(data) != HEADER.size + body.size:
+        return None
+    fields = body.unpack_from(data, HEADER.size)
+    axes = tuple(a / AXIS_SCALE for a in fields[:n_axes])
+    values = tuple(v / VALUE_SCALE for v in fields[n_axes + 1:])
+    return GamepadSnapshot(seq, sent_at, axes, fields[n_axes], values)
+
+
+class SnapshotDiffer:
+    """Turns one connection's snapshots into the messages for what changed since the last one."""
+
+    def __init__(self):
+        self.pressed = 0
+        self.sticks = {stick: (0.0, 0.0) for stick in STICKS}
+        self.triggers = {trigger: 0.0 for trigger in TRIGGERS}
+
+    def diff(self, snapshot: GamepadSnapshot) -> list[dict]:
+        events = []
+        axes, values = snapshot.axes, snapshot.values
+
+        changed = (snapshot.pressed ^ self.pressed) & ((1 << len(values)) - 1)
+        while changed:
+            index = (changed & -changed).bit_length() - 1
+            changed &= changed - 1
+            events.append({
+                "type": "button_press" if snapshot.pressed >> index & 1 else "button_release",
+                "button_index": index,
+                "button_name": BUTTON_NAMES[index] if index < len(BUTTON_NAMES) else f"Button {index}",
+                "value": values[index],
+            })
+        self.pressed = snapshot.pressed
+
+        for stick, (ix, iy) in STICKS.items():
+            if iy >= len(axes):
+                continue
+            x, y = axes[ix], axes[iy]
+            if abs(x) < DEADZONE and abs(y) < DEADZONE:
+                x = y = 0.0
+            if (x, y) != self.sticks[stick]:
+                self.sticks[stick] = (x, y)
+                events.append({"type": "analog_stick", "stick": stick, "x": x, "y": y})
+
+        for trigger, index in TRIGGERS.items():
+            if index >= len(values):
+                continue
+            value = values[index] if values[index] >= DEADZONE else 0.0
+            if value != self.triggers[trigger]:
+                self.triggers[trigger] = value
+                events.append({"type": "analog_trigger", "trigger": trigger, "value": value})
+        return events
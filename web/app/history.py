@@ -0,0 +1,173 @@
+import logging
+from os import environ
+from pathlib import Path
+import time
+
+import numpy as np
+
+from protocol import StateCmd
+from recorder import FIELDS, KINDS, clock_offset, list_segments, load_segment
+
+logger = logging.getLogger(__name__)
+
+# STATs kept in memory per vehicle, 1 << 16 is about 55 minutes at 20 Hz and 4 MB
+HISTORY_RECORDS = int(environ.get("PUBMARINE_HISTORY_RECORDS", 1 << 16))
+# Most points /history returns per field
+MAX_POINTS = 10_000
+METHODS = ("lttb", "minmax")
+# Recorded rows this close before the buffer's oldest are taken to be that one again,
+# the two clocks are read a few microseconds apart
+SEAM = 0.01
+
+# (column, StateCmd attribute, tuple index), named like the recording columns
+STATE_FIELDS = FIELDS[StateCmd]
+FIELD_NAMES = tuple(name for name, _, _ in STATE_FIELDS)
+
+
+def lttb(t: np.ndarray, v: np.ndarray, points: int) -> np.ndarray:
+    """Indices of the points Largest-Triangle-Three-Buckets keeps, first and last included.
+
+    Bucket averages are worked out for all buckets at once; only picking each
+    bucket's point depends on the one picked before it.
+    """
+    n = len(t)
+    if points >= n:
+        return np.arange(n)
+    if points < 3:
+        return np.array([0, n - 1][:points])
+    # everything between the first and last point, in points - 2 buckets of about equal size
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    sums_t = np.concatenate(([0.0], np.cumsum(t)))
+    sums_v = np.concatenate(([0.0], np.cumsum(v)))
+    counts = ends - starts
+    # the third corner of each bucket's triangles: the next bucket's average, the last point for the last
+    next_t = np.append((sums_t[ends] - sums_t[starts])[1:] / counts[1:], t[-1])
+    next_v = np.append((sums_v[ends] - sums_v[starts])[1:] / counts[1:], v[-1])
+
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        at, av = t[a], v[a]
+        area = np.abs((at - next_t[i]) * (v[start:end] - av) - (at - t[start:end]) * (next_v[i] - av))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(t: np.ndarray, v: np.ndarray, points: int) -> np.ndarray:
+    """Indices of the lowest and highest value in each of points / 2 - 1 equal-size buckets, and the ends."""
+    n = len(v)
+    if points >= n:
+        return np.arange(n)
+    if points < 4:
+        # not enough for a bucket's low and high besides the ends
+        return np.array([0, n - 1][:points])
+    buckets = points // 2 - 1
+    size = -(-n // buckets)
+    # pad the last bucket with the last value, whose index it then stands in for
+    grid = np.pad(v, (0, buckets * size - n), mode="edge").reshape(buckets, size)
+    base = np.arange(buckets) * size
+    picked = np.concatenate(([0, n - 1], base + grid.argmin(axis=1), base + grid.argmax(axis=1)))
+    return np.unique(np.minimum(picked, n - 1))
+
+
+DOWNSAMPLERS = {"lttb": lttb, "minmax": minmax}
+
+
+class TelemetryHistory:
+    """A vehicle's recent STATs by wall-clock time, in a ring buffer of NumPy columns.
+
+    Anything older comes from the recordings in directory, when there is one.
+    """
+
+    def __init__(self, directory: Path | str | None = None, capacity: int = HISTORY_RECORDS):
+        self.directory = Path(directory) if directory else None
+        self.capacity = capacity
+        self.t = np.zeros(capacity)
+        self.columns = {name: np.full(capacity, np.nan, dtype=np.float32) for name in FIELD_NAMES}
+        self.count = 0
+
+    def record(self, msg: StateCmd):
+        i = self.count % self.capacity
+        self.t[i] = time.time()
+        values = msg.__dict__
+        columns = self.columns
+        for name, attr, index in STATE_FIELDS:
+            value = values[attr]
+            if value is None:
+                columns[name][i] = np.nan
+            else:
+                columns[name][i] = value if index is None else value[index]
+        self.count += 1
+
+    def recent(self, fields: list[str], start: float, end: float) -> tuple[np.ndarray, dict[str, np.ndarray], float]:
+        """Copies of the buffered rows from start to end, oldest first, and when the buffer begins.
+
+        record() may run in between, so call this on the event loop.
+        """
+        t = self.t
+        columns = {name: self.columns[name] for name in fields}
+        if self.count > self.capacity:
+            split = self.count % self.capacity
+            oldest = float(t[split])
+            t = np.concatenate((t[split:], t[:split]))
+            columns = {name: np.concatenate((column[split:], column[:split])) for name, column in columns.items()}
+        else:
+            oldest = float(t[0]) if self.count else end
+            t = t[:self.count]
+            columns = {name: column[:self.count] for name, column in columns.items()}
+        rows = (t >= start) & (t <= end)
+        return t[rows], {name: column[rows] for name, column in columns.items()}, oldest
+
+    def _recorded(self, fields: list[str], start: float, end: float) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        times = []
+        values = {name: [] for name in fields}
+        for path in list_segments(self.directory):
+            try:
+                columns = load_segment(path)
+            except (OSError, ValueError) as e:
+                logger.warning("Skipping recording %s: %s", path, e)
+                continue
+            t = columns["t"]
+            if not len(t):
+                continue
+            offset = clock_offset(path, columns)
+            if t[-1] + offset < start or t[0] + offset >= end:
+                continue
+            t = t + offset
+            rows = (columns["kind"] == KINDS[StateCmd]) & (t >= start) & (t < end)
+            times.append(t[rows])
+            for name in fields:
+                values[name].append(columns[name][rows])
+        if not times:
+            return np.zeros(0), {name: np.zeros(0, dtype=np.float32) for name in fields}
+        return np.concatenate(times), {name: np.concatenate(parts) for name, parts in values.items()}
+
+    def query(self, fields: list[str], start: float, end: float, points: int, method: str = "lttb",
+              recent: tuple | None = None) -> dict:
+        """Each field's samples from start to end, epoch seconds, downsampled to at most points.
+
+        With recent() taken on the event loop beforehand, this is safe to run on a thread.
+        """
+        t, values, oldest = recent if recent is not None else self.recent(fields, start, end)
+        if self.directory is not None and start < oldest:
+            # older than anything in memory, the recordings have the newer rows too but those are left out
+            old_t, old_values = self._recorded(fields, start, min(oldest - SEAM, end))
+            t = np.concatenate((old_t, t))
+            values = {name: np.concatenate((old_values[name], values[name])) for name in fields}
+
+        downsample = DOWNSAMPLERS[method]
+        out = {}
+        for name in fields:
+            column = values[name]
+            present = ~np.isnan(column)
+            field_t, field_v = t[present], column[present].astype(np.float64)
+            keep = downsample(field_t, field_v, points)
+            out[name] = {
+                "t": field_t[keep].round(3).tolist(),
+                "v": field_v[keep].round(6).tolist(),
+                "samples": int(len(field_t)),
+            }
+        return out
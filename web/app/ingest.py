@@ -0,0 +1,115 @@
+from asyncio import Event, create_task
+from collections import deque
+import logging
+from typing import Any, Awaitable, Callable
+
+from metrics import InputStamp, metrics
+
+logger = logging.getLogger(__name__)
+
+# Messages waiting per connection before the WebSocket stops being read
+INGEST_QUEUE = 256
+
+# Messages only the newest of which matters, keyed by what they describe
+ANALOG_KEYS = {
+    "analog_stick": "stick",
+    "analog_trigger": "trigger",
+    "gamepad_state": None,
+}
+
+Handler = Callable[[dict, InputStamp | None], Awaitable[Any]]
+
+
+class _Entry:
+    __slots__ = ("key", "data", "stamp")
+
+    def __init__(self, key, data: dict, stamp: InputStamp | None):
+        self.key = key
+        self.data = data
+        self.stamp = stamp
+
+
+def merge_key(data: dict):
+    """What an analog message supersedes, None for messages that must all be handled."""
+    event_type = data.get("type")
+    if event_type not in ANALOG_KEYS:
+        return None
+    field = ANALOG_KEYS[event_type]
+    return (event_type, data.get(field)) if field else (event_type,)
+
+
+class GamepadIngest:
+    """One connection's input, handled in arrival order by a single consumer task.
+
+    When the consumer falls behind, a newer stick or trigger value replaces the queued
+    one for the same control, and moves to the back so it still lands after any button
+    sent before it. Buttons and console commands are never dropped; once INGEST_QUEUE
+    of them are waiting, put() blocks, which stops reading the socket.
+    """
+
+    def __init__(self, handler: Handler, limit: int = INGEST_QUEUE):
+        self.handler = handler
+        self.limit = limit
+        self.queue: deque[_Entry] = deque()
+        self.pending: dict[Any, _Entry] = {}
+        self.ready = Event()
+        self.space = Event()
+        self.closed = False
+        self.handled = 0
+        self.merged = 0
+        self.waits = 0
+        self.max_depth = 0
+        self.task = create_task(self.consume())
+
+    async def put(self, data: dict, stamp: InputStamp | None = None):
+        key = merge_key(data)
+        if key is not None and (old := self.pending.pop(key, None)) is not None:
+            self.queue.remove(old)
+            self.merged += 1
+            metrics.gamepad_merged += 1
+            metrics.gamepad_queued -= 1
+        while len(self.queue) >= self.limit:
+            self.waits += 1
+            metrics.gamepad_waits += 1
+            self.space.clear()
+            await self.space.wait()
+
+        entry = _Entry(key, data, stamp)
+        self.queue.append(entry)
+        metrics.gamepad_queued += 1
+        if key is not None:
+            self.pending[key] = entry
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.ready.set()
+
+    async def consume(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                entry = self.queue.popleft()
+                metrics.gamepad_queued -= 1
+                if entry.key is not None:
+                    del self.pending[entry.key]
+                self.space.set()
+                try:
+                    await self.handler(entry.data, entry.stamp)
+                except Exception:
+                    logger.exception("Error handling websocket message")
+                self.handled += 1
+            if self.closed:
+                return
+
+    def close(self):
+        """Stop once what's queued is handled, a STOP pressed just before leaving still goes out."""
+        self.closed = True
+        self.ready.set()
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.queue),
+            "max_depth": self.max_depth,
+            "handled": self.handled,
+            "merged": self.merged,
+            "waits": self.waits,
+        }
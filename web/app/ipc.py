@@ -0,0 +1,356 @@
+from asyncio import (
+    Event,
+    Future,
+    StreamReader,
+    StreamWriter,
+    create_task,
+    get_running_loop,
+    open_unix_connection,
+    run,
+    sleep,
+    start_unix_server,
+    wait_for,
+)
+import json
+import logging
+import os
+import re
+import signal
+import stat
+
+from gpio import cleanup_gpio, initialize_gpio
+from history import TelemetryHistory
+from logs import setup_logging
+from metrics import InputStamp, current_input, metrics
+from plumbing import Plumbing, vehicles_from_env
+from protocol import Command, ConsoleLog, StateCmd
+
+logger = logging.getLogger(__name__)
+
+# Newline separated JSON over a Unix socket between the serial owner and the web workers.
+# To the workers, each message from a Pico:
+#
+#   {"v": vehicle, "t": "STAT X=0.5 ..."}                     wire commands, as serialized
+#   {"v": vehicle, "log": level, "line": text}                console output
+#
+# To the owner, a Plumbing control call and the gamepad message that caused it:
+#
+#   {"v": vehicle, "op": "stick_moved", "args": ["left", 0.0, 0.5], "stamp": [seq, received]}
+#   {"op": "metrics", "id": n}  ->  {"reply": n, "text": "..."}
+#
+# received is time.monotonic() in the worker, the same clock in every process on the box.
+# In the user's own runtime directory, or a 0700 one made in /tmp, the socket itself is 0600
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or f"/tmp/pubmarine-{os.getuid()}", "pubmarine.sock")
+# Plumbing methods a worker may call
+OPS = frozenset(("button_pressed", "button_released", "stick_moved", "trigger_moved", "console_cmd"))
+# Bytes waiting for a worker beyond which its STATs are skipped, console lines never are
+WORKER_BUFFER_LIMIT = 64 * 1024
+RECONNECT_INTERVAL = 0.5
+# Seconds a worker waits for the owner's metrics before leaving them out
+METRICS_TIMEOUT = 2.0
+
+_SAMPLE = re.compile(r"([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (.*)")
+
+
+def encode_message(vehicle: str, msg: Command) -> bytes:
+    if isinstance(msg, ConsoleLog):
+        obj = {"v": vehicle, "log": msg.level, "line": msg.line}
+    else:
+        obj = {"v": vehicle, "t": msg.serialize()}
+    return json.dumps(obj).encode() + b"\n"
+
+
+def decode_message(obj: dict) -> Command | None:
+    if "line" in obj:
+        return ConsoleLog(level=obj.get("log", "INFO"), line=obj["line"])
+    return Command.parse(obj.get("t", ""))
+
+
+def with_label(text: str, name: str, value: str) -> str:
+    """Prometheus text with name="value" added to every sample."""
+    lines = []
+    for line in text.splitlines():
+        if (match := _SAMPLE.fullmatch(line)) and not line.startswith("#"):
+            metric, labels, sample = match.groups()
+            labels = f'{{{name}="{value}",{labels[1:]}' if labels else f'{{{name}="{value}"}}'
+            line = f"{metric}{labels} {sample}"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def merge_expositions(*texts: str) -> str:
+    """Several processes' Prometheus text as one, each family's HELP and TYPE once."""
+    families: dict[str, list[str]] = {}
+    current = None
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                current = line.split(" ", 3)[2]
+                family = families.setdefault(current, [])
+                if line not in family:
+                    family.append(line)
+            elif line and current is not None:
+                families[current].append(line)
+    return "\n".join(line for family in families.values() for line in family) + "\n"
+
+
+class OwnerPlumbing(Plumbing):
+    """A vehicle in the serial owner process, passing what its Pico says on to the workers."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner: "SerialOwner | None" = None
+
+    async def handle_circuitpy_msg(self, msg: Command):
+        await super().handle_circuitpy_msg(msg)
+        if self.owner is not None:
+            self.owner.broadcast(self.name, msg)
+
+
+class SerialOwner:
+    """The one process with the serial ports open, serving any number of web workers."""
+
+    def __init__(self, vehicles: dict[str, OwnerPlumbing], path: str = DEFAULT_SOCKET):
+        self.vehicles = vehicles
+        self.path = path
+        self.workers: set[StreamWriter] = set()
+        self.server = None
+        self.skipped = 0
+        for vehicle in vehicles.values():
+            vehicle.owner = self
+
+    async def start(self):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # makedirs keeps whatever was there, in /tmp that could be someone else's
+        info = os.stat(directory)
+        if info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0o700:
+            raise RuntimeError(f"{directory} must be owned by this user and mode 0700")
+        if os.path.exists(self.path):
+            try:
+                _, writer = await open_unix_connection(self.path)
+            except OSError:
+                # left behind by an owner that didn't close
+                os.unlink(self.path)
+            else:
+                writer.close()
+                raise RuntimeError(f"Another serial owner is listening on {self.path}")
+        # only this user's workers may connect
+        umask = os.umask(0o177)
+        try:
+            self.server = await start_unix_server(self.serve, self.path)
+        finally:
+            os.umask(umask)
+        logger.info("Serial owner listening on %s for %s", self.path, ", ".join(self.vehicles))
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        for writer in list(self.workers):
+            writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def broadcast(self, vehicle: str, msg: Command):
+        if not self.workers:
+            return
+        data = encode_message(vehicle, msg)
+        for writer in list(self.workers):
+            if writer.is_closing():
+                self.workers.discard(writer)
+            elif isinstance(msg, StateCmd) and writer.transport.get_write_buffer_size() > WORKER_BUFFER_LIMIT:
+                # a worker this far behind gets the next STAT instead
+                self.skipped += 1
+            else:
+                writer.write(data)
+
+    async def serve(self, reader: StreamReader, writer: StreamWriter):
+        self.workers.add(writer)
+        logger.info("Web worker connected. Total: %d", len(self.workers))
+        try:
+            while line := await reader.readline():
+                try:
+                    await self.handle(json.loads(line), writer)
+                except Exception:
+                    logger.exception("Error handling worker request %r", line)
+        except ConnectionError:
+            pass
+        finally:
+            self.workers.discard(writer)
+            writer.close()
+            logger.info("Web worker disconnected. Total: %d", len(self.workers))
+
+    async def handle(self, request: dict, writer: StreamWriter):
+        op = request.get("op")
+        if op == "metrics":
+            reply = {"reply": request.get("id"), "text": metrics.render()}
+            writer.write(json.dumps(reply).encode() + b"\n")
+            return
+        vehicle = self.vehicles.get(request.get("v"))
+        if vehicle is None or op not in OPS:
+            logger.warning("Ignoring worker request %r", request)
+            return
+        stamp = request.get("stamp")
+        # serially per worker, so calls keep the order the worker made them in
+        current_input.set(InputStamp(*stamp) if stamp else None)
+        await getattr(vehicle, op)(*request.get("args", ()))
+
+
+class OwnerLink:
+    """A web worker's connection to the serial owner, shared by all its vehicles."""
+
+    def __init__(self, path: str = DEFAULT_SOCKET):
+        self.path = path
+        self.vehicles: dict[str, "RemoteSerial"] = {}
+        self.writer: StreamWriter | None = None
+        self.task = None
+        self.requests: dict[int, Future] = {}
+        self.next_id = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = create_task(self.run())
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    async def run(self):
+        warned = False
+        while True:
+            try:
+                reader, self.writer = await open_unix_connection(self.path)
+            except OSError as e:
+                if not warned:
+                    logger.warning("Serial owner not reachable at %s, retrying: %s", self.path, e)
+                    warned = True
+                await sleep(RECONNECT_INTERVAL)
+                continue
+            warned = False
+            logger.info("Connected to serial owner at %s", self.path)
+            try:
+                while line := await reader.readline():
+                    await self.received(json.loads(line))
+            except ConnectionError:
+                pass
+            except Exception:
+                logger.exception("Error reading from serial owner")
+            self.writer = None
+            for future in self.requests.values():
+                future.set_result(None)
+            self.requests.clear()
+            logger.warning("Lost the serial owner, reconnecting")
+            await sleep(RECONNECT_INTERVAL)
+
+    async def received(self, obj: dict):
+        if "reply" in obj:
+            if (future := self.requests.pop(obj["reply"], None)) is not None:
+                future.set_result(obj.get("text"))
+            return
+        serial = self.vehicles.get(obj.get("v"))
+        if serial is None or serial.callback is None:
+            return
+        if (msg := decode_message(obj)) is not None:
+            await serial.callback(msg)
+
+    async def send(self, obj: dict):
+        if self.writer is None:
+            logger.warning("No serial owner, dropping %s", obj.get("op"), extra={"rate_limit": "owner_send"})
+            return
+        self.writer.write(json.dumps(obj).encode() + b"\n")
+        await self.writer.drain()
+
+    async def metrics(self) -> str | None:
+        """The owner's metrics.render(), None if it isn't there or doesn't answer in time."""
+        if self.writer is None:
+            return None
+        self.next_id += 1
+        request = self.next_id
+        future = self.requests[request] = get_running_loop().create_future()
+        try:
+            await self.send({"op": "metrics", "id": request})
+            return await wait_for(future, METRICS_TIMEOUT)
+        except TimeoutError:
+            logger.warning("Serial owner didn't send its metrics within %ss", METRICS_TIMEOUT)
+            return None
+        finally:
+            self.requests.pop(request, None)
+
+
+class RemoteSerial:
+    """Stands in for a vehicle's serial client in a worker, its messages come from the owner."""
+
+    def __init__(self, link: OwnerLink, vehicle: str):
+        self.link = link
+        self.vehicle = vehicle
+        self.callback = None
+        link.vehicles[vehicle] = self
+
+    async def connect(self):
+        self.link.start()
+
+    def disconnect(self):
+        self.link.close()
+
+    async def call(self, op: str, *args):
+        stamp = current_input.get()
+        await self.link.send({"v": self.vehicle, "op": op, "args": args, "stamp": stamp})
+
+
+class RemotePlumbing(Plumbing):
+    """A vehicle in a web worker: browsers connect here, the owner process does the driving."""
+
+    def __init__(self, name: str, link: OwnerLink, record_dir: str | None = None):
+        super().__init__(name, RemoteSerial(link, name), gpio_reset=False)
+        # the owner writes the recordings, history only reads them
+        self.history = TelemetryHistory(record_dir)
+
+    async def init(self):
+        await self.serial.connect()
+
+    async def shutdown(self):
+        self.serial.disconnect()
+
+    async def button_pressed(self, index, value):
+        await self.serial.call("button_pressed", index, value)
+
+    async def button_released(self, index, value):
+        await self.serial.call("button_released", index, value)
+
+    async def stick_moved(self, stick: str, x: float, y: float):
+        await self.serial.call("stick_moved", stick, x, y)
+
+    async def trigger_moved(self, trigger: str, value: float):
+        await self.serial.call("trigger_moved", trigger, value)
+
+    async def console_cmd(self, text: str):
+        await self.serial.call("console_cmd", text)
+
+
+async def run_owner(path: str):
+    """Open every vehicle's serial port and serve the web workers until SIGINT or SIGTERM."""
+    vehicles = vehicles_from_env(OwnerPlumbing)
+    owner = SerialOwner(vehicles, path)
+    initialize_gpio()
+    for vehicle in vehicles.values():
+        await vehicle.init()
+    await owner.start()
+
+    stop = Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        get_running_loop().add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    await owner.close()
+    for vehicle in vehicles.values():
+        await vehicle.shutdown()
+    cleanup_gpio()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    run(run_owner(os.environ.get("PUBMARINE_IPC_SOCKET", DEFAULT_SOCKET)))
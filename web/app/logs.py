@@ -0,0 +1,78 @@
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from os import environ
+from queue import SimpleQueue
+from time import monotonic
+
+# Seconds between records of a category, passed as extra={"rate_limit": category}
+RATE_LIMITS = {
+    "stick": 1.0,
+    "trigger": 1.0,
+    "serial_tx": 1.0,
+    "owner_send": 5.0,
+    "recorder": 5.0,
+}
+DEFAULT_LEVEL = "INFO"
+FORMAT = "%(asctime)s %(levelname)s:%(name)s:%(message)s"
+
+_listener: QueueListener | None = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets one record per category through each interval, noting how many were held back."""
+
+    def __init__(self, limits: dict[str, float] = RATE_LIMITS):
+        super().__init__()
+        self.limits = limits
+        # category -> (time last let through, records dropped since)
+        self.state: dict[str, tuple[float, int]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, "rate_limit", None)
+        if category is None or (interval := self.limits.get(category)) is None:
+            return True
+        now = monotonic()
+        last, dropped = self.state.get(category, (0.0, 0))
+        if now - last < interval:
+            self.state[category] = (last, dropped + 1)
+            return False
+        self.state[category] = (now, 0)
+        if dropped:
+            record.msg = f"{record.msg} (+{dropped} more in {now - last:.1f}s)"
+        return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Hands records over unformatted, the listener thread does the % formatting and the I/O.
+
+    Only safe with log arguments nobody changes afterwards, which is all this app passes.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(level: str | None = None) -> QueueListener:
+    """Send all logging through a queue to a writer thread, at PUBMARINE_LOG_LEVEL or INFO."""
+    global _listener
+    if _listener is not None:
+        return _listener
+    level = (level or environ.get("PUBMARINE_LOG_LEVEL") or DEFAULT_LEVEL).upper()
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(FORMAT))
+    queue = SimpleQueue()
+    handler = DeferredQueueHandler(queue)
+    handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(queue, output, respect_handler_level=True)
+    _listener.start()
+    # flush whatever is still queued when the server exits
+    atexit.register(_listener.stop)
+    return _listener
@@ -1,5 +1,6 @@
-from asyncio import TaskGroup
+from asyncio import to_thread
 from contextlib import asynccontextmanager
+from functools import partial
 from fastapi import (
     FastAPI,
     HTTPException,
@@ -8,39 +9,81 @@ from fastapi import (
     WebSocket,
     WebSocketDisconnect,
 )
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
 import json
 import logging
+from os import environ, getpid
+import time
 
 import httpx
 
-from plumbing import Plumbing
+from assets import StaticAssets
+from gamepad_frame import SnapshotDiffer, decode_snapshot
+from history import FIELD_NAMES, MAX_POINTS, METHODS
+from ingest import GamepadIngest
+from ipc import DEFAULT_SOCKET, OwnerLink, RemotePlumbing, merge_expositions, with_label
+from logs import setup_logging
+from metrics import InputStamp, current_input, metrics
+from plumbing import Plumbing, record_dir_for, vehicle_specs, vehicles_from_env
 from gpio import cleanup_gpio, initialize_gpio
 
-plumbing = Plumbing()
+# Number of uvicorn worker processes, above 1 the serial ports go to a separate owner (ipc.py)
+WORKERS = int(environ.get("PUBMARINE_WORKERS", 1))
+
+# Whether this is the parent of several workers that starts the owner itself, it must not
+# open the ports either
+START_OWNER = __name__ == "__main__" and WORKERS > 1 and not environ.get("PUBMARINE_IPC_SOCKET")
+if START_OWNER:
+    environ["PUBMARINE_IPC_SOCKET"] = DEFAULT_SOCKET
+
+# Set when the serial ports belong to a separate owner process (ipc.py) and this is one of
+# several web workers talking to it, or their parent
+IPC_SOCKET = environ.get("PUBMARINE_IPC_SOCKET")
+owner_link = OwnerLink(IPC_SOCKET) if IPC_SOCKET else None
+
+# name -> vehicle, from PUBMARINE_VEHICLES. The first is served at the unscoped routes
+if owner_link:
+    vehicles = {
+        name: RemotePlumbing(name, owner_link, record_dir_for(name, spec)) for name, spec in vehicle_specs().items()
+    }
+else:
+    vehicles = vehicles_from_env()
+plumbing = next(iter(vehicles.values()))
 
 
 @asynccontextmanager
-async def plumbing_lifespan(_app: FastAPI):
-    await plumbing.init()
-    initialize_gpio()
+async def plumbing_lifespan(app: FastAPI):
+    for vehicle in vehicles.values():
+        await vehicle.init()
+    if not owner_link:
+        initialize_gpio()
+    # one pooled client for the /cam proxy, keeps connections to mediamtx alive
+    app.state.cam_client = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60.0),
+    )
     yield
-    await plumbing.shutdown()
-    cleanup_gpio()
+    await app.state.cam_client.aclose()
+    for vehicle in vehicles.values():
+        await vehicle.shutdown()
+    if not owner_link:
+        cleanup_gpio()
 
 
 app = FastAPI(lifespan=plumbing_lifespan, title="Pubmarine Submarine", version="0.1.0")
 
-# Mount static files
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Static files, from memory with hashed URLs and compressed variants
+assets = StaticAssets("static")
+app.mount("/static", assets, name="static")
 
 # Templates
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["static_url"] = assets.url
 
-# Set up logging for gamepad data
-logging.basicConfig(level=logging.DEBUG)
+# Written out by a background thread, level from PUBMARINE_LOG_LEVEL
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 @app.get("/", response_class=HTMLResponse)
@@ -56,34 +99,125 @@ async def gamepad_page(request: Request):
     return RedirectResponse(url="/")
 
 
+@app.get("/clients")
+async def clients():
+    """Queue counters for each connected WebSocket client, by vehicle."""
+    return {name: vehicle.client_stats() for name, vehicle in vehicles.items()}
+
+
+@app.get("/vehicles")
+async def vehicle_list():
+    """Vehicle names, the first one is what /ws/gamepad talks to."""
+    return list(vehicles)
+
+
+@app.get("/history")
+async def history(
+    fields: str = "depth,bat",
+    vehicle: str | None = None,
+    start: float | None = None,
+    end: float | None = None,
+    last: float = 600,
+    points: int = 1000,
+    method: str = "lttb",
+):
+    """Telemetry between start and end (epoch seconds, or the last seconds), downsampled to points per field."""
+    target = vehicles.get(vehicle) if vehicle else plumbing
+    if target is None:
+        raise HTTPException(status_code=404, detail=f"No vehicle {vehicle}")
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    if not names or not set(names) <= set(FIELD_NAMES):
+        raise HTTPException(status_code=400, detail=f"fields are some of {', '.join(FIELD_NAMES)}")
+    if method not in METHODS:
+        raise HTTPException(status_code=400, detail=f"method is one of {', '.join(METHODS)}")
+    if not 2 <= points <= MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"points is 2 to {MAX_POINTS}")
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - last
+    if start > end:
+        raise HTTPException(status_code=400, detail="start is after end")
+    # copied on the event loop, recordings and downsampling on a thread
+    recent = target.history.recent(names, start, end)
+    series = await to_thread(target.history.query, names, start, end, points, method, recent)
+    return {"vehicle": target.name, "start": start, "end": end, "method": method, "fields": series}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_page():
+    """Latency histograms and serial counters in the Prometheus text format."""
+    text = metrics.render()
+    if owner_link:
+        # serial and control metrics are the owner's, WebSocket input ones this worker's
+        text = merge_expositions(
+            with_label(await owner_link.metrics() or "", "process", "serial"),
+            with_label(text, "process", f"web-{getpid()}"),
+        )
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+
 @app.websocket("/ws/gamepad")
 async def websocket_endpoint(websocket: WebSocket):
+    await gamepad_session(websocket, plumbing)
+
+
+@app.websocket("/ws/{vehicle}/gamepad")
+async def vehicle_websocket_endpoint(websocket: WebSocket, vehicle: str):
+    if vehicle not in vehicles:
+        await websocket.close(code=1008, reason=f"No vehicle {vehicle}")
+        return
+    await gamepad_session(websocket, vehicles[vehicle])
+
+
+async def gamepad_session(websocket: WebSocket, plumbing: Plumbing):
     await websocket.accept()
-    plumbing.ws_connect(websocket)
+    client = plumbing.ws_connect(websocket)
+    # handled one at a time in the order sent, so a release can't overtake its press
+    ingest = client.ingest = GamepadIngest(partial(handle_gamepad_data, plumbing))
+    differ = SnapshotDiffer()
+    last_seq = None
 
     try:
-        async with TaskGroup() as tg:
-            while True:
-                # Receive gamepad data from client
-                data = await websocket.receive_text()
-                gamepad_data = json.loads(data)
-
-                tg.create_task(handle_gamepad_data(gamepad_data))
+        while True:
+            # Receive gamepad data from client
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                # a binary gamepad snapshot, what changed since the last one becomes messages
+                if (snapshot := decode_snapshot(message["bytes"])) is None:
+                    logger.warning("Ignoring bad gamepad snapshot of %d bytes", len(message["bytes"]))
+                    continue
+                stamp = metrics.input_received(snapshot._asdict(), last_seq)
+                last_seq = stamp.seq
+                for gamepad_data in differ.diff(snapshot):
+                    await ingest.put(gamepad_data, stamp)
+                continue
+
+            gamepad_data = json.loads(message["text"])
+            stamp = metrics.input_received(gamepad_data, last_seq)
+            last_seq = stamp.seq if stamp.seq is not None else last_seq
+
+            if gamepad_data.get("type") == "subscribe":
+                # which Pico messages this client wants, and how often
+                plumbing.ws_subscribe(websocket, gamepad_data.get("max_rate"), gamepad_data.get("messages"))
+                continue
+
+            await ingest.put(gamepad_data, stamp)
 
     except WebSocketDisconnect:
-        plumbing.ws_disconnect(websocket)
+        pass
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
-        plumbing.ws_disconnect(websocket)
+    ingest.close()
+    plumbing.ws_disconnect(websocket)
 
 
-async def handle_gamepad_data(data: dict):
-    try:
-        await log_gamepad_data(data)
-    except Exception:
-        logger.exception("Error handling websocket message")
+async def handle_gamepad_data(plumbing: Plumbing, data: dict, stamp: InputStamp | None = None):
+    # the connection's consumer task handles one message at a time, so this tags only its writes
+    current_input.set(stamp)
+    await log_gamepad_data(plumbing, data)
 
-async def log_gamepad_data(data: dict):
+async def log_gamepad_data(plumbing: Plumbing, data: dict):
     """Log gamepad data in a readable format."""
     event_type = data.get("type", "unknown")
 
@@ -92,31 +226,31 @@ async def log_gamepad_data(data: dict):
         value = data["value"]
         button_index = data["button_index"]
         await plumbing.button_pressed(button_index, value)
-        logger.info(f"🎮 BUTTON: {button_name} pressed (value: {value:.3f})")
+        logger.info("🎮 BUTTON: %s pressed (value: %.3f)", button_name, value)
 
     elif event_type == "button_release":
         button_name = data.get("button_name", "Unknown")
         value = data["value"]
         button_index = data["button_index"]
         await plumbing.button_released(button_index, value)
-        logger.info(f"🎮 BUTTON: {button_name} released (value: {value:.3f})")
+        logger.info("🎮 BUTTON: %s released (value: %.3f)", button_name, value)
 
     elif event_type == "analog_stick":
         stick = data.get("stick", "unknown")
         x = data.get("x", 0)
         y = data.get("y", 0)
         await plumbing.stick_moved(stick, x, y)
-        logger.info(f"🕹️  STICK: {stick} moved to X:{x:.3f}, Y:{y:.3f}")
+        logger.info("🕹️  STICK: %s moved to X:%.3f, Y:%.3f", stick, x, y, extra={"rate_limit": "stick"})
 
     elif event_type == "analog_trigger":
         trigger = data.get("trigger", "unknown")
         value = data.get("value", 0)
         await plumbing.trigger_moved(trigger, value)
-        logger.info(f"🕹️  TRIGGER: {trigger} moved to:{value:.3f}")
+        logger.info("🕹️  TRIGGER: %s moved to:%.3f", trigger, value, extra={"rate_limit": "trigger"})
 
     elif event_type == "gamepad_connected":
         gamepad_id = data.get("gamepad_id", "Unknown")
-        logger.info(f"🔌 GAMEPAD CONNECTED: {gamepad_id}")
+        logger.info("🔌 GAMEPAD CONNECTED: %s", gamepad_id)
 
     elif event_type == "gamepad_disconnected":
         logger.info("🔌 GAMEPAD DISCONNECTED")
@@ -131,50 +265,48 @@ async def log_gamepad_data(data: dict):
 
 WEBRTC_SERVER_URL = "http://localhost:8889"
 
+# Headers that only apply to a single connection and must not be forwarded (RFC 9110 7.6.1)
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
 
-@app.api_route("/cam", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
-async def proxy_cam(request: Request):
-    """
-    Proxy all requests to the WebRTC server at /cam endpoint
+
+def forward_headers(headers: list[tuple[str, str]], drop: frozenset[str] = frozenset()) -> list[tuple[str, str]]:
+    """Copy header pairs minus hop-by-hop ones, including any the Connection header names.
+
+    Pairs rather than a dict, so repeated ones like Set-Cookie all get through.
     """
+    drop = HOP_BY_HOP_HEADERS | drop | {
+        name.strip().lower()
+        for key, value in headers if key.lower() == "connection"
+        for name in value.split(",") if name.strip()
+    }
+    return [(name, value) for name, value in headers if name.lower() not in drop]
+
+
+async def proxy_to_webrtc(request: Request, path: str) -> Response:
+    client: httpx.AsyncClient = request.app.state.cam_client
+    headers = forward_headers(request.headers.items(), frozenset({"host"}))
+
+    # stream the body through, but don't turn a bodyless GET into a chunked one
+    has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+    upstream_request = client.build_request(
+        method=request.method,
+        url=f"{WEBRTC_SERVER_URL}/{path}",
+        headers=headers,
+        content=request.stream() if has_body else None,
+        params=request.query_params,
+    )
     try:
-        # Construct the target URL
-        target_url = f"{WEBRTC_SERVER_URL}/cam"
-
-        # Get request body if it exists
-        body = await request.body()
-
-        # Prepare headers (exclude host header to avoid conflicts)
-        headers = dict(request.headers)
-        if "host" in headers:
-            del headers["host"]
-
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Forward the request to the WebRTC server
-            response = await client.request(
-                method=request.method,
-                url=target_url,
-                headers=headers,
-                content=body,
-                params=request.query_params,
-            )
-
-            # For streaming responses (like video streams)
-            if "stream" in response.headers.get("content-type", "").lower():
-                return StreamingResponse(
-                    response.aiter_bytes(),
-                    media_type=response.headers.get("content-type"),
-                    headers=dict(response.headers),
-                )
-
-            # For regular responses
-            return Response(
-                content=response.content,
-                status_code=response.status_code,
-                headers=dict(response.headers),
-                media_type=response.headers.get("content-type"),
-            )
-
+        response = await client.send(upstream_request, stream=True)
     except httpx.ConnectError:
         raise HTTPException(
             status_code=502, detail="WebRTC server is not available at localhost:8889"
@@ -186,6 +318,24 @@ async def proxy_cam(request: Request):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Proxy error: {str(e)}")
 
+    # raw bytes, so content-encoding and content-length stay valid as forwarded
+    proxied = StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        background=BackgroundTask(response.aclose),
+    )
+    for name, value in forward_headers(response.headers.multi_items()):
+        proxied.headers.append(name, value)
+    return proxied
+
+
+@app.api_route("/cam", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
+async def proxy_cam(request: Request):
+    """
+    Proxy all requests to the WebRTC server at /cam endpoint
+    """
+    return await proxy_to_webrtc(request, "cam")
+
 
 @app.api_route(
     "/cam/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"]
@@ -194,73 +344,38 @@ async def proxy_cam_subpaths(path: str, request: Request):
     """
     Proxy requests to WebRTC server subpaths (e.g., /cam/stream, /cam/config)
     """
-    try:
-        # Construct the target URL with the subpath
-        target_url = f"{WEBRTC_SERVER_URL}/cam/{path}"
-
-        # Get request body if it exists
-        body = await request.body()
-
-        # Prepare headers (exclude host header to avoid conflicts)
-        headers = dict(request.headers)
-        if "host" in headers:
-            del headers["host"]
-
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Forward the request to the WebRTC server
-            response = await client.request(
-                method=request.method,
-                url=target_url,
-                headers=headers,
-                content=body,
-                params=request.query_params,
-            )
-
-            # For streaming responses
-            if "stream" in response.headers.get("content-type", "").lower():
-                return StreamingResponse(
-                    response.aiter_bytes(),
-                    media_type=response.headers.get("content-type"),
-                    headers=dict(response.headers),
-                )
-
-            # For regular responses
-            return Response(
-                content=response.content,
-                status_code=response.status_code,
-                headers=dict(response.headers),
-                media_type=response.headers.get("content-type"),
-            )
-
-    except httpx.ConnectError:
-        raise HTTPException(
-            status_code=502, detail="WebRTC server is not available at localhost:8889"
-        )
-    except httpx.TimeoutException:
-        raise HTTPException(
-            status_code=504, detail="Request to WebRTC server timed out"
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Proxy error: {str(e)}")
+    return await proxy_to_webrtc(request, f"cam/{path}")
 
 
 if __name__ == "__main__":
+    import subprocess
+    import sys
     import uvicorn
     from pathlib import Path
 
     cert_file = Path("certs/cert.pem")
     key_file = Path("certs/key.pem")
+    # uvicorn's own loggers go through the same queue as ours
+    options = {"host": "0.0.0.0", "port": 8000, "log_config": None}
 
     if cert_file.exists() and key_file.exists():
         print("Access at: https://localhost:8000")
         print("You may need to accept the self-signed certificate warning.")
-        uvicorn.run(
-            app,
-            host="0.0.0.0",
-            port=8000,
-            ssl_keyfile=str(key_file),
-            ssl_certfile=str(cert_file),
-        )
+        options.update(ssl_keyfile=str(key_file), ssl_certfile=str(cert_file))
     else:
         print("Access at: http://localhost:8000")
-        uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    if WORKERS <= 1:
+        uvicorn.run(app, **options)
+        sys.exit()
+
+    # only one process may have the serial ports, the workers import main afresh and talk to it
+    owner = None
+    if START_OWNER:
+        owner = subprocess.Popen([sys.executable, str(Path(__file__).with_name("ipc.py"))])
+    try:
+        uvicorn.run("main:app", app_dir=str(Path(__file__).parent), workers=WORKERS, **options)
+    finally:
+        if owner:
+            owner.terminate()
+            owner.wait()
@@ -0,0 +1,259 @@
+from bisect import bisect_left
+from collections import deque
+from contextvars import ContextVar
+from time import monotonic, time
+from typing import NamedTuple
+
+from protocol import MOTOR_MIN, SERVO_MAX, SERVO_MIN, StateCmd
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Observations the quantiles are worked out from
+QUANTILE_WINDOW = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+# Seconds of history behind the *_per_second gauges
+RATE_WINDOW = 10
+
+# STAT fields a MotionCmd setpoint shows up in, and how close counts as reached
+REFLECTED_FIELDS = {"x": 0.01, "z": 0.01, "sv1": 1, "fu": 0, "rd": 0}
+# Give up on a setpoint the Pico never reports reaching after this long
+MATCH_TIMEOUT = 5.0
+
+
+def reported(field: str, value: float) -> float:
+    """What a STAT shows once the firmware has applied a setpoint."""
+    if field == "sv1":
+        return min(max(value, SERVO_MIN), SERVO_MAX)
+    if field in ("x", "z") and abs(value) < MOTOR_MIN:
+        return 0.0
+    return value
+
+# client_to_server: browser send to WebSocket receive, includes clock skew between the two
+# receive_to_serial: WebSocket receive to the command it caused written to the serial port
+# serial_to_stat: serial write to the first STAT showing the new setpoint
+# receive_to_stat: WebSocket receive to that same STAT
+STAGES = ("client_to_server", "receive_to_serial", "serial_to_stat", "receive_to_stat")
+
+
+class InputStamp(NamedTuple):
+    """Where a gamepad message came in, carried along to the serial write it causes."""
+    seq: int | None
+    received: float
+
+
+# Set by main.py for the gamepad message being handled
+current_input: ContextVar[InputStamp | None] = ContextVar("current_input", default=None)
+
+
+class Histogram:
+    """Prometheus style cumulative buckets, plus recent samples for quantiles."""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: deque[float] = deque(maxlen=QUANTILE_WINDOW)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self) -> dict[float, float]:
+        if not self.recent:
+            return {}
+        ordered = sorted(self.recent)
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+
+class RateCounter:
+    """A running total that also knows how fast it went up over the last few seconds."""
+
+    def __init__(self):
+        self.total = 0
+        # (time, total) about once a second
+        self.history: deque[tuple[float, int]] = deque(maxlen=RATE_WINDOW + 1)
+
+    def add(self, n: int = 1):
+        self.total += n
+        now = monotonic()
+        if not self.history or now - self.history[-1][0] >= 1.0:
+            self.history.append((now, self.total))
+
+    def rate(self) -> float:
+        if not self.history:
+            return 0.0
+        then, total = self.history[0]
+        elapsed = monotonic() - then
+        return (self.total - total) / elapsed if elapsed > 0 else 0.0
+
+
+class SerialMetrics:
+    """One vehicle's serial link: traffic, parse errors and write latency."""
+
+    def __init__(self):
+        self.rx_bytes = RateCounter()
+        self.rx_lines = RateCounter()
+        self.tx_bytes = RateCounter()
+        self.tx_lines = RateCounter()
+        # several to a line when batched
+        self.tx_commands = RateCounter()
+        self.parse_errors = {"text": 0, "frame": 0, "encoding": 0}
+        self.stale_skipped = 0
+        # queued to written, by serial_client.Priority
+        self.write_latency = {"safety": Histogram(), "normal": Histogram()}
+        self.overridden = 0
+
+
+class Metrics:
+    def __init__(self):
+        self.latency = {stage: Histogram() for stage in STAGES}
+        # vehicle -> field -> (target value, received, written) for setpoints not yet seen in a STAT
+        self.expected: dict[str, dict[str, tuple[float, float, float]]] = {}
+        self.unmatched = 0
+        self.gamepad_messages = 0
+        self.gamepad_missed = 0
+        # kept up to date by ingest.GamepadIngest across all connections
+        self.gamepad_queued = 0
+        self.gamepad_merged = 0
+        self.gamepad_waits = 0
+        # vehicle -> its serial link's counters
+        self.serial: dict[str, SerialMetrics] = {}
+
+    def serial_for(self, vehicle: str) -> SerialMetrics:
+        if (serial := self.serial.get(vehicle)) is None:
+            serial = self.serial[vehicle] = SerialMetrics()
+        return serial
+
+    def input_received(self, data: dict, last_seq: int | None) -> InputStamp:
+        """Stamp a gamepad message as it comes off the WebSocket."""
+        received = monotonic()
+        self.gamepad_messages += 1
+        seq = data.get("seq")
+        if not isinstance(seq, int):
+            seq = None
+        elif last_seq is not None and seq > last_seq + 1:
+            self.gamepad_missed += seq - last_seq - 1
+        sent_at = data.get("sent_at")
+        if isinstance(sent_at, int | float) and (transit := time() - sent_at / 1000) >= 0:
+            self.latency["client_to_server"].observe(transit)
+        return InputStamp(seq, received)
+
+    def sent(self, stamp: InputStamp | None, written: float | None):
+        # None for a write that never went out (port closed, overridden by a STOP)
+        if stamp is not None and written is not None and written >= stamp.received:
+            self.latency["receive_to_serial"].observe(written - stamp.received)
+
+    def expect(self, field: str, value: float, stamp: InputStamp | None, written: float | None,
+               vehicle: str = ""):
+        """Wait for a STAT from the same vehicle to show a setpoint that was just written."""
+        if stamp is None or written is None or field not in REFLECTED_FIELDS or written < stamp.received:
+            return
+        expected = self.expected.setdefault(vehicle, {})
+        if field in expected:
+            # superseded before the Pico got there
+            self.unmatched += 1
+        expected[field] = (reported(field, value), stamp.received, written)
+
+    def state(self, msg: StateCmd, vehicle: str = ""):
+        if not (expected := self.expected.get(vehicle)):
+            return
+        now = monotonic()
+        values = msg.__dict__
+        for field, (target, received, written) in list(expected.items()):
+            value = values.get(field)
+            if value is not None and abs(value - target) <= REFLECTED_FIELDS[field]:
+                self.latency["serial_to_stat"].observe(now - written)
+                self.latency["receive_to_stat"].observe(now - received)
+                del expected[field]
+            elif now - written > MATCH_TIMEOUT:
+                self.unmatched += 1
+                del expected[field]
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format."""
+        lines = []
+
+        def family(name: str, kind: str, help: str):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        # extra is more labels to put first, like 'vehicle="sub",'
+        def histograms(name: str, label: str, by_label: dict[str, Histogram], extra: str = ""):
+            for value, histogram in by_label.items():
+                cumulative = 0
+                for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{extra}{label}="{value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{extra}{label}="{value}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{{extra}{label}="{value}"}} {histogram.count}')
+
+        def quantiles(name: str, label: str, by_label: dict[str, Histogram], extra: str = ""):
+            for value, histogram in by_label.items():
+                for q, observed in histogram.quantiles().items():
+                    lines.append(f'{name}{{{extra}{label}="{value}",quantile="{q}"}} {observed}')
+
+        # vehicle="..." label per serial link
+        links = [(f'vehicle="{vehicle}"', serial) for vehicle, serial in self.serial.items()]
+
+        family("pubmarine_latency_seconds", "histogram", "Control latency by stage")
+        histograms("pubmarine_latency_seconds", "stage", self.latency)
+        family("pubmarine_latency_quantile_seconds", "gauge",
+               f"Control latency quantiles over the last {QUANTILE_WINDOW} observations of each stage")
+        quantiles("pubmarine_latency_quantile_seconds", "stage", self.latency)
+        family("pubmarine_latency_unmatched_total", "counter",
+               "Setpoints written that no STAT was seen reaching before being replaced or timing out")
+        lines.append(f"pubmarine_latency_unmatched_total {self.unmatched}")
+
+        family("pubmarine_serial_write_latency_seconds", "histogram",
+               "Serial writes from queued to handed to the port, by priority")
+        for vehicle, serial in links:
+            histograms("pubmarine_serial_write_latency_seconds", "priority", serial.write_latency, vehicle + ",")
+        family("pubmarine_serial_write_latency_quantile_seconds", "gauge",
+               f"Serial write latency quantiles over the last {QUANTILE_WINDOW} writes of each priority")
+        for vehicle, serial in links:
+            quantiles("pubmarine_serial_write_latency_quantile_seconds", "priority", serial.write_latency,
+                      vehicle + ",")
+        family("pubmarine_serial_overridden_total", "counter",
+               "Queued setpoints dropped because a STOP or RESET went out first")
+        for vehicle, serial in links:
+            lines.append(f"pubmarine_serial_overridden_total{{{vehicle}}} {serial.overridden}")
+
+        family("pubmarine_gamepad_messages_total", "counter", "Messages received on gamepad WebSockets")
+        lines.append(f"pubmarine_gamepad_messages_total {self.gamepad_messages}")
+        family("pubmarine_gamepad_missed_total", "counter", "Gaps in gamepad message sequence numbers")
+        lines.append(f"pubmarine_gamepad_missed_total {self.gamepad_missed}")
+        family("pubmarine_gamepad_queued", "gauge", "Gamepad messages waiting to be handled, all connections")
+        lines.append(f"pubmarine_gamepad_queued {self.gamepad_queued}")
+        family("pubmarine_gamepad_merged_total", "counter",
+               "Queued stick and trigger messages replaced by a newer one before being handled")
+        lines.append(f"pubmarine_gamepad_merged_total {self.gamepad_merged}")
+        family("pubmarine_gamepad_waits_total", "counter",
+               "Times a connection's queue was full and reading from it paused")
+        lines.append(f"pubmarine_gamepad_waits_total {self.gamepad_waits}")
+
+        for direction, unit in (("rx", "bytes"), ("rx", "lines"), ("tx", "bytes"), ("tx", "lines"), ("tx", "commands")):
+            what = f"Serial {unit} {'received' if direction == 'rx' else 'sent'}"
+            counters = [(vehicle, getattr(serial, f"{direction}_{unit}")) for vehicle, serial in links]
+            family(f"pubmarine_serial_{direction}_{unit}_total", "counter", what)
+            for vehicle, counter in counters:
+                lines.append(f"pubmarine_serial_{direction}_{unit}_total{{{vehicle}}} {counter.total}")
+            family(f"pubmarine_serial_{direction}_{unit}_per_second", "gauge", f"{what} per second, last {RATE_WINDOW}s")
+            for vehicle, counter in counters:
+                lines.append(f"pubmarine_serial_{direction}_{unit}_per_second{{{vehicle}}} {counter.rate():.3f}")
+
+        family("pubmarine_serial_parse_errors_total", "counter",
+               "Serial input that looked like a message but didn't parse")
+        for vehicle, serial in links:
+            for kind, count in serial.parse_errors.items():
+                lines.append(f'pubmarine_serial_parse_errors_total{{{vehicle},kind="{kind}"}} {count}')
+        family("pubmarine_serial_stale_skipped_total", "counter",
+               "STATs dropped unparsed because a newer one was read at the same time")
+        for vehicle, serial in links:
+            lines.append(f"pubmarine_serial_stale_skipped_total{{{vehicle}}} {serial.stale_skipped}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
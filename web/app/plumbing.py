@@ -1,54 +1,246 @@
+from asyncio import create_task, sleep
 import logging
+import math
+from time import monotonic
 from fastapi import WebSocket
-from protocol import Command, ResetCmd, StopCmd, MotionCmd, ConsoleLog
-from serial_client import DebugSerialClient, SerialClient
+from broadcast import TelemetryEncoder
+from metrics import InputStamp, current_input, metrics
+from protocol import Command, ResetCmd, StopCmd, MotionCmd, ConsoleLog, StateCmd
+from history import TelemetryHistory
+from recorder import TelemetryRecorder
+from serial_client import DebugSerialClient, ReplaySerialClient, SerialClient
+from shared_state import VEHICLE_NAME, StatePublisher
+from ws_client import WebSocketClient
 from gpio import reset_pico
 from os import environ
+from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# How often merged motion setpoints are flushed to the Pico, matches its CONTROL_MS by default
+MOTION_RATE_HZ = float(environ.get("PUBMARINE_MOTION_HZ", 50))
+
+# Whether the latest STAT is published to shared memory for other local processes
+SHARED_STATE = environ.get("PUBMARINE_SHARED_STATE", "1") != "0"
+
+# The one vehicle when PUBMARINE_VEHICLES isn't set
+DEFAULT_VEHICLE = "sub"
+
+
+def axis(value: float) -> float:
+    """A stick or trigger reading held to -1..1, 0 for one that isn't a number."""
+    return min(1.0, max(-1.0, value)) if math.isfinite(value) else 0.0
+
+
+def serial_from_env():
+    """The serial client picked by PUBMARINE_REPLAY / PUBMARINE_DEBUG_SERIAL, else the Pico."""
+    if replay := environ.get("PUBMARINE_REPLAY"):
+        return serial_from_spec(f"replay:{replay}")
+    if environ.get("PUBMARINE_DEBUG_SERIAL"):
+        return serial_from_spec("debug")
+    return serial_from_spec("/dev/ttyACM0")
+
+
+def serial_from_spec(spec: str):
+    """A device path, "debug" for the fake Pico or "replay:<recording>"."""
+    telemetry_rate = environ.get("PUBMARINE_TELEMETRY_HZ")
+    telemetry_rate = int(telemetry_rate) if telemetry_rate else None
+    if spec == "debug":
+        return DebugSerialClient(telemetry_rate=telemetry_rate)
+    if spec.startswith("replay:"):
+        return ReplaySerialClient(spec.removeprefix("replay:"), speed=float(environ.get("PUBMARINE_REPLAY_SPEED", 1)))
+    return SerialClient(spec, binary=bool(environ.get("PUBMARINE_SERIAL_BINARY")), telemetry_rate=telemetry_rate)
+
+
+def vehicle_specs() -> dict[str, str | None]:
+    """Vehicle name -> serial spec from PUBMARINE_VEHICLES="sub=/dev/ttyACM0,bench=debug".
+
+    Without it there's one vehicle, None standing for the serial the other settings pick.
+    """
+    if not (spec := environ.get("PUBMARINE_VEHICLES")):
+        return {DEFAULT_VEHICLE: None}
+    specs = {}
+    for entry in spec.split(","):
+        name, _, serial = entry.strip().partition("=")
+        if not VEHICLE_NAME.fullmatch(name) or not serial or name in specs:
+            raise ValueError(f"Bad PUBMARINE_VEHICLES entry: {entry!r}")
+        specs[name] = serial
+    return specs
+
+
+def record_dir_for(name: str, spec: str | None) -> str | None:
+    """Where a vehicle's recordings go: PUBMARINE_RECORD_DIR, per vehicle when there are several."""
+    record_dir = environ.get("PUBMARINE_RECORD_DIR")
+    return str(Path(record_dir) / name) if record_dir and spec else record_dir
+
+
+def vehicles_from_env(cls: type["Plumbing"] | None = None) -> dict[str, "Plumbing"]:
+    """Every vehicle in vehicle_specs(), the first of which is the default one.
+
+    That's also the only one the Pi's GPIO reset line is wired to.
+    """
+    cls = cls or Plumbing
+    specs = vehicle_specs()
+    vehicles = {}
+    for name, spec in specs.items():
+        vehicles[name] = cls(
+            name,
+            serial_from_spec(spec) if spec else serial_from_env(),
+            record_dir_for(name, spec),
+            gpio_reset=not vehicles,
+        )
+    return vehicles
+
+
 class Plumbing:
-    def __init__(self):
-        self.connections: list[WebSocket] = []
-        #self.serial = DebugSerialClient()
-        if environ.get("PUBMARINE_DEBUG_SERIAL"):
-            self.serial = DebugSerialClient()
-        else:
-            self.serial = SerialClient("/dev/ttyACM0")
+    """One vehicle: its serial link, the browsers connected to it and its telemetry."""
+
+    def __init__(self, name: str = DEFAULT_VEHICLE, serial=None, record_dir: str | None = None,
+                 gpio_reset: bool = True):
+        self.name = name
+        self.gpio_reset = gpio_reset
+        self.clients: dict[WebSocket, WebSocketClient] = {}
+        self.encoder = TelemetryEncoder(delta=environ.get("PUBMARINE_TELEMETRY_DELTA", "1") != "0")
+        # Latest requested value per MotionCmd field, flushed by motion_writer()
+        self.motion_pending: dict[str, float | int] = {}
+        # What the Pico was last told, so unchanged setpoints aren't resent
+        self.motion_sent: dict[str, float | int] = {}
+        # The gamepad message behind each pending setpoint, for latency metrics
+        self.motion_stamps: dict[str, InputStamp] = {}
+        self.motion_task = None
+        self.recorder = TelemetryRecorder(record_dir) if record_dir else None
+        self.history = TelemetryHistory(record_dir)
+        self.shared_state = None
+        self.serial = serial if serial is not None else serial_from_env()
         #self.serial = SerialClient("/dev/pts/13", baudrate=9600)
         self.serial.callback = self.handle_circuitpy_msg
+        self.serial.metrics = metrics.serial_for(name)
+        # fresh firmware starts with its actuators off, setpoints sent before never reached it
+        self.serial.on_restart = self.clear_motion
+        # STATs the serial client skips to catch up still go in the recording, which costs
+        # parsing them, so only with a recorder
+        self.serial.on_stale = self.record_state if self.recorder else None
 
     async def init(self):
-        print("connecting serial")
+        if self.recorder:
+            self.recorder.start()
+        if SHARED_STATE:
+            self.shared_state = StatePublisher(self.name)
+        logger.info(f"Connecting serial for {self.name}")
         await self.serial.connect()
+        self.motion_task = create_task(self.motion_writer())
 
     async def shutdown(self):
+        if self.motion_task:
+            self.motion_task.cancel()
         await self.serial.write_cmd(StopCmd())
-        await self.serial.disconnect()
+        self.serial.disconnect()
+        if self.recorder:
+            self.recorder.close()
+        if self.shared_state:
+            self.shared_state.close()
+            self.shared_state = None
 
-    def ws_connect(self, ws: WebSocket):
-        self.connections.append(ws)
-        logger.info(f"Websocket client connected. Total: {len(self.connections)}")
+    def ws_connect(self, ws: WebSocket) -> WebSocketClient:
+        client = WebSocketClient(ws)
+        for j in self.encoder.snapshot():
+            client.send(j)
+        self.clients[ws] = client
+        logger.info(f"Websocket client connected to {self.name}. Total: {len(self.clients)}")
+        return client
 
     def ws_disconnect(self, ws: WebSocket):
-        if ws in self.connections:
-            self.connections.remove(ws)
-        logger.info(f"Gamepad WebSocket disconnected. Total: {len(self.connections)}")
+        stats = {}
+        if client := self.clients.pop(ws, None):
+            client.close()
+            stats = client.stats()
+        logger.info(f"Gamepad WebSocket disconnected from {self.name}. Total: {len(self.clients)} {stats}")
+
+    def ws_subscribe(self, ws: WebSocket, max_rate: float | None, messages: list[str] | None):
+        if client := self.clients.get(ws):
+            client.subscribe(max_rate, messages)
+
+    def client_stats(self) -> list[dict]:
+        return [client.stats() for client in self.clients.values()]
+
+    def record_state(self, msg: StateCmd):
+        if self.recorder:
+            self.recorder.record(msg)
+        self.history.record(msg)
 
     async def handle_circuitpy_msg(self, msg: Command):
-        j = msg.model_dump_json()
-        for ws in self.connections:
-            await ws.send_text(j)
+        if isinstance(msg, StateCmd):
+            self.record_state(msg)
+            metrics.state(msg, self.name)
+            if self.shared_state:
+                self.shared_state.publish(msg)
+        elif self.recorder:
+            self.recorder.record(msg)
+        # encoded once and queued per client, the serial reader never waits on a browser
+        clients = [client for client in self.clients.values() if client.wants(msg.name)]
+        if not clients:
+            return
+        j, droppable = self.encoder.encode(msg)
+        for client in clients:
+            client.publish(msg.name, j, droppable)
+
+    def set_motion(self, **values):
+        self.motion_pending.update(values)
+        if stamp := current_input.get():
+            self.motion_stamps.update(dict.fromkeys(values, stamp))
+
+    def clear_motion(self):
+        """Forget queued setpoints, for when the Pico resets its actuators itself."""
+        self.motion_pending.clear()
+        self.motion_sent.clear()
+        self.motion_stamps.clear()
+
+    async def flush_motion(self):
+        changed = {
+            field: value for field, value in self.motion_pending.items()
+            if self.motion_sent.get(field) != value
+        }
+        self.motion_pending.clear()
+        stamps, self.motion_stamps = self.motion_stamps, {}
+        if not changed:
+            return
+        self.motion_sent.update(changed)
+        written = await self.serial.write_cmd(MotionCmd(**changed))
+        if written is None:
+            # never went out, overridden by a STOP or the port went away
+            for field in changed:
+                self.motion_sent.pop(field, None)
+            return
+        for stamp in {stamps[field] for field in changed if field in stamps}:
+            metrics.sent(stamp, written)
+        for field, value in changed.items():
+            metrics.expect(field, value, stamps.get(field), written, self.name)
+
+    async def motion_writer(self):
+        period = 1.0 / MOTION_RATE_HZ
+        next_tick = monotonic()
+        while True:
+            next_tick += period
+            await sleep(max(0.0, next_tick - monotonic()))
+            if next_tick < monotonic() - period:
+                # fell behind, don't try to catch up with a burst of writes
+                next_tick = monotonic()
+            try:
+                await self.flush_motion()
+            except Exception:
+                logger.exception("Error writing motion setpoint")
 
     async def console_cmd(self, text: str):
         await self.handle_circuitpy_msg(ConsoleLog(level="ECHO", line=text))
-        await self.serial.write_text(f"{text}\r\n")
+        written = await self.serial.write_text(f"{text}\r\n")
+        metrics.sent(current_input.get(), written)
 
     async def stick_moved(self, stick: str, x: float, y: float):
+        x, y = axis(x), axis(y)
         if stick == "left":
             sv1 = int(90 + 45*y)
             sv2 = int(90 - 45*y)
-            await self.serial.write_cmd(MotionCmd(sv1=sv1, sv2=sv2))
+            self.set_motion(sv1=sv1, sv2=sv2)
         elif stick == "right":
             # Used for the debug impl. No idea what this does to the real sub uncomment at your own risk
             pass
@@ -61,23 +253,32 @@ class Plumbing:
             #    await self.serial.write_cmd(MotionCmd(fl=0, rl=0, fr=0, rr=0))
 
     async def trigger_moved(self, trigger: str, value: float):
+        value = axis(value)
         if trigger == "left":
-            await self.serial.write_cmd(MotionCmd(x=-value, z=-value))
+            self.set_motion(x=-value, z=-value)
         elif trigger == "right":
-            await self.serial.write_cmd(MotionCmd(x=value, z=value))
+            self.set_motion(x=value, z=value)
 
     async def button_pressed(self, index, value):
         match index:
             case 0:  # A
-                await self.serial.write_cmd(MotionCmd(sv1=0, sv2=180))
+                self.set_motion(sv1=0, sv2=180)
             case 1:  # B
-                await self.serial.write_cmd(ResetCmd())
+                self.clear_motion()
+                written = await self.serial.write_cmd(ResetCmd())
+                metrics.sent(current_input.get(), written)
             case 2:  # X
-                await self.serial.write_cmd(StopCmd())
+                self.clear_motion()
+                written = await self.serial.write_cmd(StopCmd())
+                metrics.sent(current_input.get(), written)
             case 3:  # Y
-                await self.serial.write_cmd(MotionCmd(sv1=90, sv2=90))
+                self.set_motion(sv1=90, sv2=90)
             case 8: # back / select
-                await reset_pico()
+                self.clear_motion()
+                if self.gpio_reset:
+                    await reset_pico()
+                else:
+                    logger.info("Ignoring reset command - %s has no GPIO reset line", self.name)
 
     async def button_released(self, index, value):
         pass
@@ -1,28 +1,253 @@
-from typing import ClassVar, Literal, Self
-from pydantic import BaseModel, Field
+import re
+from types import NoneType
+from typing import Any, Callable, ClassVar, Literal, NamedTuple, Self, get_args
+from pydantic import BaseModel, Field, ValidationError
+from pydantic_core import PydanticUndefined
 
 
-class Command(BaseModel):
-    name: ClassVar[str]
-    flags: list[str] = []
+# Converters raise ValueError for anything they can't vouch for, the text then goes
+# through pydantic so validation results never depend on which path parsed a line.
+def _to_int(text: str) -> int:
+    whole, dot, frac = text.partition(".")
+    if dot:
+        # pydantic takes "90.0" for an int, the firmware prints servo angles like that
+        if not frac or frac.strip("0") or not whole.lstrip("+-").isdigit():
+            raise ValueError(text)
+    return int(whole)
 
-    def serialize(self) -> str:
-        cmd = self.name
-        for mod in self.flags:
-            cmd += f" {mod}"
-        for key, val in self.__class__.model_fields.items():
-            if key in Command.model_fields.keys() or key == "name":
+
+def _to_str(text: str) -> str:
+    if "," in text:
+        raise ValueError(text)
+    return text
+
+
+def _tuple_converter(size: int, item: Callable[[str], Any]) -> Callable[[str], tuple]:
+    def convert(text: str) -> tuple:
+        values = tuple(map(item, text.split(",")))
+        if len(values) != size:
+            raise ValueError(text)
+        return values
+    return convert
+
+
+class _Field(NamedTuple):
+    convert: Callable[[str], Any]
+    # regex for the value in a compiled layout, one group per number
+    pattern: str
+    # how a layout's builder turns the groups starting at g[{0}] into the value
+    expression: str
+
+
+# ints: what _to_int takes, minus "1_0" and the like, which pydantic gets to judge
+_FIELDS = {
+    float: _Field(float, "([^ ]*)", "float(g[{0}])"),
+    int: _Field(_to_int, r"([+-]?[0-9]+)(?:\.0+)?", "int(g[{0}])"),
+    str: _Field(_to_str, "([^ ,]*)", "g[{0}]"),
+}
+
+
+def _field_for(annotation) -> _Field | None:
+    options = [arg for arg in get_args(annotation) or (annotation,) if arg is not NoneType]
+    if len(options) != 1:
+        return None
+    option = options[0]
+    if option in _FIELDS:
+        return _FIELDS[option]
+    items = get_args(option)
+    if getattr(option, "__origin__", None) is tuple and items and all(i is float for i in items):
+        return _Field(
+            _tuple_converter(len(items), float),
+            ",".join(["([^ ,]*)"] * len(items)),
+            "(" + ", ".join(f"float(g[{{0}} + {i}])" for i in range(len(items))) + ",)",
+        )
+    return None
+
+
+# Key orders remembered per command, the firmware prints the same one every tick
+MAX_LAYOUTS = 8
+
+
+class _Layout(NamedTuple):
+    """One key order, matched against a line as a whole."""
+    # the whole line with that key order, a group per value we keep
+    pattern: re.Pattern
+    # groups -> Command
+    build: Callable[[tuple[str, ...]], "Command"]
+
+
+class Codec:
+    """Text wire format of one Command subclass, worked out once when the class is defined."""
+
+    def __init__(self, cls: type["Command"]):
+        self.cls = cls
+        self.name: str = cls.model_fields["name"].default
+        # (attribute, "KEY=") in declaration order, for serialize()
+        self.encoders: list[tuple[str, str]] = []
+        # wire key as lower or upper case -> (attribute, field)
+        self.decoders: dict[str, tuple[str, _Field]] = {}
+        self.defaults: dict[str, Any] = {}
+        self.required: set[str] = set()
+        # regex source -> layout, oldest first
+        self.layouts: dict[str, _Layout] = {}
+        # hot messages skip pydantic entirely when every value converts cleanly
+        self.fast = cls.fast_decode
+
+        for attr, info in cls.model_fields.items():
+            self.defaults[attr] = None if info.default is PydanticUndefined else info.default
+            if info.is_required():
+                self.required.add(attr)
+            if attr in Command.model_fields or attr == "name":
+                continue
+            self.encoders.append((attr, f"{attr.upper()}="))
+            field = _field_for(info.annotation)
+            if field is None:
+                self.fast = False
                 continue
-            val = getattr(self, key)
+            self.decoders[attr] = self.decoders[attr.upper()] = (attr, field)
+
+    def encode(self, cmd: "Command") -> str:
+        parts = [self.name, *cmd.flags] if cmd.flags else [self.name]
+        values = cmd.__dict__
+        for attr, prefix in self.encoders:
+            val = values[attr]
             if val is None:
                 continue
             if type(val) is tuple:
-                val = ','.join(str(x) for x in val)
-            cmd += f" {key.upper()}={val}"
+                val = ','.join(map(str, val))
+            parts.append(f"{prefix}{val}")
+        return " ".join(parts)
+
+    def decode(self, text: str) -> "Command | None":
+        """Build the command from a stripped line, None if pydantic should have a look."""
+        if not text.isascii():
+            return None
+        try:
+            for layout in self.layouts.values():
+                if (match := layout.pattern.fullmatch(text)) is not None:
+                    return layout.build(match.groups())
+            return self._decode_chunks(text.split(" ")[1:])
+        except ValueError:
+            return None
+
+    def _decode_chunks(self, chunks: list[str]) -> "Command | None":
+        flags = []
+        values = {}
+        # the line as a layout: regex pieces, and (attribute, field) per kept value
+        pieces = [re.escape(self.name)]
+        fields = []
+        decoders = self.decoders
+        for chunk in chunks:
+            arg_name, delim, arg_val = chunk.partition("=")
+            if not delim:
+                flags.append(chunk)
+                continue
+            decoder = decoders.get(arg_name) or decoders.get(arg_name.lower())
+            if decoder is None:
+                if arg_name.lower() in ("name", "flags"):
+                    return None
+                # unknown fields are ignored, same as pydantic does
+                pieces.append(re.escape(arg_name) + "=[^ ]*")
+                continue
+            attr, field = decoder
+            values[attr] = field.convert(arg_val)
+            pieces.append(re.escape(arg_name) + "=" + field.pattern)
+            fields.append((attr, field))
+
+        if self.required and not self.required.issubset(values):
+            return None
+        if not flags and len(fields) == len(values):
+            self._remember(" ".join(pieces), fields)
+        return self.build(values, flags)
+
+    def _remember(self, source: str, fields: list[tuple[str, _Field]]):
+        # a line the layout's regex turns down, "SV1=1_0" say, only gets here again
+        if source in self.layouts:
+            return
+        if len(self.layouts) >= MAX_LAYOUTS:
+            del self.layouts[next(iter(self.layouts))]
+        self.layouts[source] = _Layout(re.compile(source, re.ASCII), self._compile_build(fields))
+
+    def _compile_build(self, fields: list[tuple[str, _Field]]) -> Callable[[tuple[str, ...]], "Command"]:
+        """build() for one layout as straight-line code, taking the layout's regex groups."""
+        expressions = {}
+        group = 0
+        for attr, field in fields:
+            expressions[attr] = field.expression.format(group)
+            group += field.pattern.count("(") - field.pattern.count("(?:")
+        state = ", ".join(
+            f"{attr!r}: {'[]' if attr == 'flags' else expressions.get(attr, f'defaults[{attr!r}]')}"
+            for attr in self.defaults
+        )
+        fields_set = ", ".join(repr(attr) for attr in ("name", "flags", *expressions))
+        source = (
+            "def build(g):\n"
+            "    cmd = new(cls)\n"
+            f"    setattr(cmd, '__dict__', {{{state}}})\n"
+            f"    setattr(cmd, '__pydantic_fields_set__', {{{fields_set}}})\n"
+            "    setattr(cmd, '__pydantic_extra__', None)\n"
+            "    setattr(cmd, '__pydantic_private__', None)\n"
+            "    return cmd\n"
+        )
+        namespace = {"new": object.__new__, "cls": self.cls, "setattr": object.__setattr__,
+                     "defaults": self.defaults}
+        exec(source, namespace)
+        return namespace["build"]
+
+    def build(self, values: dict[str, Any], flags: list[str]) -> "Command":
+        state = dict(self.defaults)
+        state["flags"] = flags
+        state.update(values)
+        fields_set = {"name", "flags"}
+        fields_set.update(values)
+
+        # what BaseModel.model_construct() does, minus its per-call overhead
+        cmd = self.cls.__new__(self.cls)
+        object.__setattr__(cmd, "__dict__", state)
+        object.__setattr__(cmd, "__pydantic_fields_set__", fields_set)
+        object.__setattr__(cmd, "__pydantic_extra__", None)
+        object.__setattr__(cmd, "__pydantic_private__", None)
         return cmd
 
+
+class Command(BaseModel):
+    name: ClassVar[str]
+    flags: list[str] = []
+    fast_decode: ClassVar[bool] = False
+    _codec: ClassVar[Codec]
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs):
+        super().__pydantic_init_subclass__(**kwargs)
+        cls._codec = Codec(cls)
+
+    def serialize(self) -> str:
+        return self._codec.encode(self)
+
+    @classmethod
+    def parse(cls, text: str) -> "Command | None":
+        """Parse a line from the Pico, None if it isn't a command we know."""
+        text = text.strip()
+        codec = _WIRE_CODECS.get(text.partition(" ")[0])
+        if codec is None:
+            return None
+        if codec.fast and (cmd := codec.decode(text)) is not None:
+            return cmd
+        try:
+            return cls.validate_text(text)
+        except ValidationError:
+            return None
+
     @classmethod
     def deserialize(cls, text: str):
+        if (cmd := cls.parse(text)) is not None:
+            return cmd
+        # let pydantic raise the ValidationError callers expect
+        return cls.validate_text(text)
+
+    @classmethod
+    def validate_text(cls, text: str):
+        """Reference parser, every field goes through pydantic validation."""
         text = text.strip()
         chunks = text.split(" ")
 
@@ -55,6 +280,7 @@ class StopCmd(Command):
 
 class MotionCmd(Command):
     name: Literal["MOT"] = "MOT"
+    fast_decode: ClassVar[bool] = True
     x: float | None = None
     z: float | None = None
     sv1: int | None = None
@@ -71,6 +297,7 @@ class MotionCmd(Command):
 
 class StateCmd(Command):
     name: Literal["STAT"] = "STAT"
+    fast_decode: ClassVar[bool] = True
     x: float | None = None
     z: float | None = None
     sv1: int | None = None
@@ -96,6 +323,18 @@ class StateCmd(Command):
         )
 
 
+class ProtoCmd(Command):
+    """Switches the Pico's output between the text protocol and binary frames."""
+    name: Literal["PROTO"] = "PROTO"
+
+
+class RateCmd(Command):
+    """How often the Pico prints telemetry and debug lines, in Hz. 0 turns them off."""
+    name: Literal["RATE"] = "RATE"
+    stat: int | None = None
+    debug: int | None = None
+
+
 class ConsoleLog(Command):
     name: Literal["CONSOLE"] = "CONSOLE"
     level: str = "INFO"
@@ -103,54 +342,34 @@ class ConsoleLog(Command):
  
 
 class CommandModel(BaseModel):
-    command: ResetCmd | StopCmd | MotionCmd | StateCmd = Field(discriminator="name")
-
-
-def test1():
-    test = """
-        STAT X=0.5 Z=-0.5 SV1=90 FU=1 RD=1 ACC=0.23,0.12,9.89 GYRO=0.12,0.23,0.34 DEPTH=0.5 BAT=11.6
-        MOT X=1.0 Z=-0.5 SV1=90 FU=1.0 RD=1.0
-        RESET
-        RESET SAFE
-        BOOT
-        STOP
-        CAL
-    """.strip()
-    for txt_cmd in test.split("\n"):
-        txt_cmd = txt_cmd.strip()
-        try:
-            cmd = Command.deserialize(txt_cmd)
-        except Exception:
-            print(f"failed to parse {txt_cmd}")
-            exit()
+    command: ResetCmd | StopCmd | MotionCmd | StateCmd | ProtoCmd | RateCmd = Field(discriminator="name")
 
-        try:
-            txt_cmd2 = cmd.serialize()
-            print(f"{txt_cmd} -> {cmd} -> {txt_cmd2}")
-        except Exception:
-            print(f"failed to serialize {cmd}")
-
-
-def test():
-    commands = [
-        StopCmd(),
-        MotionCmd(x=1.0, z=-1.0, sv1=90, fu=1, rd=1),
-        ResetCmd(flags=["SAFE"]),
-        ResetCmd(),
-        StateCmd(
-            x=1.0,
-            z=-1.0,
-            sv1=90,
-            fu=1,
-            rd=1,
-            acc=(0, 2.1, 0),
-            gyro=(-4.5, 0.1, 3.2),
-            depth=0.5,
-            bat=3.5,
-        ),
-    ]
-    print([cmd.serialize() for cmd in commands])
+
+# Only what CommandModel accepts is parsed off the wire, anything else is console output
+_WIRE_CODECS: dict[str, Codec] = {
+    cmd_cls._codec.name: cmd_cls._codec
+    for cmd_cls in get_args(CommandModel.model_fields["command"].annotation)
+}
+WIRE_NAMES = frozenset(_WIRE_CODECS)
+
+# What firmware/code.py makes of MOT setpoints, kept in sync with it: servos are held
+# to SERVO_MIN..SERVO_MAX and motors are off below MOTOR_MIN. A stopped motor ignores
+# requests below MOTOR_MIN_START, starts at no more than MOTOR_MAX_START and then ramps
+SERVO_MIN = 10
+SERVO_MAX = 170
+MOTOR_MIN = 0.2
+MOTOR_MIN_START = 0.3
+MOTOR_MAX_START = 0.5
+MOTOR_MAX_CHANGE_PER_S = 4.0
+# MOT values the firmware takes, anything else gets ERR Range and the line is dropped
+MOT_RANGES = {
+    "x": (-1.0, 1.0), "z": (-1.0, 1.0), "sv1": (0, 180), "sv2": (0, 180),
+    **dict.fromkeys(("fu", "fd", "fl", "fr", "ru", "rd", "rl", "rr"), (0, 1)),
+}
+
+# Between commands sent to the Pico on one line, which it applies all together or not at all
+BATCH_SEPARATOR = ";"
 
 
-if __name__ == "__main__":
-    test()
+def serialize_batch(cmds: list[Command]) -> str:
+    return BATCH_SEPARATOR.join(cmd.serialize() for cmd in cmds)
@@ -0,0 +1,300 @@
+from asyncio import get_running_loop
+from concurrent.futures import Future
+import json
+import logging
+from pathlib import Path
+import re
+import struct
+import time
+from typing import get_args
+
+import numpy as np
+
+from protocol import Command, MotionCmd, StateCmd
+
+logger = logging.getLogger(__name__)
+
+# Segment files are a fixed header followed by one preallocated array per column:
+#
+#   magic (8s) | version (u32) | pad (u32) | capacity (u64) | count (u64) | columns json
+#
+# count is updated after every record so a reader (or a crash) only ever sees
+# complete rows. Value columns start out NaN, which marks a field as not sent.
+# t is time.monotonic(), the columns json has clock_offset to add for wall-clock time.
+# That is rewritten when the segment is closed, so a clock set by NTP after the
+# segment was created is caught up with; a segment cut off by a crash keeps the first one.
+MAGIC = b"PUBREC\x00\x01"
+VERSION = 1
+HEADER_SIZE = 4096
+HEADER = struct.Struct("<8sIIQQ")
+COUNT_OFFSET = 24
+SUFFIX = ".rec"
+# telemetry-<number>-<local time>.rec, numbered on from the directory's highest so the
+# order survives the clock jumping when NTP sets it. Older names have the time first
+SEGMENT_NAME = re.compile(r"telemetry-(\d{6,})-\d{8}-\d{6}")
+
+KINDS = {StateCmd: 1, MotionCmd: 2}
+KIND_NAMES = {kind: cls.model_fields["name"].default for cls, kind in KINDS.items()}
+
+# (column, dtype, message attribute, tuple index)
+VALUE_COLUMNS = [
+    ("x", "<f4", "x", None),
+    ("z", "<f4", "z", None),
+    ("sv1", "<f4", "sv1", None),
+    ("sv2", "<f4", "sv2", None),
+    ("fu", "<f4", "fu", None),
+    ("fd", "<f4", "fd", None),
+    ("fl", "<f4", "fl", None),
+    ("fr", "<f4", "fr", None),
+    ("ru", "<f4", "ru", None),
+    ("rd", "<f4", "rd", None),
+    ("rl", "<f4", "rl", None),
+    ("rr", "<f4", "rr", None),
+    ("acc_x", "<f4", "acc", 0),
+    ("acc_y", "<f4", "acc", 1),
+    ("acc_z", "<f4", "acc", 2),
+    ("gyro_x", "<f4", "gyro", 0),
+    ("gyro_y", "<f4", "gyro", 1),
+    ("gyro_z", "<f4", "gyro", 2),
+    ("depth", "<f4", "depth", None),
+    ("bat", "<f4", "bat", None),
+]
+COLUMNS = [("t", "<f8"), ("kind", "u1")] + [(name, dtype) for name, dtype, _, _ in VALUE_COLUMNS]
+# per message type: (column, attribute, tuple index)
+FIELDS = {
+    cls: [(name, attr, index) for name, _, attr, index in VALUE_COLUMNS if attr in cls.model_fields]
+    for cls in KINDS
+}
+
+# 81 bytes a row, so about 21 MB and 3.6 hours of 20 Hz telemetry per segment
+SEGMENT_RECORDS = 1 << 18
+MAX_SEGMENTS = 16
+
+
+def _layout(capacity: int) -> tuple[list[tuple[str, str, int]], int]:
+    """(column, dtype, offset) for each column, and the file size."""
+    offset = HEADER_SIZE
+    layout = []
+    for name, dtype in COLUMNS:
+        layout.append((name, dtype, offset))
+        offset += capacity * np.dtype(dtype).itemsize
+        offset = (offset + 7) & ~7
+    return layout, offset
+
+
+class Segment:
+    """One preallocated, memory-mapped recording file. Creating one writes the whole file."""
+
+    def __init__(self, path: Path, capacity: int):
+        self.path = path
+        self.capacity = capacity
+        layout, size = _layout(capacity)
+        self.mm = np.memmap(path, dtype=np.uint8, mode="w+", shape=(size,))
+        self.mm[:HEADER.size] = np.frombuffer(HEADER.pack(MAGIC, VERSION, 0, capacity, 0), dtype=np.uint8)
+        self.write_spec()
+        self.count_view = self.mm[COUNT_OFFSET:COUNT_OFFSET + 8].view("<u8")
+        self.columns = {
+            name: self.mm[offset:offset + capacity * np.dtype(dtype).itemsize].view(dtype)
+            for name, dtype, offset in layout
+        }
+        for name, _, _, _ in VALUE_COLUMNS:
+            self.columns[name][:] = np.nan
+        self.count = 0
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def write_spec(self):
+        """The columns json, with clock_offset as the clocks stand now."""
+        spec = json.dumps({
+            "columns": COLUMNS, "kinds": KIND_NAMES, "clock_offset": time.time() - time.monotonic(),
+        }).encode()
+        self.mm[HEADER.size:HEADER_SIZE] = 0
+        self.mm[HEADER.size:HEADER.size + len(spec)] = np.frombuffer(spec, dtype=np.uint8)
+
+    def close(self):
+        # a Pi without a clock may only have had it set since the segment was made
+        self.write_spec()
+        self.mm.flush()
+        del self.mm
+
+
+def load_segment(path: Path | str) -> dict[str, np.ndarray]:
+    """Read-only columns of a recording, trimmed to the rows actually written."""
+    mm = np.memmap(path, dtype=np.uint8, mode="r")
+    magic, version, _, capacity, count = HEADER.unpack(mm[:HEADER.size].tobytes())
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a telemetry recording")
+    layout, _ = _layout(capacity)
+    return {
+        name: mm[offset:offset + capacity * np.dtype(dtype).itemsize].view(dtype)[:count]
+        for name, dtype, offset in layout
+    }
+
+
+def clock_offset(path: Path | str, columns: dict[str, np.ndarray]) -> float:
+    """What to add to a recording's t for epoch seconds."""
+    with open(path, "rb") as f:
+        f.seek(HEADER.size)
+        spec = f.read(HEADER_SIZE - HEADER.size).rstrip(b"\x00")
+    try:
+        return float(json.loads(spec)["clock_offset"])
+    except (ValueError, KeyError):
+        # older recordings: assume the last row was written when the file last was
+        t = columns["t"]
+        return Path(path).stat().st_mtime - (float(t[-1]) if len(t) else 0.0)
+
+
+def load_messages(path: Path | str) -> list[tuple[float, Command]]:
+    """(receive time, message) for every row of a recording."""
+    columns = load_segment(path)
+    classes = {kind: cls for cls, kind in KINDS.items()}
+    rows = {name: columns[name].tolist() for name, _, _, _ in VALUE_COLUMNS}
+    ints = {cls: {attr for attr, info in cls.model_fields.items() if int in get_args(info.annotation)} for cls in KINDS}
+    out = []
+    for i, (t, kind) in enumerate(zip(columns["t"].tolist(), columns["kind"].tolist())):
+        if (cls := classes.get(kind)) is None:
+            continue
+        values = {}
+        for name, attr, index in FIELDS[cls]:
+            value = rows[name][i]
+            if value != value:
+                continue
+            # shortest decimal that round-trips through float32, as the Pico printed it
+            value = int(value) if attr in ints[cls] else float(f"{value:.7g}")
+            if index is None:
+                values[attr] = value
+            else:
+                values.setdefault(attr, []).append(value)
+        for attr, value in values.items():
+            if type(value) is list:
+                values[attr] = tuple(value)
+        out.append((t, cls._codec.build(values, [])))
+    return out
+
+
+def segment_number(path: Path) -> int:
+    """Where a recording comes in its directory's sequence, 0 for ones named before numbering."""
+    match = SEGMENT_NAME.fullmatch(path.stem)
+    return int(match[1]) if match else 0
+
+
+def list_segments(directory: Path | str) -> list[Path]:
+    """Recordings in a directory, oldest first."""
+    return sorted(Path(directory).glob(f"*{SUFFIX}"), key=lambda path: (segment_number(path), path.name))
+
+
+class TelemetryRecorder:
+    """Writes StateCmd and MotionCmd into rolling memory-mapped column files.
+
+    record() only stores values into the mapped arrays. Creating the next segment,
+    flushing a finished one and deleting old ones all happen on a worker thread, and
+    the next segment is ready well before the current one fills up.
+    """
+
+    def __init__(self, directory: Path | str, segment_records: int = SEGMENT_RECORDS, max_segments: int = MAX_SEGMENTS):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self.segment: Segment | None = None
+        self.next_segment: Future | None = None
+        self.next_path: Path | None = None
+        self.recorded = 0
+        self.dropped = 0
+        self.serial = max(map(segment_number, list_segments(self.directory)), default=0)
+
+    def start(self):
+        self.segment = Segment(self._next_path(), self.segment_records)
+        logger.info(f"Recording telemetry to {self.segment.path}")
+
+    def record(self, msg: Command):
+        kind = KINDS.get(type(msg))
+        if kind is None:
+            return
+        t = time.monotonic()
+        segment = self.segment
+        if segment is None or segment.full:
+            if (segment := self._roll()) is None:
+                self.dropped += 1
+                return
+
+        i = segment.count
+        columns = segment.columns
+        columns["t"][i] = t
+        columns["kind"][i] = kind
+        values = msg.__dict__
+        for name, attr, index in FIELDS[type(msg)]:
+            value = values[attr]
+            if value is None:
+                continue
+            columns[name][i] = value if index is None else value[index]
+        segment.count = i + 1
+        segment.count_view[0] = i + 1
+        self.recorded += 1
+
+        if self.next_segment is None and segment.count >= segment.capacity * 3 // 4:
+            self._prepare()
+
+    def _prepare(self):
+        self.next_path = self._next_path()
+        self.next_segment = get_running_loop().run_in_executor(None, Segment, self.next_path, self.segment_records)
+
+    def _next_ready(self) -> Segment | None:
+        """The prepared segment, None if making it failed, the SD card being full say."""
+        try:
+            return self.next_segment.result()
+        except Exception as e:
+            logger.error("Couldn't create recording %s: %s", self.next_path, e, extra={"rate_limit": "recorder"})
+            self.next_path.unlink(missing_ok=True)
+            return None
+        finally:
+            self.next_segment = None
+
+    def _roll(self) -> Segment | None:
+        if self.next_segment is None:
+            # the last attempt failed, try again
+            self._prepare()
+        if not self.next_segment.done():
+            # not ready yet, better to lose a few rows than stall the event loop
+            return None
+        if (segment := self._next_ready()) is None:
+            return None
+        finished = self.segment
+        self.segment = segment
+        logger.info(f"Recording telemetry to {self.segment.path}")
+        get_running_loop().run_in_executor(None, self._retire, finished)
+        return self.segment
+
+    def _retire(self, segment: Segment | None):
+        if segment is not None:
+            segment.close()
+        # never the one being written or the one being made for after it
+        live = {self.segment.path if self.segment else None, self.next_path}
+        segments = list_segments(self.directory)
+        old = [path for path in segments if path not in live]
+        for path in old[:max(0, len(segments) - self.max_segments)]:
+            path.unlink(missing_ok=True)
+
+    def _next_path(self) -> Path:
+        self.serial += 1
+        return self.directory / f"telemetry-{self.serial:06d}-{time.strftime('%Y%m%d-%H%M%S')}{SUFFIX}"
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        if self.next_segment is not None and self.next_segment.done():
+            # never written to, don't leave an empty recording behind
+            if (spare := self._next_ready()) is not None:
+                spare.close()
+                spare.path.unlink(missing_ok=True)
+        self.next_segment = None
+
+    def stats(self) -> dict:
+        return {
+            "file": str(self.segment.path) if self.segment else None,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+        }
@@ -1,140 +1,172 @@
-from asyncio import create_task, sleep
+from asyncio import CancelledError, Event, create_task, get_running_loop, sleep, to_thread
+from bisect import bisect_right
+from collections import deque
+from enum import IntEnum
+from operator import itemgetter
+from pathlib import Path
+import re
+from time import monotonic
 import serial
 from serial_asyncio import open_serial_connection
 import logging
-import random
 
-from pydantic import ValidationError
-
-from protocol import Command, StateCmd, MotionCmd, ConsoleLog
+from framing import FrameReader, encode_batch, encode_cmd
+from metrics import SerialMetrics
+from protocol import (
+    BATCH_SEPARATOR, MOT_RANGES, WIRE_NAMES, Command, StateCmd, MotionCmd, ConsoleLog, ProtoCmd, RateCmd, ResetCmd, StopCmd,
+    serialize_batch,
+)
+from recorder import SUFFIX, list_segments, load_messages
+from simulator import shared_simulator
 
 logger = logging.getLogger(__name__)
 
-class DebugSerialClient:
-    def __init__(self, *args, **kwargs):
-        self.callback = None
-        self.gyro = [0.0, 0.0, 0.0]  # [roll, pitch, yaw]
-        self.last_motion_cmd = None
+# How often and how many times to ask the Pico to switch to binary frames
+BINARY_REQUEST_INTERVAL = 1.0
+BINARY_REQUEST_ATTEMPTS = 5
 
-    async def connect(self):
-        self.task = create_task(self.fake_state())
+# Bytes handed to the serial transport before a write waits for them to go out. Small,
+# so a STOP is never stuck behind more than about this much already written
+WRITE_BUFFER_HIGH = 256
+# Most commands queued back to back that go out as one line, which the Pico applies
+# in one go. Keeps the line well inside the firmware's 1024 byte input buffer
+WRITE_BATCH = 8
 
-    def disconnect(self):
-        pass
+# Most bytes taken off the serial port per read, normally all that's waiting
+READ_CHUNK = 65536
+# How a STAT line starts, so one can be skipped without parsing it
+STAT_PREFIX = StateCmd._codec.name + " "
+# What CircuitPython prints when code.py starts over, e.g. after a soft reboot
+FIRMWARE_START = "code.py output:"
 
-    async def write_text(self, text: str):
-        logger.info(f"debug serial tx: {repr(text)}")
+# Time between STAT lines in a raw log without timestamps, the Pico's 20 Hz
+REPLAY_STAT_INTERVAL = 0.05
+# Longest pause kept between recording segments, more means the server was down in between
+REPLAY_MAX_GAP = 1.0
+# Messages handed over per read when replaying as fast as possible
+REPLAY_BATCH = 64
+# "12.345 STAT X=..." as written by e.g. `ts -s %.s`
+TIMESTAMPED_LINE = re.compile(r"(\d+(?:\.\d*)?)[ \t]+(.*)")
 
-    async def write_cmd(self, cmd: Command):
-        txt = cmd.serialize()
-        logger.info(txt)
 
-        # Track MotionCmd to simulate gyro changes
-        if isinstance(cmd, MotionCmd):
-            self.last_motion_cmd = cmd
+def _in_range(cmd: Command) -> bool:
+    """Whether firmware/code.py would take cmd's MOT values."""
+    if not isinstance(cmd, MotionCmd):
+        return True
+    values = cmd.__dict__
+    return all(values[field] is None or low <= values[field] <= high for field, (low, high) in MOT_RANGES.items())
 
-            # Immediately send state update for responsive feedback
-            if self.callback:
-                state = StateCmd.default()
 
-                # Calculate gyro based on the new command
-                roll_delta = 0.0
-                pitch_delta = 0.0
-                yaw_delta = 0.0
+def _is_state(item: str | Command) -> bool:
+    return isinstance(item, StateCmd) or isinstance(item, str) and item.startswith(STAT_PREFIX)
 
-                if cmd.sv1 is not None:
-                    roll_delta = (cmd.sv1 - 90) * 0.5
-                if cmd.sv2 is not None:
-                    pitch_delta = (cmd.sv2 - 90) * 0.5
 
-                if cmd.x is not None:
-                    roll_delta += cmd.x * 10.0
-                if cmd.z is not None:
-                    roll_delta += cmd.z * 10.0
+class Priority(IntEnum):
+    """Outbound write classes, lower goes first."""
+    SAFETY = 0
+    NORMAL = 1
 
-                left_thrust = 0
-                right_thrust = 0
 
-                if cmd.fl: left_thrust += 1
-                if cmd.rl: left_thrust += 1
-                if cmd.fr: right_thrust += 1
-                if cmd.rr: right_thrust += 1
+# Written ahead of everything else, dropping any queued setpoints they make moot
+SAFETY_COMMANDS = (StopCmd, ResetCmd)
+# Setpoints a safety command overrides if they haven't gone out yet
+OVERRIDABLE_COMMANDS = (MotionCmd,)
+# What the simulated Pico understands, PROTO is accepted but it stays on text
+SIMULATED_COMMANDS = (MotionCmd, StopCmd, ResetCmd, RateCmd, ProtoCmd)
 
-                yaw_delta = (right_thrust - left_thrust) * 15.0
 
-                self.gyro[0] += (roll_delta - self.gyro[0]) * 0.5
-                self.gyro[1] += (pitch_delta - self.gyro[1]) * 0.1
-                self.gyro[2] += yaw_delta * 0.3
+class DebugSerialClient:
+    """Stands in for the Pico with a vehicle in the shared simulator, for running without hardware."""
 
-                self.gyro[0] *= 0.95
-                self.gyro[1] *= 0.95
-                self.gyro[2] *= 0.98
+    def __init__(self, *args, telemetry_rate=None, **kwargs):
+        self.callback = None
+        # STAT lines per second, None for the firmware's default
+        self.telemetry_rate = telemetry_rate
+        self.simulator = None
+        self.slot = None
+        self.last_write_at = 0.0
 
-                state.gyro = tuple(round(v, 3) for v in self.gyro)
-                await self.callback(state)
+    async def connect(self):
+        if self.slot is None:
+            self.simulator = shared_simulator()
+            self.slot = self.simulator.add(self.received, self.telemetry_rate)
+
+    def disconnect(self):
+        if self.slot is not None:
+            self.simulator.remove(self.slot)
+            self.slot = None
+
+    async def received(self, msg: Command):
+        if callback := self.callback:
+            await callback(msg)
+
+    async def write_text(self, text: str, priority: Priority = Priority.NORMAL) -> float:
+        self.last_write_at = monotonic()
+        logger.info("debug serial tx: %r", text)
+        # like the firmware: every command on the line is checked before any is applied
+        cmds = [Command.parse(part) for part in text.strip().split(BATCH_SEPARATOR)]
+        if not all(isinstance(cmd, SIMULATED_COMMANDS) for cmd in cmds):
+            await self.received(ConsoleLog(line="ERR Unknown command"))
+        elif not all(map(_in_range, cmds)):
+            await self.received(ConsoleLog(line="ERR Range"))
+        else:
+            for cmd in cmds:
+                self.apply(cmd)
+        return self.last_write_at
+
+    async def write_cmd(self, cmd: Command) -> float:
+        self.last_write_at = monotonic()
+        logger.info("%s", cmd.serialize())
+        if _in_range(cmd):
+            self.apply(cmd)
+        else:
+            await self.received(ConsoleLog(line="ERR Range"))
+        return self.last_write_at
+
+    def apply(self, cmd: Command):
+        if self.slot is None:
+            return
+        if isinstance(cmd, MotionCmd):
+            self.simulator.motion(self.slot, cmd)
+        elif isinstance(cmd, StopCmd):
+            self.simulator.stop(self.slot)
+        elif isinstance(cmd, ResetCmd):
+            self.simulator.reset(self.slot)
+        elif isinstance(cmd, RateCmd) and cmd.stat is not None:
+            self.simulator.set_rate(self.slot, cmd.stat)
 
-    async def fake_state(self):
-        while True:
-            try:
-                await sleep(0.1)  # Update more frequently for smooth simulation
-                if self.callback:
-                    if random.randint(0, 100) == 0:
-                        await self.callback(ConsoleLog(line="This is a test message from the debug PICO serial client"))
-                    elif random.randint(0, 1000) == 0:
-                        await self.callback(MotionCmd(x=1.0, y=-2.7, fl=29))
-
-                    state = StateCmd.default()
-
-                    # Simulate gyro changes based on last MotionCmd
-                    if self.last_motion_cmd:
-                        roll_delta = 0.0
-                        pitch_delta = 0.0
-                        yaw_delta = 0.0
-
-                        if self.last_motion_cmd.sv1 is not None:
-                            roll_delta = (self.last_motion_cmd.sv1 - 90) * 0.5  # Map 0-180 to degrees
-                        if self.last_motion_cmd.sv2 is not None:
-                            pitch_delta = (self.last_motion_cmd.sv2 - 90) * 0.5  # Map 0-180 to degrees
-
-                        # Handle x and z axes - both control roll
-                        if self.last_motion_cmd.x is not None:
-                            roll_delta += self.last_motion_cmd.x * 10.0
-                        if self.last_motion_cmd.z is not None:
-                            roll_delta += self.last_motion_cmd.z * 10.0
-
-                        left_thrust = 0
-                        right_thrust = 0
-
-                        if self.last_motion_cmd.fl: left_thrust += 1
-                        if self.last_motion_cmd.rl: left_thrust += 1
-                        if self.last_motion_cmd.fr: right_thrust += 1
-                        if self.last_motion_cmd.rr: right_thrust += 1
-
-                        yaw_delta = (right_thrust - left_thrust) * 15.0
-
-                        self.gyro[0] += (roll_delta - self.gyro[0]) * 0.5  # roll
-                        self.gyro[1] += (pitch_delta - self.gyro[1]) * 0.1  # pitch
-                        self.gyro[2] += yaw_delta * 0.3  # yaw accumulates
-
-                        self.gyro[0] *= 0.95
-                        self.gyro[1] *= 0.95
-                        # Don't decay yaw as much so rotation is visible
-                        self.gyro[2] *= 0.98
-
-                    state.gyro = tuple(round(v, 3) for v in self.gyro)
-                    await self.callback(state)
-            except Exception:
-                logger.exception("Error handling cmd")
 
 class SerialClient:
-    def __init__(self, port="/dev/ttyUSB0", baudrate=115200):
+    def __init__(self, port="/dev/ttyUSB0", baudrate=115200, binary=False, telemetry_rate=None):
         self.port = port
         self.baudrate = baudrate
+        # STAT lines per second to ask the Pico for, None leaves its default
+        self.telemetry_rate = telemetry_rate
         self.callback = None
+        # called whenever the firmware may have started afresh: on (re)connect and when code.py restarts
+        self.on_restart = None
+        # given the STATs skipped as stale, which still have to be recorded
+        self.on_stale = None
         self.connect_loop_task = None
         self.read_task = None
         self.writer = None
         self.reader = None
+        # binary: we'd like framed telemetry, binary_active: the Pico agreed to it
+        self.binary = binary
+        self.binary_active = False
+        self.binary_requests = 0
+        self.binary_requested_at = 0.0
+        self.frames = FrameReader()
+        # replaced by the vehicle's own once Plumbing knows its name
+        self.metrics = SerialMetrics()
+        # only the newest of several STATs read at once is parsed and passed on
+        self.skip_stale = True
+        # when the last write was handed to the OS, for latency metrics
+        self.last_write_at = 0.0
+        # Priority -> (Command or raw bytes, overridable, queued at, future for when it went out)
+        self.outbox: dict[Priority, deque] = {priority: deque() for priority in Priority}
+        self.outbox_ready = Event()
+        self.send_task = None
 
     async def _connect_loop(self):
         error_count = 0
@@ -146,10 +178,20 @@ class SerialClient:
                 logger.info(f"Successfully connected: {self.port}")
                 self.reader = reader
                 self.writer = writer
+                writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+                if self.send_task is None or self.send_task.done():
+                    self.send_task = create_task(self.sender())
+                self.binary_active = False
+                self.binary_requests = 0
+                self.frames = FrameReader()
 
                 if self.read_task:
                     self.read_task.cancel()
                 self.read_task = create_task(self.continuous_read())
+                self.restarted()
+                if self.telemetry_rate is not None:
+                    await self.write_cmd(RateCmd(stat=self.telemetry_rate))
+                await self.request_binary()
                 return
             except serial.SerialException as e:
                 await sleep(0.1)
@@ -157,6 +199,10 @@ class SerialClient:
                     logger.warning(f"Retrying - {e}")
                     error_count += 1
 
+    def restarted(self):
+        if on_restart := self.on_restart:
+            on_restart()
+
     async def connect(self):
         if self.connect_loop_task:
             self.connect_loop_task.cancel()
@@ -168,47 +214,314 @@ class SerialClient:
             self.writer.close()
         if task := self.read_task:
             task.cancel()
+        if task := self.send_task:
+            task.cancel()
+            self.send_task = None
+        for queue in self.outbox.values():
+            while queue:
+                self._finish(queue.popleft(), None)
         logger.debug("Disconnected")
 
-    async def write_cmd(self, cmd: Command):
-        await self.write_text(cmd.serialize() + "\n")
-
-    async def write_text(self, text: str):
+    async def request_binary(self):
+        """Ask the Pico for binary frames, giving up on firmware that doesn't know PROTO."""
+        if not self.binary or self.binary_requests >= BINARY_REQUEST_ATTEMPTS:
+            return
+        if monotonic() - self.binary_requested_at < BINARY_REQUEST_INTERVAL:
+            return
+        self.binary_requests += 1
+        self.binary_requested_at = monotonic()
+        if self.binary_requests == BINARY_REQUEST_ATTEMPTS:
+            logger.warning("No reply to PROTO BIN, staying on the text protocol")
+        await self.write_cmd(ProtoCmd(flags=["BIN"]))
+
+    async def write_cmd(self, cmd: Command) -> float | None:
+        """Queue a command, returning when it went out, or None if it never did."""
+        priority = Priority.SAFETY if isinstance(cmd, SAFETY_COMMANDS) else Priority.NORMAL
+        return await self._queue(cmd, priority, isinstance(cmd, OVERRIDABLE_COMMANDS))
+
+    async def write_text(self, text: str, priority: Priority = Priority.NORMAL) -> float | None:
         if not self.writer:
+            return None
+        logger.debug("TX: %s", text, extra={"rate_limit": "serial_tx"})
+        return await self.write_bytes(text.encode("utf-8"), priority)
+
+    async def write_bytes(self, data: bytes, priority: Priority = Priority.NORMAL) -> float | None:
+        return await self._queue(data, priority, False)
+
+    async def _queue(self, item: Command | bytes, priority: Priority, overridable: bool) -> float | None:
+        if not self.writer or self.send_task is None or self.send_task.done():
+            return None
+        if priority == Priority.SAFETY:
+            self.override()
+        future = get_running_loop().create_future()
+        self.outbox[priority].append((item, overridable, monotonic(), future))
+        self.outbox_ready.set()
+        return await future
+
+    def encode(self, cmds: list[Command]) -> bytes:
+        """One line for all of cmds, a frame if the Pico takes them and they all have one."""
+        if self.binary_active:
+            frame = encode_cmd(cmds[0]) if len(cmds) == 1 else encode_batch(cmds)
+            if frame is not None:
+                return frame
+        text = serialize_batch(cmds)
+        logger.debug("TX: %s", text, extra={"rate_limit": "serial_tx"})
+        return (text + "\n").encode("utf-8")
+
+    def override(self):
+        """Drop queued setpoints that haven't gone out, a safety command is about to replace them."""
+        queue = self.outbox[Priority.NORMAL]
+        if not any(overridable for _, overridable, _, _ in queue):
             return
-        try:
-            logger.debug(f"TX: {text}")
-            self.writer.write(text.encode("utf-8"))
-            await self.writer.drain()
-        except serial.SerialException:
-            #logger.exception("Error writing data")
-            logger.warning(f"Failed to send serial command: {text}")
-
-    async def read_line(self) -> str | None:
-        data = await self.reader.readline()
-        text = data.decode("utf-8").strip()
-        return text if text else None
-
+        kept = deque()
+        for entry in queue:
+            if entry[1]:
+                self.metrics.overridden += 1
+                self._finish(entry, None)
+            else:
+                kept.append(entry)
+        self.outbox[Priority.NORMAL] = kept
+
+    @staticmethod
+    def _finish(entry, written: float | None):
+        if not (future := entry[3]).done():
+            future.set_result(written)
+
+    async def sender(self):
+        """The only writer to the port, always taking the highest priority writes queued.
+
+        Commands queued one after another at the same priority go out together as one
+        line with a single drain.
+        """
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+            while True:
+                priority = next((p for p in Priority if self.outbox[p]), None)
+                if priority is None:
+                    break
+                queue = self.outbox[priority]
+                batch = [queue.popleft()]
+                if isinstance(batch[0][0], Command):
+                    while queue and isinstance(queue[0][0], Command) and len(batch) < WRITE_BATCH:
+                        batch.append(queue.popleft())
+                data = b""
+                written = None
+                try:
+                    if isinstance(batch[0][0], Command):
+                        data = self.encode([entry[0] for entry in batch])
+                    else:
+                        data = batch[0][0]
+                    if self.writer:
+                        self.writer.write(data)
+                        # returns once the transport is back under WRITE_BUFFER_HIGH
+                        await self.writer.drain()
+                        written = monotonic()
+                except serial.SerialException:
+                    logger.warning(f"Failed to send serial command: {data!r}")
+                except CancelledError:
+                    for entry in batch:
+                        self._finish(entry, None)
+                    raise
+                except Exception:
+                    # this batch is lost, but a STOP queued behind it must still go out
+                    logger.exception("Failed to send serial commands %r", [entry[0] for entry in batch])
+                if written is not None:
+                    self.last_write_at = written
+                    self.metrics.tx_bytes.add(len(data))
+                    self.metrics.tx_lines.add(data.count(b"\n"))
+                    self.metrics.tx_commands.add(len(batch))
+                for entry in batch:
+                    if written is not None:
+                        self.metrics.write_latency[priority.name.lower()].observe(written - entry[2])
+                    self._finish(entry, written)
+
+    async def read_messages(self) -> list[str | Command]:
+        """Every whole text line and decoded frame received so far, waiting for at least one byte."""
+        data = await self.reader.read(READ_CHUNK)
+        if not data:
+            raise serial.SerialException("Connection closed")
+        frames = self.frames
+        bad_frames, bad_text = frames.bad_frames, frames.bad_text
+        messages = frames.feed(data)
+        self.metrics.rx_bytes.add(len(data))
+        self.metrics.rx_lines.add(len(messages))
+        self.metrics.parse_errors["frame"] += frames.bad_frames - bad_frames
+        self.metrics.parse_errors["encoding"] += frames.bad_text - bad_text
+        return messages
 
     async def continuous_read(self):
         while True:
             try:
-                data = await self.read_line()
+                messages = await self.read_messages()
             except serial.SerialException:
                 logger.warning(f"Disconnected {self.port}")
                 await self.connect()
                 return
 
-            if data:
+            # behind on a backlog, only the newest STAT that parses matters but every console line does
+            newest, newest_cmd = -1, None
+            if self.skip_stale and len(messages) > 1:
+                for i in range(len(messages) - 1, -1, -1):
+                    if _is_state(data := messages[i]):
+                        cmd = data if isinstance(data, Command) else Command.parse(data)
+                        if cmd is not None:
+                            newest, newest_cmd = i, cmd
+                            break
+
+            for i, data in enumerate(messages):
+                if i < newest and _is_state(data):
+                    if (on_stale := self.on_stale) is None:
+                        # not parsed, so a broken one counts here too
+                        self.metrics.stale_skipped += 1
+                    elif (cmd := data if isinstance(data, Command) else Command.parse(data)) is None:
+                        self.metrics.parse_errors["text"] += 1
+                    else:
+                        self.metrics.stale_skipped += 1
+                        on_stale(cmd)
+                    continue
+                if isinstance(data, Command):
+                    # already decoded from a binary frame
+                    if callback := self.callback:
+                        await callback(data)
+                    continue
+
+                cmd = newest_cmd if i == newest else Command.parse(data)
+                if cmd is None and data.partition(" ")[0] in WIRE_NAMES:
+                    self.metrics.parse_errors["text"] += 1
+                if cmd is None and data.startswith(FIRMWARE_START):
+                    self.restarted()
+                if isinstance(cmd, ProtoCmd):
+                    self.binary_active = self.binary and cmd.flags == ["BIN"]
+                    self.binary_requests = 0
+                    logger.info(f"Serial protocol: {'binary' if self.binary_active else 'text'}")
+                    continue
+                if isinstance(cmd, StateCmd) and self.binary:
+                    # text telemetry while we want frames, the Pico restarted or missed the request
+                    self.binary_active = False
+                    await self.request_binary()
+
                 if callback := self.callback:
                     # logger.debug(f"RX: {data}")
-                    try:
-                        cmd = Command.deserialize(data.strip())
+                    if cmd is None:
+                        logger.debug("RX: %s", data)
+                        await callback(ConsoleLog(line=data))
+                    else:
                         if not isinstance(cmd, StateCmd):
                             logger.info(cmd)
                         await callback(cmd)
-                    except ValidationError:
-                        logger.debug(f"RX: {data}")
-                        await callback(ConsoleLog(line=data))
                 else:
-                    logger.debug(f"RX: {data}")
+                    logger.debug("RX: %s", data)
+
+
+class ReplaySerialClient(SerialClient):
+    """Plays a captured session through the normal read path instead of talking to a Pico.
+
+    path is a raw serial log (Pico output, optionally with a time in seconds in front of
+    each line) or telemetry recorded with PUBMARINE_RECORD_DIR, either one .rec file or the
+    whole directory. speed 1 is real time, N is N times faster and 0 as fast as the server
+    keeps up. The session starts over when it runs out.
+    """
+
+    def __init__(self, path, speed: float = 1.0):
+        super().__init__(port=str(path))
+        self.path = Path(path)
+        self.speed = speed
+        # as fast as possible is for timing the whole read path, every message counts
+        self.skip_stale = speed > 0
+        # (seconds since the first message, line or decoded message)
+        self.timeline: list[tuple[float, str | Command]] = []
+        self.position = 0
+        self.started = 0.0
+        self.passes = 0
+
+    async def connect(self):
+        self.timeline = await to_thread(self.load)
+        logger.info(f"Replaying {len(self.timeline)} messages from {self.path} at {self.speed or 'max'}x")
+        self.started = monotonic()
+        if self.read_task:
+            self.read_task.cancel()
+        self.read_task = create_task(self.continuous_read())
+
+    def load(self) -> list[tuple[float, str | Command]]:
+        if self.path.is_dir():
+            timeline = self.join_segments([load_messages(segment) for segment in list_segments(self.path)])
+        elif self.path.suffix == SUFFIX:
+            timeline = load_messages(self.path)
+        else:
+            timeline = self.load_raw(self.path.read_bytes())
+        if not timeline:
+            raise ValueError(f"Nothing to replay in {self.path}")
+        start = timeline[0][0]
+        return [(t - start, item) for t, item in timeline]
+
+    @staticmethod
+    def join_segments(segments: list[list[tuple[float, Command]]]) -> list[tuple[float, Command]]:
+        """Recordings one after the other on a single clock.
+
+        t is time.monotonic() of the server that recorded a segment, which starts over
+        with every boot. A segment that starts before the previous one ended, or long
+        after, is moved to follow on from it.
+        """
+        timeline = []
+        for segment in segments:
+            if not segment:
+                continue
+            if timeline:
+                end = timeline[-1][0]
+                gap = segment[0][0] - end
+                if not 0 <= gap <= REPLAY_MAX_GAP:
+                    shift = end + REPLAY_STAT_INTERVAL - segment[0][0]
+                    segment = [(t + shift, item) for t, item in segment]
+            timeline.extend(segment)
+        return timeline
+
+    @staticmethod
+    def load_raw(data: bytes) -> list[tuple[float, str | Command]]:
+        items = FrameReader().feed(data + b"\n")
+        timestamped = bool(items) and isinstance(items[0], str) and TIMESTAMPED_LINE.fullmatch(items[0]) is not None
+        timeline = []
+        t = 0.0
+        for item in items:
+            if timestamped and isinstance(item, str) and (match := TIMESTAMPED_LINE.fullmatch(item)):
+                t = float(match[1])
+                item = match[2]
+            elif not timestamped and (isinstance(item, StateCmd) or item.startswith("STAT")):
+                t += REPLAY_STAT_INTERVAL
+            timeline.append((t, item))
+        return timeline
+
+    async def read_messages(self) -> list[str | Command]:
+        timeline = self.timeline
+        if self.position >= len(timeline):
+            elapsed = monotonic() - self.started
+            self.passes += 1
+            logger.info(
+                f"Replayed {len(timeline)} messages in {elapsed:.2f}s ({len(timeline) / max(elapsed, 1e-9):.0f}/s), "
+                f"pass {self.passes}"
+            )
+            self.position = 0
+            self.started = monotonic()
+
+        start = self.position
+        if self.speed > 0:
+            delay = self.started + timeline[start][0] / self.speed - monotonic()
+            if delay > 0:
+                await sleep(delay)
+            # everything that's due, like a serial buffer filling up behind a busy reader
+            now = (monotonic() - self.started) * self.speed
+            end = max(start + 1, bisect_right(timeline, now, lo=start, key=itemgetter(0)))
+        else:
+            await sleep(0)
+            end = start + REPLAY_BATCH
+        self.position = min(end, len(timeline))
+        self.metrics.rx_lines.add(self.position - start)
+        return [item for _, item in timeline[start:end]]
+
+    async def write_cmd(self, cmd: Command) -> float:
+        return await self.write_text(cmd.serialize() + "\n")
+
+    async def write_text(self, text: str, priority: Priority = Priority.NORMAL) -> float:
+        self.last_write_at = monotonic()
+        logger.debug("replay serial tx: %r", text, extra={"rate_limit": "serial_tx"})
+        return self.last_write_at
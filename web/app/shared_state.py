@@ -0,0 +1,177 @@
+import argparse
+from multiprocessing import resource_tracker, shared_memory
+import re
+import struct
+import sys
+import time
+from typing import NamedTuple
+
+from protocol import StateCmd
+
+# The newest STAT of each vehicle, in a shared memory block named pubmarine_<vehicle>
+# so other processes on the box can poll it without a WebSocket or any JSON:
+#
+#   magic (4s) | version (u8) | pad | seq (u64)
+#   | count (u64) | updated_at (f64, epoch s) | present (u32, bit per FIELDS entry)
+#   | sv1 fu rd (i32 each) | x z depth bat (f64 each) | acc (3 f64) | gyro (3 f64)
+#
+# seq is a seqlock: odd while the block is being written. A reader copies the body
+# and keeps it only if seq was even and unchanged around the copy. count is 0 until
+# the publisher that has the block now sends its first STAT.
+MAGIC = b"PUBS"
+VERSION = 1
+HEADER = struct.Struct("<4sB3xQ")
+SEQ = struct.Struct("<Q")
+SEQ_OFFSET = 8
+BODY = struct.Struct("<QdI3i4d3d3d")
+SIZE = HEADER.size + BODY.size
+PREFIX = "pubmarine_"
+# What a vehicle may be called, its name ends up in block names, paths and metric labels
+VEHICLE_NAME = re.compile(r"[A-Za-z0-9_-]+")
+# How long a reader waits for a write in progress before giving up on the writer
+READ_TIMEOUT = 0.1
+
+# In StateCmd order, which SharedState follows
+FIELDS = ("x", "z", "sv1", "fu", "rd", "acc", "gyro", "depth", "bat")
+ALL_PRESENT = (1 << len(FIELDS)) - 1
+
+
+class SharedState(NamedTuple):
+    # STATs published since the server started
+    count: int
+    updated_at: float
+    x: float | None
+    z: float | None
+    sv1: int | None
+    fu: int | None
+    rd: int | None
+    acc: tuple[float, float, float] | None
+    gyro: tuple[float, float, float] | None
+    depth: float | None
+    bat: float | None
+
+
+def block_name(vehicle: str) -> str:
+    if not VEHICLE_NAME.fullmatch(vehicle):
+        raise ValueError(f"Bad vehicle name: {vehicle!r}")
+    return PREFIX + vehicle
+
+
+class StatePublisher:
+    """Writes a vehicle's STATs into its block, one writer per vehicle."""
+
+    def __init__(self, vehicle: str):
+        try:
+            self.shm = shared_memory.SharedMemory(block_name(vehicle), create=True, size=SIZE)
+        except FileExistsError:
+            # left behind by a process that didn't get to unlink it
+            self.shm = shared_memory.SharedMemory(block_name(vehicle))
+        buf = self.shm.buf
+        magic, version, seq = HEADER.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            seq = 0
+        # the old STAT is stale, readers see none until this process publishes.
+        # seq carries on, so pollers attached to the old block notice the change
+        self.seq = seq + (seq & 1)
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, self.seq + 1)
+        buf[HEADER.size:SIZE] = bytes(BODY.size)
+        self.seq += 2
+        SEQ.pack_into(buf, SEQ_OFFSET, self.seq)
+        self.count = 0
+
+    def publish(self, state: StateCmd):
+        present = 0
+        for bit, field in enumerate(FIELDS):
+            if getattr(state, field) is not None:
+                present |= 1 << bit
+        acc = state.acc or (0.0, 0.0, 0.0)
+        gyro = state.gyro or (0.0, 0.0, 0.0)
+        self.count += 1
+        buf = self.shm.buf
+        SEQ.pack_into(buf, SEQ_OFFSET, self.seq + 1)
+        BODY.pack_into(
+            buf, HEADER.size, self.count, time.time(), present,
+            state.sv1 or 0, state.fu or 0, state.rd or 0,
+            state.x or 0.0, state.z or 0.0, state.depth or 0.0, state.bat or 0.0,
+            *acc, *gyro,
+        )
+        self.seq += 2
+        SEQ.pack_into(buf, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class StateReader:
+    """Polls a vehicle's latest STAT from its block.
+
+    Raises FileNotFoundError while no server publishes that vehicle.
+    """
+
+    def __init__(self, vehicle: str):
+        self.shm = shared_memory.SharedMemory(block_name(vehicle))
+        if sys.version_info < (3, 13):
+            # attaching registers the block too, and the tracker would unlink it when we exit
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        magic, version, _ = HEADER.unpack_from(self.shm.buf)
+        if magic != MAGIC or version != VERSION:
+            self.shm.close()
+            raise ValueError(f"{block_name(vehicle)} isn't a version {VERSION} state block")
+
+    def seq(self) -> int:
+        """Changes whenever a new STAT is published, to poll for updates cheaply."""
+        return SEQ.unpack_from(self.shm.buf, SEQ_OFFSET)[0]
+
+    def read(self) -> SharedState | None:
+        """The newest STAT, None if none has been published yet."""
+        buf = self.shm.buf
+        deadline = None
+        while True:
+            before = SEQ.unpack_from(buf, SEQ_OFFSET)[0]
+            if not before & 1:
+                fields = BODY.unpack_from(buf, HEADER.size)
+                if SEQ.unpack_from(buf, SEQ_OFFSET)[0] == before:
+                    break
+            if deadline is None:
+                deadline = time.monotonic() + READ_TIMEOUT
+            elif time.monotonic() > deadline:
+                raise TimeoutError("State block is being written for too long")
+            # let a writer that was switched out mid-write finish
+            time.sleep(0)
+        if fields[0] == 0:
+            return None
+        count, updated_at, present, sv1, fu, rd, x, z, depth, bat = fields[:10]
+        values = [x, z, sv1, fu, rd, fields[10:13], fields[13:16], depth, bat]
+        if present != ALL_PRESENT:
+            for bit in range(len(FIELDS)):
+                if not present >> bit & 1:
+                    values[bit] = None
+        return SharedState(count, updated_at, *values)
+
+    def close(self):
+        self.shm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a vehicle's latest telemetry from shared memory.")
+    parser.add_argument("vehicle", nargs="?", default="sub")
+    parser.add_argument("--rate", type=float, default=10, help="prints per second (default %(default)s)")
+    args = parser.parse_args()
+
+    reader = StateReader(args.vehicle)
+    try:
+        while True:
+            if state := reader.read():
+                age = time.time() - state.updated_at
+                print(f"#{state.count} {age * 1000:6.1f}ms ago  depth={state.depth} bat={state.bat} "
+                      f"acc={state.acc} gyro={state.gyro}")
+            time.sleep(1 / args.rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
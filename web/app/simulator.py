@@ -0,0 +1,364 @@
+import argparse
+from asyncio import CancelledError, create_task, run, sleep
+import logging
+from os import environ
+from time import monotonic
+from typing import Awaitable, Callable
+
+import numpy as np
+
+from framing import JETS
+from protocol import (
+    MOTOR_MAX_CHANGE_PER_S,
+    MOTOR_MAX_START,
+    MOTOR_MIN,
+    MOTOR_MIN_START,
+    SERVO_MAX,
+    SERVO_MIN,
+    Command,
+    MotionCmd,
+    StateCmd,
+)
+
+logger = logging.getLogger(__name__)
+
+# Physics steps per second, PUBMARINE_SIM_HZ for the shared simulator
+TICK_HZ = 100.0
+MAX_TICK_HZ = 1000
+# STATs per second a vehicle starts out with, the firmware's default
+STAT_HZ = 20
+# Steps run back to back to catch up after the event loop was busy, beyond that time slips
+MAX_CATCH_UP = 50
+
+# Rough numbers for the sub. Body axes are x forward, y right, z down and
+# attitude is roll, pitch, yaw in radians
+MASS = 14.0  # kg, with the water moved along with the hull
+INERTIA = np.array([0.25, 1.1, 1.1])  # kg m^2
+MOTOR_THRUST = 25.0  # N per motor at full throttle
+MOTOR_ARM = 0.12  # m, motor X to the left of the centre line and Z to the right
+JET_THRUST = 4.0  # N
+JET_ARM = 0.45  # m, bow and stern jets from the centre
+FIN_LIFT = 1.0  # N per (m/s)^2 at full deflection, fins SV1 and SV2 at the stern
+FIN_ARM = 0.5  # m behind the centre
+FIN_SPAN = 0.15  # m either side of the centre line
+BUOYANCY = 1.5  # N more than the sub weighs, so a stopped sub floats up
+RIGHTING = 8.0  # N m at 90 degrees of roll or pitch, the keel hangs below the centre
+LINEAR_DRAG = np.array([6.0, 20.0, 20.0])
+QUADRATIC_DRAG = np.array([12.0, 60.0, 60.0])
+ANGULAR_DRAG = np.array([0.8, 2.5, 2.5])
+GRAVITY = 9.81
+PITCH_LIMIT = np.pi / 2 - 0.01
+
+# How fast the servos turn, the motors follow the firmware's numbers in protocol.py
+SERVO_DEG_PER_S = 300.0
+
+# Depth at which the pressure sensor reads 1.0
+DEPTH_RANGE = 10.0  # m
+# A 3S pack from empty to full, with enough resistance to sag under the motors
+BATTERY_EMPTY = 10.5  # V
+BATTERY_FULL = 12.6  # V
+BATTERY_RESISTANCE = 0.06  # ohm
+BATTERY_CAPACITY = 5.0 * 3600  # coulombs
+IDLE_CURRENT = 0.4  # A
+MOTOR_CURRENT = 12.0  # A per motor at full throttle
+JET_CURRENT = 1.5  # A per jet
+
+# Standard deviation of the noise on each reading
+ACC_NOISE = 0.05
+GYRO_NOISE = 0.005
+DEPTH_NOISE = 0.0005
+BAT_NOISE = 0.01
+
+# From body axes to the IMU's: x forward, y left, z up
+SENSOR_AXES = np.array([1.0, -1.0, -1.0])
+
+# Per vehicle: attribute -> (shape, value a new vehicle starts with)
+_ARRAYS = {
+    "throttle_request": ((2,), 0.0),
+    "throttle": ((2,), 0.0),
+    "servo_request": ((2,), 90.0),
+    "servo": ((2,), 90.0),
+    "jets": ((len(JETS),), 0.0),
+    "velocity": ((3,), 0.0),
+    "rates": ((3,), 0.0),
+    "attitude": ((3,), 0.0),
+    "specific_force": ((3,), 0.0),
+    "depth": ((), 0.0),
+    "current": ((), IDLE_CURRENT),
+}
+
+Callback = Callable[[Command], Awaitable]
+
+
+class Simulator:
+    """Any number of simulated subs, stepped together as arrays with a row per vehicle."""
+
+    def __init__(self, tick_hz: float = TICK_HZ, seed: int | None = None):
+        if not 0 < tick_hz <= MAX_TICK_HZ:
+            raise ValueError(f"Simulator tick rate must be up to {MAX_TICK_HZ} Hz, not {tick_hz}")
+        self.tick_hz = tick_hz
+        self.dt = 1.0 / tick_hz
+        self.rng = np.random.default_rng(seed)
+        self.t = 0.0
+        self.ticks = 0
+        self.task = None
+        self.callbacks: list[Callback | None] = []
+        self.active = np.zeros(0, dtype=bool)
+        self.charge = np.zeros(0)
+        self.stat_period = np.zeros(0)
+        self.next_stat = np.zeros(0)
+        for name, (shape, _) in _ARRAYS.items():
+            setattr(self, name, np.zeros((0, *shape)))
+
+    def add(self, callback: Callback, stat_hz: float | None = None) -> int:
+        """A new vehicle at rest on the surface with a full battery, returning its slot."""
+        free = np.flatnonzero(~self.active)
+        if len(free):
+            slot = int(free[0])
+        else:
+            slot = len(self.active)
+            self._grow(max(4, 2 * slot))
+        self.callbacks[slot] = callback
+        self.active[slot] = True
+        self.charge[slot] = 1.0
+        self.reset(slot)
+        self.set_rate(slot, STAT_HZ if stat_hz is None else stat_hz)
+        if self.task is None:
+            self.task = create_task(self.run())
+        return slot
+
+    def remove(self, slot: int):
+        self.active[slot] = False
+        self.callbacks[slot] = None
+        if self.task and not self.active.any():
+            self.task.cancel()
+            self.task = None
+
+    def _grow(self, capacity: int):
+        extra = capacity - len(self.active)
+        self.callbacks += [None] * extra
+        self.active = np.concatenate((self.active, np.zeros(extra, dtype=bool)))
+        for name in ("charge", "stat_period", "next_stat"):
+            setattr(self, name, np.concatenate((getattr(self, name), np.zeros(extra))))
+        for name, (shape, _) in _ARRAYS.items():
+            setattr(self, name, np.concatenate((getattr(self, name), np.zeros((extra, *shape)))))
+
+    def reset(self, slot: int):
+        """Back to rest on the surface, like a Pico reboot. The battery stays as it was."""
+        for name, (_, value) in _ARRAYS.items():
+            getattr(self, name)[slot] = value
+        # level and still, the accelerometer only feels gravity
+        self.specific_force[slot] = (0.0, 0.0, -GRAVITY)
+        self.next_stat[slot] = self.t
+
+    def set_rate(self, slot: int, stat_hz: float):
+        stat_hz = min(stat_hz, self.tick_hz)
+        self.stat_period[slot] = 1.0 / stat_hz if stat_hz > 0 else 0.0
+        self.next_stat[slot] = self.t
+
+    def motion(self, slot: int, cmd: MotionCmd):
+        if cmd.x is not None:
+            self.throttle_request[slot, 0] = np.clip(cmd.x, -1.0, 1.0)
+        if cmd.z is not None:
+            self.throttle_request[slot, 1] = np.clip(cmd.z, -1.0, 1.0)
+        if cmd.sv1 is not None:
+            self.servo_request[slot, 0] = np.clip(cmd.sv1, SERVO_MIN, SERVO_MAX)
+        if cmd.sv2 is not None:
+            self.servo_request[slot, 1] = np.clip(cmd.sv2, SERVO_MIN, SERVO_MAX)
+        for index, jet in enumerate(JETS):
+            if (value := getattr(cmd, jet)) is not None:
+                self.jets[slot, index] = 1.0 if value else 0.0
+
+    def stop(self, slot: int):
+        """Like the firmware's STOP: motors off at once, jets off, servos back to centre."""
+        self.throttle_request[slot] = 0.0
+        self.throttle[slot] = 0.0
+        self.jets[slot] = 0.0
+        self.servo_request[slot] = 90.0
+
+    def step(self):
+        """Advance every vehicle by one tick."""
+        dt = self.dt
+        request = self.throttle_request
+        magnitude = np.abs(request)
+        motor_step = MOTOR_MAX_CHANGE_PER_S * dt
+        stopped = self.throttle == 0
+        # soft_motor_control: off at once below MOTOR_MIN, otherwise ramped
+        self.throttle = np.where(
+            magnitude < MOTOR_MIN, 0.0,
+            np.where(stopped & (magnitude < MOTOR_MIN_START), 0.0,
+                     np.where(stopped & (magnitude > MOTOR_MAX_START), np.sign(request) * MOTOR_MAX_START,
+                              self.throttle + np.clip(request - self.throttle, -motor_step, motor_step))))
+        servo_step = SERVO_DEG_PER_S * dt
+        self.servo += np.clip(self.servo_request - self.servo, -servo_step, servo_step)
+
+        velocity, rates = self.velocity, self.rates
+        u = velocity[:, 0]
+        roll, pitch = self.attitude[:, 0], self.attitude[:, 1]
+        sr, cr, sp, cp = np.sin(roll), np.cos(roll), np.sin(pitch), np.cos(pitch)
+        fu, fd, fl, fr, ru, rd, rl, rr = self.jets.T
+        bow_up, stern_up = JET_THRUST * (fu - fd), JET_THRUST * (ru - rd)
+        bow_right, stern_right = JET_THRUST * (fr - fl), JET_THRUST * (rr - rl)
+        thrust = MOTOR_THRUST * self.throttle
+        # upward force from each fin, servo angles past 90 lift the stern
+        fin_up = (FIN_LIFT * u * np.abs(u))[:, None] * np.sin(np.radians(self.servo - 90.0))
+
+        force = np.empty_like(velocity)
+        force[:, 0] = thrust.sum(1) + BUOYANCY * sp
+        force[:, 1] = bow_right + stern_right - BUOYANCY * sr * cp
+        force[:, 2] = -(bow_up + stern_up + fin_up.sum(1)) - BUOYANCY * cr * cp
+        force -= LINEAR_DRAG * velocity + QUADRATIC_DRAG * velocity * np.abs(velocity)
+
+        torque = np.empty_like(rates)
+        torque[:, 0] = FIN_SPAN * (fin_up[:, 0] - fin_up[:, 1]) - RIGHTING * sr
+        torque[:, 1] = JET_ARM * (bow_up - stern_up) - FIN_ARM * fin_up.sum(1) - RIGHTING * sp
+        torque[:, 2] = JET_ARM * (bow_right - stern_right) + MOTOR_ARM * (thrust[:, 0] - thrust[:, 1])
+        torque -= ANGULAR_DRAG * rates
+
+        acceleration = force / MASS
+        # what the accelerometer feels: acceleration plus turning, less gravity.
+        # np.cross and np.stack cost more than the arithmetic for a few vehicles
+        p, q, r = rates.T
+        v, w = velocity[:, 1], velocity[:, 2]
+        felt = self.specific_force
+        felt[:, 0] = q * w - r * v + GRAVITY * sp
+        felt[:, 1] = r * u - p * w - GRAVITY * sr * cp
+        felt[:, 2] = p * v - q * u - GRAVITY * cr * cp
+        felt += acceleration
+        velocity += acceleration * dt
+        rates += torque / INERTIA * dt
+
+        turn = q * sr + r * cr
+        self.attitude[:, 0] += (p + turn * np.tan(pitch)) * dt
+        self.attitude[:, 1] = np.clip(pitch + (q * cr - r * sr) * dt, -PITCH_LIMIT, PITCH_LIMIT)
+        self.attitude[:, 2] = (self.attitude[:, 2] + turn / cp * dt + np.pi) % (2 * np.pi) - np.pi
+
+        self.depth += (-u * sp + v * sr * cp + w * cr * cp) * dt
+        surfaced = self.depth < 0
+        self.depth[surfaced] = 0.0
+        velocity[surfaced, 2] = np.maximum(velocity[surfaced, 2], 0.0)
+
+        self.current = (
+            IDLE_CURRENT
+            + MOTOR_CURRENT * (np.abs(self.throttle) ** 1.5).sum(1)
+            + JET_CURRENT * self.jets.sum(1)
+        )
+        self.charge = np.maximum(self.charge - self.current * dt / BATTERY_CAPACITY, 0.0)
+        self.t += dt
+        self.ticks += 1
+
+    def due(self) -> np.ndarray:
+        """Slots whose next STAT is due, moving their schedule on."""
+        due = np.flatnonzero(self.active & (self.stat_period > 0) & (self.next_stat <= self.t))
+        if len(due):
+            self.next_stat[due] += self.stat_period[due]
+            # after a long stall, start counting from now rather than send a burst
+            self.next_stat[due] = np.maximum(self.next_stat[due], self.t)
+        return due
+
+    def states(self, slots: np.ndarray) -> list[StateCmd]:
+        """The STAT each vehicle's Pico would print, with sensor noise."""
+        n = len(slots)
+        rng = self.rng
+        acc = self.specific_force[slots] * SENSOR_AXES + rng.normal(0, ACC_NOISE, (n, 3))
+        gyro = self.rates[slots] * SENSOR_AXES + rng.normal(0, GYRO_NOISE, (n, 3))
+        depth = np.clip(self.depth[slots] / DEPTH_RANGE + rng.normal(0, DEPTH_NOISE, n), 0.0, 1.0)
+        bat = (
+            BATTERY_EMPTY + (BATTERY_FULL - BATTERY_EMPTY) * self.charge[slots]
+            - BATTERY_RESISTANCE * self.current[slots] + rng.normal(0, BAT_NOISE, n)
+        )
+        throttle = self.throttle[slots].round(4).tolist()
+        sv1 = np.rint(self.servo[slots, 0]).astype(int).tolist()
+        fu = self.jets[slots, JETS.index("fu")].astype(int).tolist()
+        rd = self.jets[slots, JETS.index("rd")].astype(int).tolist()
+        acc, gyro = acc.round(4).tolist(), gyro.round(4).tolist()
+        depth, bat = depth.round(5).tolist(), bat.round(3).tolist()
+        build = StateCmd._codec.build
+        return [
+            build({
+                "x": throttle[i][0],
+                "z": throttle[i][1],
+                "sv1": sv1[i],
+                "fu": fu[i],
+                "rd": rd[i],
+                "acc": tuple(acc[i]),
+                "gyro": tuple(gyro[i]),
+                "depth": depth[i],
+                "bat": bat[i],
+            }, [])
+            for i in range(n)
+        ]
+
+    async def run(self):
+        next_tick = monotonic()
+        while True:
+            steps = 0
+            while next_tick <= monotonic() and steps < MAX_CATCH_UP:
+                self.step()
+                next_tick += self.dt
+                steps += 1
+            if steps == MAX_CATCH_UP:
+                next_tick = monotonic()
+            slots = self.due()
+            for slot, state in zip(slots.tolist(), self.states(slots)):
+                if (callback := self.callbacks[slot]) is None:
+                    continue
+                try:
+                    await callback(state)
+                except CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Error handling simulated STAT")
+            await sleep(max(0.0, next_tick - monotonic()))
+
+
+_shared: Simulator | None = None
+
+
+def shared_simulator() -> Simulator:
+    """The one simulator every DebugSerialClient in the process adds its vehicle to, made on first use."""
+    global _shared
+    if _shared is None:
+        try:
+            _shared = Simulator(float(environ.get("PUBMARINE_SIM_HZ", TICK_HZ)))
+        except ValueError as e:
+            logger.warning("Ignoring PUBMARINE_SIM_HZ, stepping at %s Hz: %s", TICK_HZ, e)
+            _shared = Simulator()
+    return _shared
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run simulated subs without a server, to see how fast it goes.")
+    parser.add_argument("--vehicles", type=int, default=100)
+    parser.add_argument("--hz", type=float, default=MAX_TICK_HZ, help="physics steps per second (default %(default)s)")
+    parser.add_argument("--stat-hz", type=float, default=STAT_HZ, help="STATs per vehicle per second (default %(default)s)")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    async def go():
+        sim = Simulator(args.hz)
+        received = [0]
+        last: list[StateCmd] = []
+
+        async def count(state):
+            received[0] += 1
+            last[:] = [state]
+
+        slots = [sim.add(count, args.stat_hz) for _ in range(args.vehicles)]
+        for slot in slots[::2]:
+            sim.motion(slot, MotionCmd(x=0.8, z=0.6, sv1=120, sv2=120, fu=1))
+        started, ticks = monotonic(), sim.ticks
+        await sleep(args.seconds)
+        elapsed = monotonic() - started
+        for slot in slots:
+            sim.remove(slot)
+        print(f"{args.vehicles} vehicles: {(sim.ticks - ticks) / elapsed:.0f} ticks/s of {args.hz:.0f}, "
+              f"{received[0] / elapsed:.0f} STATs/s")
+        if last:
+            print(last[0].serialize())
+
+    run(go())
+
+
+if __name__ == "__main__":
+    main()
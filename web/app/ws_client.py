@@ -0,0 +1,136 @@
+from asyncio import Event, create_task
+from collections import deque
+import logging
+from time import monotonic
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+# Telemetry kept per client before the oldest frame is dropped
+TELEMETRY_QUEUE = 8
+# Console lines are never dropped, but a client this far behind is given up on
+CONSOLE_QUEUE = 1000
+
+
+class WebSocketClient:
+    """One browser with its own outbound queue and sender, so a slow one can't stall the rest."""
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        # (droppable, text) in the order they were queued
+        self.queue: deque[tuple[bool, str]] = deque()
+        self.droppable = 0
+        self.dropped = 0
+        self.sent = 0
+        self.closed = False
+        # set by a subscribe message, None means everything at full rate
+        self.max_rate: float | None = None
+        self.messages: set[str] | None = None
+        self.last_telemetry = 0.0
+        # the last droppable STAT queued, so an unchanged one isn't sent again
+        self.last_state: str | None = None
+        self.decimated = 0
+        self.repeated = 0
+        # inbound side, set by main.py for gamepad connections
+        self.ingest = None
+        self.wakeup = Event()
+        self.task = create_task(self.sender())
+
+    def subscribe(self, max_rate: float | None = None, messages: list[str] | None = None):
+        if not isinstance(max_rate, int | float | None) or not isinstance(messages, list | None):
+            logger.warning(f"Ignoring bad subscription from {self.name}: {max_rate!r} {messages!r}")
+            return
+        self.max_rate = max_rate if max_rate and max_rate > 0 else None
+        self.messages = {str(m) for m in messages} if messages is not None else None
+        logger.info(f"WebSocket client {self.name} subscribed to {messages or 'everything'} at {max_rate or 'full'} Hz")
+
+    def wants(self, name: str) -> bool:
+        return self.messages is None or name in self.messages
+
+    def publish(self, name: str, text: str, droppable: bool):
+        """Queue a message from the Pico if subscribed to, thinning droppable telemetry to max_rate."""
+        if not self.wants(name):
+            return
+        if name == "STAT":
+            if not droppable:
+                # a keyframe, the deltas after it are against a new base
+                self.last_state = None
+            elif text == self.last_state:
+                # drop-oldest keeps the newest frame, so the one queued still gets there
+                self.repeated += 1
+                return
+            if self.max_rate:
+                now = monotonic()
+                # a little slack so jitter in the Pico's tick doesn't halve the rate
+                if droppable and now - self.last_telemetry < 0.9 / self.max_rate:
+                    self.decimated += 1
+                    return
+                self.last_telemetry = now
+            if droppable:
+                self.last_state = text
+        self.send(text, droppable)
+
+    def send(self, text: str, droppable: bool = False):
+        """Queue a message without waiting. Droppable ones make way for newer ones when behind."""
+        if self.closed:
+            return
+        if droppable:
+            if self.droppable >= TELEMETRY_QUEUE:
+                self._drop_oldest()
+            self.droppable += 1
+        elif len(self.queue) - self.droppable >= CONSOLE_QUEUE:
+            logger.warning(f"WebSocket client {self.name} too far behind, closing")
+            self.close()
+            create_task(self.ws.close(code=1013))
+            return
+        self.queue.append((droppable, text))
+        self.wakeup.set()
+
+    def _drop_oldest(self):
+        for i, (droppable, _) in enumerate(self.queue):
+            if droppable:
+                del self.queue[i]
+                self.droppable -= 1
+                self.dropped += 1
+                return
+
+    async def sender(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue:
+                    droppable, text = self.queue.popleft()
+                    if droppable:
+                        self.droppable -= 1
+                    await self.ws.send_text(text)
+                    self.sent += 1
+        except Exception as e:
+            # the receive loop in main.py notices the disconnect and cleans up
+            logger.debug(f"WebSocket send to {self.name} failed: {e}")
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.droppable = 0
+        self.task.cancel()
+
+    @property
+    def name(self) -> str:
+        client = self.ws.client
+        return f"{client.host}:{client.port}" if client else "unknown"
+
+    def stats(self) -> dict:
+        return {
+            "client": self.name,
+            "queued": len(self.queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "decimated": self.decimated,
+            "repeated": self.repeated,
+            "max_rate": self.max_rate,
+            "messages": sorted(self.messages) if self.messages is not None else None,
+            "ingest": self.ingest.stats() if self.ingest is not None else None,
+        }
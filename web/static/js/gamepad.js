@@ -6,7 +6,9 @@ class GamepadController {
         this.isRunning = false;
         this.websocket = null;
         this.wsConnected = false;
-        this.objectGamepadState = "";
+        this.lastSnapshot = null;
+        this.stateKeyframe = null;
+        this.sendSeq = 0;
         this.submarine3D = null;
         this.artificialHorizon = null;
 
@@ -77,8 +79,9 @@ class GamepadController {
         // Wait for THREE and OBJLoader to be ready before initializing
         const initSub = () => {
             if (typeof THREE !== 'undefined' && typeof OBJLoader !== 'undefined' && typeof Submarine3D !== 'undefined') {
-                const modelPath = '/static/subsanwich.obj';
-                this.submarine3D = new Submarine3D('submarine-3d-container', modelPath);
+                // content-hashed URLs from the template
+                const { model, materials } = document.getElementById('submarine-3d-container').dataset;
+                this.submarine3D = new Submarine3D('submarine-3d-container', model || '/static/subsanwich.obj', materials);
                 console.log('3D submarine visualization initialized');
             } else {
                 console.warn('THREE, Submarine3D class or OBJLoader not found');
@@ -158,26 +161,6 @@ class GamepadController {
         this.animationFrame = requestAnimationFrame(() => this.loop());
     }
 
-    gamepadToObject(obj) {
-        if (obj === null || typeof obj !== 'object') {
-            return obj;
-        }
-
-        if (Array.isArray(obj)) {
-            return obj.map(item => this.gamepadToObject(item));
-        }
-
-        const result = {};
-        for (let prop in obj) {
-            const value = obj[prop];
-            if (typeof value !== 'function') {
-                result[prop] = this.gamepadToObject(value);
-            }
-        }
-
-        return result;
-    }
-
     updateGamepadState() {
         const gamepads = navigator.getGamepads();
         const gamepad = gamepads[this.gamepadIndex];
@@ -187,27 +170,14 @@ class GamepadController {
             return;
         }
 
-        const gamepadObj = this.gamepadToObject(gamepad)
-        if (!_.isEqual(gamepadObj, this.objectGamepadState)) {
-            console.log(gamepadObj)
-            this.objectGamepadState = gamepadObj
-            this.sendWebSocketData(
-                {
-                    type: 'gamepad_state',
-                    gamepad: gamepadObj,
-                }
-            )
-        }
+        // the server works out presses, sticks and triggers from what changed
+        this.sendSnapshot(gamepad);
 
         // Check buttons
         gamepad.buttons.forEach((button, index) => {
             const wasPressed = this.previousButtons[index] || false;
-            const isPressed = button.pressed;
-
-            if (!wasPressed && isPressed) {
-                this.onButtonPress(index, button.value);
-            } else if (wasPressed && !isPressed) {
-                this.onButtonRelease(index, button.value)
+            if (!wasPressed && button.pressed) {
+                this.showButtonPress(index);
             }
         });
 
@@ -220,17 +190,6 @@ class GamepadController {
         this.previousButtons = gamepad.buttons.map(button => button.pressed);
     }
 
-    onButtonRelease(buttonIndex, value) {
-        const buttonName = this.buttonNames[buttonIndex] || `Button ${buttonIndex}`;
-        this.sendWebSocketData({
-            type: 'button_release',
-            button_index: buttonIndex,
-            button_name: buttonName,
-            value: value,
-            timestamp: Date.now()
-        });
-    }
-
     onButtonPress(buttonIndex, value) {
         const buttonName = this.buttonNames[buttonIndex] || `Button ${buttonIndex}`;
 
@@ -242,6 +201,11 @@ class GamepadController {
             value: value,
             timestamp: Date.now()
         });
+        this.showButtonPress(buttonIndex);
+    }
+
+    showButtonPress(buttonIndex) {
+        const buttonName = this.buttonNames[buttonIndex] || `Button ${buttonIndex}`;
 
         // Update last pressed button display
         const lastButtonEl = document.getElementById('last-button');
@@ -266,55 +230,6 @@ class GamepadController {
 
             // Right stick (axes 2, 3)  
             this.updateStickDisplay('right-stick', axes[2], axes[3]);
-
-            // Send analog stick data via WebSocket (throttled and with deadzone)
-            if (!this.lastStickSent || Date.now() - this.lastStickSent > 10) {
-                const deadzone = 0.1;
-
-                // Left stick - only send if outside deadzone
-                if (Math.abs(axes[0]) >= deadzone || Math.abs(axes[1]) >= deadzone) {
-                    this.sendWebSocketData({
-                        type: 'analog_stick',
-                        stick: 'left',
-                        x: axes[0],
-                        y: axes[1],
-                        timestamp: Date.now()
-                    });
-                    this.lastLeftStickSent = true;
-                } else if (this.lastLeftStickSent) {
-                    this.sendWebSocketData({
-                        type: 'analog_stick',
-                        stick: 'left',
-                        x: 0.0,
-                        y: 0.0,
-                        timestamp: Date.now()
-                    });
-                    this.lastLeftStickSent = false;
-                }
-
-                // Right stick - only send if outside deadzone
-                if (Math.abs(axes[2]) >= deadzone || Math.abs(axes[3]) >= deadzone) {
-                    this.sendWebSocketData({
-                        type: 'analog_stick',
-                        stick: 'right',
-                        x: axes[2],
-                        y: axes[3],
-                        timestamp: Date.now()
-                    });
-                    this.lastRightStickSent = true;
-                } else if (this.lastRightStickSent) {
-                    this.sendWebSocketData({
-                        type: 'analog_stick',
-                        stick: 'right',
-                        x: 0.0,
-                        y: 0.0,
-                        timestamp: Date.now()
-                    });
-                    this.lastRightStickSent = false;
-                }
-
-                this.lastStickSent = Date.now();
-            }
         }
     }
 
@@ -325,50 +240,6 @@ class GamepadController {
 
             // Right trigger (button 7)
             this.updateTriggerDisplay('right-trigger', buttons[7].value);
-
-            // Send analog trigger data via WebSocket with deadzone
-            const deadzone = 0.1;
-            const now = Date.now();
-
-            // Left trigger - send when value changes
-            if (Math.abs(buttons[6].value) >= deadzone) {
-                this.sendWebSocketData({
-                    type: 'analog_trigger',
-                    trigger: 'left',
-                    value: buttons[6].value,
-                    timestamp: now
-                });
-                this.lastLeftTriggerSent = true;
-            }
-            if (Math.abs(buttons[6].value) < deadzone && this.lastLeftTriggerSent) {
-                this.sendWebSocketData({
-                    type: 'analog_trigger',
-                    trigger: 'left',
-                    value: 0,
-                    timestamp: now
-                });
-                this.lastLeftTriggerSent = false;
-            }
-
-            // Right trigger - send when value changes
-            if (Math.abs(buttons[7].value) >= deadzone) {
-                this.sendWebSocketData({
-                    type: 'analog_trigger',
-                    trigger: 'right',
-                    value: buttons[7].value,
-                    timestamp: now
-                });
-                this.lastRightTriggerSent = true;
-            }
-            if (Math.abs(buttons[7].value) < deadzone && this.lastRightTriggerSent) {
-                this.sendWebSocketData({
-                    type: 'analog_trigger',
-                    trigger: 'right',
-                    value: 0,
-                    timestamp: now
-                });
-                this.lastRightTriggerSent = false;
-            }
         }
     }
 
@@ -548,7 +419,10 @@ class GamepadController {
 
     initWebSocket() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws/gamepad`;
+        // /?vehicle=bench drives that vehicle instead of the server's first one
+        const vehicle = new URLSearchParams(window.location.search).get('vehicle');
+        const path = vehicle ? `/ws/${encodeURIComponent(vehicle)}/gamepad` : '/ws/gamepad';
+        const wsUrl = `${protocol}//${window.location.host}${path}`;
 
         try {
             this.websocket = new WebSocket(wsUrl);
@@ -556,7 +430,11 @@ class GamepadController {
             this.websocket.onopen = () => {
                 console.log('WebSocket connected');
                 this.wsConnected = true;
+                this.sendSeq = 0;
+                // the server's idea of the gamepad starts over, so send the next one whole
+                this.lastSnapshot = null;
                 this.updateWebSocketStatus(true);
+                this.sendSubscription();
             };
 
             this.websocket.onclose = () => {
@@ -577,7 +455,15 @@ class GamepadController {
                 const data = JSON.parse(event.data);
                 //console.log('Received from server:', data);
                 if (data.name === "STAT") {
-                    this.updateStatusDisplay(data);
+                    // deltas only carry what changed since the last full state
+                    if (data.delta) {
+                        if (this.stateKeyframe) {
+                            this.updateStatusDisplay({ ...this.stateKeyframe, ...data });
+                        }
+                    } else {
+                        this.stateKeyframe = data;
+                        this.updateStatusDisplay(data);
+                    }
                 } else if (data.name === "CONSOLE") {
                     console.info(data.line);
                     this.logConsole(data.level, data.line);
@@ -592,12 +478,71 @@ class GamepadController {
         }
     }
 
+    sendSubscription() {
+        // e.g. /?rate=10&messages=STAT for a view that doesn't need every frame
+        const params = new URLSearchParams(window.location.search);
+        const rate = params.get('rate');
+        const messages = params.get('messages');
+        if (rate === null && messages === null) {
+            return;
+        }
+        this.sendWebSocketData({
+            type: 'subscribe',
+            max_rate: rate !== null ? parseFloat(rate) : null,
+            messages: messages !== null ? messages.split(',') : null
+        });
+    }
+
     sendWebSocketData(data) {
         if (this.websocket && this.wsConnected && this.websocket.readyState === WebSocket.OPEN) {
+            // seq and sent_at let the server measure latency and spot lost messages
+            data.seq = ++this.sendSeq;
+            data.sent_at = performance.timeOrigin + performance.now();
             this.websocket.send(JSON.stringify(data));
         }
     }
 
+    encodeSnapshot(gamepad) {
+        // layout is in app/gamepad_frame.py, seq and sent_at are filled in when sent
+        const axes = gamepad.axes;
+        const buttons = gamepad.buttons.slice(0, 32);
+        const frame = new Uint8Array(16 + 2 * axes.length + 4 + buttons.length);
+        const view = new DataView(frame.buffer);
+        view.setUint8(0, 1);
+        view.setUint8(1, axes.length);
+        view.setUint8(2, buttons.length);
+        let offset = 16;
+        axes.forEach(axis => {
+            view.setInt16(offset, Math.round(Math.max(-1, Math.min(1, axis)) * 32767), true);
+            offset += 2;
+        });
+        let pressed = 0;
+        buttons.forEach((button, index) => {
+            if (button.pressed) pressed |= 1 << index;
+        });
+        view.setUint32(offset, pressed >>> 0, true);
+        offset += 4;
+        buttons.forEach(button => {
+            view.setUint8(offset++, Math.round(Math.max(0, Math.min(1, button.value)) * 255));
+        });
+        return frame;
+    }
+
+    sendSnapshot(gamepad) {
+        const frame = this.encodeSnapshot(gamepad);
+        const last = this.lastSnapshot;
+        if (last && last.length === frame.length && frame.every((byte, i) => i < 16 || byte === last[i])) {
+            return;
+        }
+        if (this.websocket && this.wsConnected && this.websocket.readyState === WebSocket.OPEN) {
+            const view = new DataView(frame.buffer);
+            view.setUint32(4, ++this.sendSeq, true);
+            view.setFloat64(8, performance.timeOrigin + performance.now(), true);
+            this.websocket.send(frame);
+            this.lastSnapshot = frame;
+        }
+    }
+
     updateWebSocketStatus(connected) {
         const wsStatusEl = document.getElementById('websocket-status');
         if (wsStatusEl) {
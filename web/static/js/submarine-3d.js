@@ -4,9 +4,10 @@
  */
 
 class Submarine3D {
-    constructor(containerId, modelPath) {
+    constructor(containerId, modelPath, materialsPath) {
         this.containerId = containerId;
         this.modelPath = modelPath;
+        this.materialsPath = materialsPath;
         this.scene = null;
         this.camera = null;
         this.renderer = null;
@@ -105,8 +106,8 @@ class Submarine3D {
     }
 
     loadModel() {
-        // Get the MTL file path from the OBJ path
-        const mtlPath = this.modelPath.replace('.obj', '.mtl');
+        // Get the MTL file path from the OBJ path unless given one
+        const mtlPath = this.materialsPath || this.modelPath.replace('.obj', '.mtl');
         const basePath = this.modelPath.substring(0, this.modelPath.lastIndexOf('/') + 1);
 
         // Load materials first
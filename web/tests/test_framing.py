@@ -0,0 +1,24 @@
+import pytest
+
+from framing import FrameType, cmd_frame, encode_batch, encode_cmd
+from protocol import MotionCmd, StopCmd
+
+
+def test_jets_pack_into_bits():
+    frame_type, payload = cmd_frame(MotionCmd(fu=1, fl=0, rr=1))
+    assert frame_type == FrameType.MOT
+    # presence mask, then the jets bitmask
+    assert payload[2] == 0b1000_0001
+
+
+@pytest.mark.parametrize("value", [2, 29, -1])
+def test_jet_out_of_range_goes_as_text(value):
+    # the text protocol passes it on and the Pico answers ERR Range, frames must not turn it into 1
+    assert cmd_frame(MotionCmd(fl=value)) is None
+    assert encode_cmd(MotionCmd(fl=value)) is None
+    assert encode_batch([StopCmd(), MotionCmd(fl=value)]) is None
+
+
+@pytest.mark.parametrize("cmd", [MotionCmd(x=1e300), MotionCmd(sv1=90 + 45 * 10**6), MotionCmd(sv2=-40000)])
+def test_values_a_frame_cant_hold_go_as_text(cmd):
+    assert cmd_frame(cmd) is None
@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+
+from history import lttb, minmax
+
+
+@pytest.mark.parametrize("downsample", [lttb, minmax])
+@pytest.mark.parametrize("points", [0, 1, 2, 3, 4, 10])
+def test_downsampling_keeps_at_most_points(downsample, points):
+    t = np.arange(100.0)
+    v = np.sin(t)
+    keep = downsample(t, v, points)
+    assert len(keep) <= points
+    if points >= 2:
+        assert keep[0] == 0 and keep[-1] == 99
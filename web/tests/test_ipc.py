@@ -0,0 +1,72 @@
+import asyncio
+import os
+import socket
+import stat
+
+import pytest
+
+import ipc
+from ipc import OwnerLink, SerialOwner
+
+
+def test_owner_socket_is_private_and_not_taken_over(tmp_path):
+    path = str(tmp_path / "run" / "pubmarine.sock")
+
+    async def main():
+        owner = SerialOwner({}, path)
+        await owner.start()
+        try:
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+            assert stat.S_IMODE(os.stat(tmp_path / "run").st_mode) == 0o700
+            with pytest.raises(RuntimeError):
+                await SerialOwner({}, path).start()
+        finally:
+            await owner.close()
+
+    asyncio.run(main())
+
+
+def test_owner_refuses_shared_socket_dir(tmp_path):
+    # made before the owner, e.g. by another user in /tmp
+    (tmp_path / "run").mkdir(mode=0o755)
+    os.chmod(tmp_path / "run", 0o755)
+    path = str(tmp_path / "run" / "pubmarine.sock")
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await SerialOwner({}, path).start()
+
+    asyncio.run(main())
+    assert not os.path.exists(path)
+
+
+def test_owner_replaces_stale_socket(tmp_path):
+    path = str(tmp_path / "pubmarine.sock")
+    # bound but never listening, like one left by an owner that was killed
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+
+    async def main():
+        owner = SerialOwner({}, path)
+        await owner.start()
+        await owner.close()
+
+    asyncio.run(main())
+
+
+def test_metrics_times_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(ipc, "METRICS_TIMEOUT", 0.05)
+    path = str(tmp_path / "pubmarine.sock")
+
+    async def main():
+        # accepts but never answers
+        server = await asyncio.start_unix_server(lambda reader, writer: None, path)
+        link = OwnerLink(path)
+        _, link.writer = await asyncio.open_unix_connection(path)
+        assert await link.metrics() is None
+        assert link.requests == {}
+        link.close()
+        server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def main():
+    # main.py loads static/ and templates/ relative to the working directory
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(Path(__file__).resolve().parent.parent)
+        import main
+        yield main
+
+
+def test_forward_headers_keeps_repeats(main):
+    headers = [
+        ("Set-Cookie", "a=1"),
+        ("Set-Cookie", "b=2"),
+        ("Connection", "keep-alive, X-Private"),
+        ("X-Private", "1"),
+        ("Transfer-Encoding", "chunked"),
+        ("Host", "example"),
+        ("Vary", "Accept"),
+        ("Vary", "Origin"),
+    ]
+    assert main.forward_headers(headers, frozenset({"host"})) == [
+        ("Set-Cookie", "a=1"),
+        ("Set-Cookie", "b=2"),
+        ("Vary", "Accept"),
+        ("Vary", "Origin"),
+    ]
+
+
+def test_worker_parent_leaves_ports_to_owner(tmp_path, monkeypatch):
+    import runpy
+    import subprocess
+    import uvicorn
+    from ipc import RemoteSerial
+
+    app_dir = Path(__file__).resolve().parent.parent
+    monkeypatch.chdir(app_dir)
+    monkeypatch.setenv("PUBMARINE_WORKERS", "2")
+    monkeypatch.setenv("PUBMARINE_RECORD_DIR", str(tmp_path / "rec"))
+    # set first so the parent's own setting is undone afterwards
+    monkeypatch.setenv("PUBMARINE_IPC_SOCKET", "")
+    monkeypatch.delenv("PUBMARINE_IPC_SOCKET")
+    started = []
+
+    class Owner:
+        def __init__(self, args):
+            started.append(args)
+
+        def terminate(self):
+            pass
+
+        def wait(self):
+            pass
+
+    monkeypatch.setattr(subprocess, "Popen", Owner)
+    monkeypatch.setattr(uvicorn, "run", lambda *args, **kwargs: None)
+    main = runpy.run_path(str(app_dir / "app" / "main.py"), run_name="__main__")
+    assert len(started) == 1
+    assert all(isinstance(vehicle.serial, RemoteSerial) for vehicle in main["vehicles"].values())
+    assert not (tmp_path / "rec").exists()
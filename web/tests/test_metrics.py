@@ -0,0 +1,29 @@
+from metrics import InputStamp, Metrics
+from protocol import StateCmd
+
+
+def test_clamped_servo_setpoint_is_matched():
+    metrics = Metrics()
+    # button A sends SV1=0, the firmware holds servos to 10..170 and reports 10
+    metrics.expect("sv1", 0, InputStamp(1, 1.0), 2.0, "sub")
+    metrics.state(StateCmd(sv1=10), "sub")
+    assert metrics.latency["serial_to_stat"].count == 1
+    assert metrics.expected["sub"] == {}
+
+
+def test_throttle_below_deadband_is_matched_as_off():
+    metrics = Metrics()
+    metrics.expect("x", 0.1, InputStamp(1, 1.0), 2.0, "sub")
+    metrics.state(StateCmd(x=0.0), "sub")
+    assert metrics.latency["serial_to_stat"].count == 1
+
+
+def test_serial_metrics_are_labelled_by_vehicle():
+    metrics = Metrics()
+    metrics.serial_for("sub").parse_errors["text"] += 2
+    metrics.serial_for("boat").rx_lines.add(3)
+    text = metrics.render()
+    assert 'pubmarine_serial_parse_errors_total{vehicle="sub",kind="text"} 2' in text
+    assert 'pubmarine_serial_parse_errors_total{vehicle="boat",kind="text"} 0' in text
+    assert 'pubmarine_serial_rx_lines_total{vehicle="boat"} 3' in text
+    assert 'pubmarine_serial_write_latency_seconds_count{vehicle="sub",priority="safety"} 0' in text
@@ -0,0 +1,150 @@
+import random
+
+from pydantic import ValidationError
+import pytest
+
+from protocol import Command, ConsoleLog, MotionCmd, StateCmd, StopCmd, ResetCmd
+
+# what firmware/code.py prints every tick
+FIRMWARE_STAT = (
+    "STAT X=0.0 Y=0.0 Z=0.0 SV1=90.0 SV2=95.0 SV3=-1 SV4=-1 FU=0 FD=0 FL=0 FR=0 RU=0 RD=0 RL=0 RR=0 "
+    "BAT=11.61 DEPTH=0.0123 ACC=0.23,0.12,9.89 GYRO=0.12,0.23,0.34"
+)
+
+LINES = [
+    FIRMWARE_STAT,
+    "STAT X=0.5 Z=-0.5 SV1=90 FU=1 RD=1 ACC=0.23,0.12,9.89 GYRO=0.12,0.23,0.34 DEPTH=0.5 BAT=11.6",
+    "STAT x=0.5 z=-0.5",
+    "STAT SV1=90.5",
+    "STAT SV1=90.",
+    "STAT SV1=+90.00",
+    "STAT SV1=1_0",
+    "STAT SV1=0090 FU=-0 RD=+1",
+    "STAT X=+1 Z=.5 DEPTH=1. BAT=inf",
+    "STAT X=0.5\tZ=1",
+    "STAT X=1_0.5",
+    "STAT X=abc",
+    "STAT X=",
+    "STAT X=nan",
+    "STAT X=1e3",
+    "STAT ACC=1,2",
+    "STAT ACC=1,2,3,4",
+    "STAT ACC=1,,3",
+    "STAT X=1 X=2",
+    "STAT X=1 NAME=MOT",
+    "STAT SAFE X=1",
+    "STAT X=0.5  Z=1",
+    "STAT X=٣",
+    "MOT X=1.0 Z=-0.5 SV1=90 FU=1.0 RD=1.0",
+    "MOT SV1=135 SV2=45",
+    "MOT FU=1.5",
+    "RESET",
+    "RESET SAFE",
+    "STOP",
+    "RATE STAT=50 DEBUG=0",
+    "PROTO BIN",
+    "BOOT",
+    "CAL",
+    "ERR Range",
+    "# req x = 0.0, current x = 0.0",
+    "",
+]
+
+
+def reference(text: str) -> Command | None:
+    try:
+        return Command.validate_text(text)
+    except ValidationError:
+        return None
+
+
+def assert_same(cmd: Command | None, expected: Command | None):
+    if expected is None:
+        assert cmd is None
+        return
+    assert type(cmd) is type(expected)
+    # repr tells 1 from 1.0 and has nan equal to nan
+    assert repr(cmd.__dict__) == repr(expected.__dict__)
+    assert cmd.model_fields_set == expected.model_fields_set
+
+
+def stat_lines(count: int = 200, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        x = rng.choice((0.0, 0.5, -1.0, round(rng.uniform(-1, 1), 6)))
+        sv1 = rng.choice(("90.0", "45", "135.0", str(rng.randint(0, 180))))
+        jets = " ".join(f"{jet}={rng.choice('01')}" for jet in ("FU", "FD", "FL", "FR", "RU", "RD", "RL", "RR"))
+        acc = ",".join(str(round(rng.gauss(0, 3), 6)) for _ in range(3))
+        lines.append(f"STAT X={x} Y=0.0 Z={-x} SV1={sv1} SV2=90.0 {jets} BAT={rng.uniform(10, 13):.5f} "
+                     f"DEPTH={rng.uniform(0, 2):.6f} ACC={acc} GYRO={acc}")
+    return lines
+
+
+@pytest.mark.parametrize("text", LINES)
+def test_parse_matches_pydantic(text):
+    expected = reference(text)
+    # the first parse learns the key layout, the second goes through it
+    assert_same(Command.parse(text), expected)
+    assert_same(Command.parse(text), expected)
+
+
+def test_layout_changes():
+    # each line after a different one, so every line is parsed both ways
+    lines = stat_lines() + LINES
+    for previous, text in zip(lines, lines[1:] + lines[:1]):
+        Command.parse(previous)
+        assert_same(Command.parse(text), reference(text))
+
+
+def test_alternating_layouts_are_kept():
+    codec = StateCmd._codec
+    lines = ["STAT X=0.5 Z=0.5", "STAT DEPTH=0.1 BAT=11.5"]
+    for text in lines:
+        Command.parse(text)
+    layouts = list(codec.layouts.values())
+    for text in lines * 3:
+        assert_same(Command.parse(text), reference(text))
+    assert all(layout in codec.layouts.values() for layout in layouts)
+
+
+def test_deserialize_raises_like_pydantic():
+    with pytest.raises(ValidationError):
+        Command.deserialize("STAT SV1=90.5")
+    with pytest.raises(ValidationError):
+        Command.deserialize("BOOT")
+
+
+def reflective_serialize(cmd: Command) -> str:
+    """How serialize() worked before the codec."""
+    text = cmd.name
+    for mod in cmd.flags:
+        text += f" {mod}"
+    for key in cmd.__class__.model_fields:
+        if key in Command.model_fields or key == "name":
+            continue
+        val = getattr(cmd, key)
+        if val is None:
+            continue
+        if type(val) is tuple:
+            val = ','.join(str(x) for x in val)
+        text += f" {key.upper()}={val}"
+    return text
+
+
+@pytest.mark.parametrize("cmd", [
+    MotionCmd(sv1=135, sv2=45),
+    MotionCmd(x=1.0, z=-1.0, sv1=90, fu=1, rd=1),
+    StopCmd(),
+    ResetCmd(flags=["SAFE"]),
+    StateCmd.default(),
+    ConsoleLog(level="ERROR", line="boom"),
+])
+def test_serialize_matches_reflection(cmd):
+    assert cmd.serialize() == reflective_serialize(cmd)
+
+
+@pytest.mark.parametrize("text", stat_lines(20))
+def test_round_trip(text):
+    cmd = Command.parse(text)
+    assert_same(Command.parse(cmd.serialize()), cmd)
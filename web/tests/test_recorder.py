@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import pytest
+
+import recorder
+from recorder import Segment, clock_offset, load_segment
+
+
+def test_clock_offset_taken_again_on_close(tmp_path, monkeypatch):
+    path = tmp_path / "telemetry.rec"
+    # created before NTP set the clock, then it jumps a day ahead
+    monkeypatch.setattr(recorder.time, "time", lambda: 1_000.0 + time.monotonic())
+    segment = Segment(path, 16)
+    assert clock_offset(path, load_segment(path)) == pytest.approx(1_000.0)
+    monkeypatch.setattr(recorder.time, "time", lambda: 87_400.0 + time.monotonic())
+    segment.close()
+    assert clock_offset(path, load_segment(path)) == pytest.approx(87_400.0)
+
+
+def test_failed_segment_is_dropped_not_raised(tmp_path, monkeypatch):
+    from asyncio import sleep
+
+    from protocol import StateCmd
+
+    rec = recorder.TelemetryRecorder(tmp_path, segment_records=4)
+
+    async def main():
+        rec.start()
+        real = recorder.Segment
+
+        def full(*args):
+            raise OSError(28, "No space left on device")
+
+        monkeypatch.setattr(recorder, "Segment", full)
+        for _ in range(6):
+            rec.record(StateCmd(x=0.1))
+            await sleep(0.01)
+        assert rec.recorded == 4 and rec.dropped == 2
+        monkeypatch.setattr(recorder, "Segment", real)
+        for _ in range(3):
+            rec.record(StateCmd(x=0.1))
+            await sleep(0.01)
+        assert rec.recorded > 4
+        rec.close()
+
+    asyncio.run(main())
+
+
+def test_pruning_follows_numbering_not_clock(tmp_path):
+    # made before NTP set the clock, so the times say these are the oldest
+    for name in ("telemetry-000003-19700101-000010", "telemetry-000004-19700101-000020",
+                 "telemetry-000001-20261017-120000", "telemetry-000002-20261017-130000",
+                 "telemetry-20261016-090000-0001"):
+        (tmp_path / f"{name}.rec").touch()
+    assert [path.stem[:16] for path in recorder.list_segments(tmp_path)] == [
+        "telemetry-202610", "telemetry-000001", "telemetry-000002", "telemetry-000003", "telemetry-000004",
+    ]
+    rec = recorder.TelemetryRecorder(tmp_path, max_segments=3)
+    assert rec._next_path().name.startswith("telemetry-000005-")
+    rec._retire(None)
+    assert [path.stem[:16] for path in recorder.list_segments(tmp_path)] == [
+        "telemetry-000002", "telemetry-000003", "telemetry-000004",
+    ]
@@ -0,0 +1,153 @@
+from asyncio import CancelledError, run
+
+import pytest
+
+from protocol import Command
+from serial_client import SerialClient
+
+
+def read_once(client: SerialClient, lines: list[str]) -> list:
+    """Run continuous_read over one read of lines, returning what reached the callback."""
+    received = []
+    reads = iter([lines])
+
+    async def read_messages():
+        try:
+            return next(reads)
+        except StopIteration:
+            raise CancelledError
+
+    async def callback(msg):
+        received.append(msg)
+
+    client.read_messages = read_messages
+    client.callback = callback
+
+    async def go():
+        with pytest.raises(CancelledError):
+            await client.continuous_read()
+
+    run(go())
+    return received
+
+
+def test_code_py_restart_calls_on_restart():
+    client = SerialClient()
+    restarts = []
+    client.on_restart = lambda: restarts.append(True)
+    read_once(client, ["STAT X=0.0", "soft reboot", "code.py output:", "STAT X=0.0"])
+    assert restarts == [True]
+
+
+def test_restart_forgets_sent_setpoints():
+    from plumbing import Plumbing
+
+    plumbing = Plumbing(serial=SerialClient())
+    plumbing.motion_sent.update(x=0.5, sv1=120)
+    plumbing.serial.restarted()
+    # unchanged setpoints go out again to the fresh firmware
+    assert plumbing.motion_sent == {}
+
+
+def test_stale_stats_are_recorded_but_not_passed_on(tmp_path):
+    from plumbing import Plumbing
+
+    client = SerialClient()
+    plumbing = Plumbing("sub", client, str(tmp_path))
+    plumbing.recorder.start()
+    received = read_once(client, ["STAT X=0.0", "STAT X=0.3", "ERR nope", "STAT X=0.5"])
+    assert [msg.name for msg in received] == ["CONSOLE", "STAT"]
+    assert client.metrics.stale_skipped == 2
+    # the newest went to the callback, which read_once took over from Plumbing
+    assert plumbing.history.count == 2
+    assert plumbing.history.columns["x"][:2].tolist() == pytest.approx([0.0, 0.3])
+    assert plumbing.recorder.recorded == 2
+    plumbing.recorder.close()
+
+
+def test_stale_stats_not_parsed_without_recorder(monkeypatch):
+    from plumbing import Plumbing
+
+    client = SerialClient()
+    plumbing = Plumbing("sub", client)
+    assert client.on_stale is None
+    parsed = []
+    parse = Command.parse
+    monkeypatch.setattr(Command, "parse", lambda text: parsed.append(text) or parse(text))
+    received = read_once(client, ["STAT X=0.0", "STAT X=0.3", "STAT X=0.5"])
+    assert [msg.x for msg in received] == [0.5]
+    assert parsed == ["STAT X=0.5"]
+    assert plumbing.history.count == 0
+
+
+def test_broken_newest_stat_is_a_parse_error():
+    client = SerialClient()
+    received = read_once(client, ["STAT X=0.1", "STAT X=abc"])
+    assert [msg.name for msg in received] == ["STAT", "CONSOLE"]
+    assert received[0].x == 0.1
+    assert client.metrics.stale_skipped == 0
+    assert client.metrics.parse_errors["text"] == 1
+
+
+def test_replay_joins_segments_from_separate_runs():
+    from serial_client import REPLAY_STAT_INTERVAL, ReplaySerialClient
+
+    first = [(100.0, "a"), (100.05, "b")]
+    same_run = [(100.1, "c")]
+    after_reboot = [(3.0, "d"), (3.05, "e")]
+    hours_later = [(9000.0, "f")]
+    timeline = ReplaySerialClient.join_segments([first, same_run, [], after_reboot, hours_later])
+    times = [t for t, _ in timeline]
+    assert [item for _, item in timeline] == list("abcdef")
+    assert times == sorted(times)
+    assert times[3] == pytest.approx(100.1 + REPLAY_STAT_INTERVAL)
+    assert times[4] - times[3] == pytest.approx(0.05)
+    assert times[5] == pytest.approx(times[4] + REPLAY_STAT_INTERVAL)
+
+
+def test_sender_survives_a_batch_that_fails_to_encode():
+    from asyncio import create_task
+
+    from protocol import MotionCmd, StopCmd
+
+    class Writer:
+        def __init__(self):
+            self.written = []
+
+        def write(self, data):
+            self.written.append(data)
+
+        async def drain(self):
+            pass
+
+    client = SerialClient()
+    client.writer = Writer()
+    encode = client.encode
+
+    def failing(cmds):
+        if any(isinstance(cmd, MotionCmd) for cmd in cmds):
+            raise OverflowError("float too large to pack with f format")
+        return encode(cmds)
+
+    client.encode = failing
+
+    async def go():
+        client.send_task = create_task(client.sender())
+        motion = await client.write_cmd(MotionCmd(x=1e300))
+        stop = await client.write_cmd(StopCmd())
+        assert not client.send_task.done()
+        client.send_task.cancel()
+        return motion, stop
+
+    motion, stop = run(go())
+    assert motion is None and stop is not None
+    assert client.writer.written == [b"STOP\n"]
+
+
+def test_gamepad_input_is_held_to_axis_range():
+    from plumbing import Plumbing
+
+    plumbing = Plumbing(serial=SerialClient())
+    run(plumbing.stick_moved("left", 0.0, 1e6))
+    run(plumbing.trigger_moved("right", float("nan")))
+    assert plumbing.motion_pending == {"sv1": 135, "sv2": 45, "x": 0.0, "z": 0.0}
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from protocol import StateCmd
+from shared_state import StatePublisher, StateReader, block_name
+
+
+@pytest.fixture
+def vehicle():
+    name = f"test_{os.getpid()}"
+    yield name
+    try:
+        StatePublisher(name).close()
+    except FileNotFoundError:
+        pass
+
+
+def test_reopened_block_drops_the_old_stat(vehicle):
+    publisher = StatePublisher(vehicle)
+    publisher.publish(StateCmd(x=0.5, depth=0.2))
+    reader = StateReader(vehicle)
+    assert reader.read().x == 0.5
+    seq = reader.seq()
+    # a server restarting after a crash finds its old block
+    publisher.shm.close()
+    publisher = StatePublisher(vehicle)
+    assert reader.read() is None
+    assert reader.seq() != seq
+    publisher.publish(StateCmd(x=0.1))
+    state = reader.read()
+    assert (state.count, state.x, state.depth) == (1, 0.1, None)
+    reader.close()
+    publisher.close()
+
+
+@pytest.mark.parametrize("name", ["", "../sub", "sub/1", "sub 1", "süb"])
+def test_bad_vehicle_names_are_rejected(name):
+    with pytest.raises(ValueError):
+        block_name(name)
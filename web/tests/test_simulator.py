@@ -0,0 +1,65 @@
+import numpy as np
+
+from protocol import MOTOR_MAX_START, SERVO_MAX, SERVO_MIN, MotionCmd
+import simulator
+from simulator import Simulator
+
+
+def vehicle(tick_hz=100):
+    sim = Simulator(tick_hz, seed=1)
+    sim._grow(1)
+    sim.active[0] = True
+    sim.charge[0] = 1.0
+    sim.reset(0)
+    return sim
+
+
+def test_servos_held_to_firmware_range():
+    sim = vehicle()
+    sim.motion(0, MotionCmd(sv1=0, sv2=180))
+    assert sim.servo_request[0].tolist() == [SERVO_MIN, SERVO_MAX]
+
+
+def test_motor_start_like_firmware():
+    sim = vehicle()
+    # a stopped motor ignores small requests
+    sim.motion(0, MotionCmd(x=0.25))
+    sim.step()
+    assert sim.throttle[0, 0] == 0.0
+    # and starts big ones at MOTOR_MAX_START, then ramps
+    sim.motion(0, MotionCmd(x=-1.0))
+    sim.step()
+    assert sim.throttle[0, 0] == -MOTOR_MAX_START
+    sim.step()
+    assert np.isclose(sim.throttle[0, 0], -MOTOR_MAX_START - 4.0 * sim.dt)
+    # below MOTOR_MIN it is off at once
+    sim.motion(0, MotionCmd(x=0.1))
+    sim.step()
+    assert sim.throttle[0, 0] == 0.0
+
+
+def test_bad_sim_hz_falls_back_to_default(monkeypatch):
+    monkeypatch.setenv("PUBMARINE_SIM_HZ", "fast")
+    monkeypatch.setattr(simulator, "_shared", None)
+    assert simulator.shared_simulator().tick_hz == simulator.TICK_HZ
+
+
+def test_debug_serial_rejects_out_of_range_jets():
+    from asyncio import run
+
+    from serial_client import DebugSerialClient
+
+    client = DebugSerialClient()
+    client.simulator = vehicle()
+    client.slot = 0
+    received = []
+
+    async def callback(msg):
+        received.append(msg.line)
+
+    client.callback = callback
+    run(client.write_cmd(MotionCmd(fu=2, x=0.5)))
+    run(client.write_text("MOT FU=1;MOT RD=5"))
+    assert received == ["ERR Range", "ERR Range"]
+    assert client.simulator.jets[0].tolist() == [0.0] * 8
+    assert client.simulator.throttle_request[0, 0] == 0.0
@@ -0,0 +1,52 @@
+from asyncio import run
+from types import SimpleNamespace
+
+from broadcast import TelemetryEncoder
+from protocol import StateCmd
+import ws_client
+from ws_client import WebSocketClient
+
+
+class FakeWebSocket:
+    client = SimpleNamespace(host="127.0.0.1", port=1)
+
+    async def send_text(self, text: str):
+        pass
+
+
+def queued(client: WebSocketClient) -> list[str]:
+    return [text for _, text in client.queue]
+
+
+def test_rate_limited_client_gets_delta_it_thinned_out(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(ws_client, "monotonic", lambda: clock[0])
+
+    async def go():
+        encoder = TelemetryEncoder()
+        client = WebSocketClient(FakeWebSocket())
+        client.subscribe(max_rate=2)
+        # keyframe, delta A, then B while over the rate, then B again at 20 Hz
+        states = [StateCmd(depth=0.0), StateCmd(depth=1.0)] + [StateCmd(depth=2.0)] * 20
+        for state in states:
+            client.publish("STAT", *encoder.encode(state))
+            clock[0] += 0.05
+        texts = queued(client)
+        client.close()
+        return texts
+
+    texts = run(go())
+    assert '"depth":2.0' in texts[-1]
+
+
+def test_unchanged_delta_queued_once():
+    async def go():
+        encoder = TelemetryEncoder()
+        client = WebSocketClient(FakeWebSocket())
+        for state in [StateCmd(depth=0.0)] + [StateCmd(depth=1.0)] * 5:
+            client.publish("STAT", *encoder.encode(state))
+        client.close()
+        return client
+
+    client = run(go())
+    assert client.repeated == 4